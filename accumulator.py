@@ -16,12 +16,21 @@ send to the ratings API contains at least 10 ratings, only one request will be
 sent. However, if more ratings are needed, the additional API call will be made
 only when the generator goes that far. This, in general, makes quick iterations
 faster.
+
+Pagination ends at the first empty page, or earlier when a page is known to be
+the last one: either the fetcher returned a model.Page marked is_last, or the
+page is shorter than page_size. With prefetch set, up to that many of the
+following pages are fetched on background threads while the current page is
+consumed, trading a few speculative requests for latency.
 '''
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Callable, List, Optional
+from typing import Callable, Deque, List, Optional
 
 from fetcher import safe_run
+from model import Page
 
 
 @dataclass
@@ -34,11 +43,26 @@ class Accumulator:
     Fields:
         zero_indexed_fetcher: A function that given an integer i returns the
             ith page of data. The first page is index 0.
+        page_size: If set, a page with fewer items is the last page.
+        prefetch: How many pages past the current one to fetch in the
+            background. 0 fetches each page only when it is needed.
     '''
 
     zero_indexed_fetcher: Callable[[int], Optional[List]]
+    page_size: Optional[int] = None
+    prefetch: int = 0
+
+    def _is_last(self, page: List) -> bool:
+        if isinstance(page, Page) and page.is_last:
+            return True
+
+        return self.page_size is not None and len(page) < self.page_size
 
     def generator(self):
+        if self.prefetch > 0:
+            yield from self._prefetching_generator()
+            return
+
         i = 0
         safe_fetcher = lambda i: safe_run(lambda: self.zero_indexed_fetcher(i))
         page = safe_fetcher(i)
@@ -46,6 +70,44 @@ class Accumulator:
 
         while len(page) > 0:
             yield from page
+            if self._is_last(page):
+                return
+
             i += 1
             page = safe_fetcher(i)
             page = page if page is not None else []
+
+    def _prefetching_generator(self):
+        safe_fetcher = lambda i: safe_run(lambda: self.zero_indexed_fetcher(i))
+        executor = ThreadPoolExecutor(max_workers=self.prefetch + 1)
+        pending: Deque[Future] = deque()
+        next_index = 0
+        page_count = None
+
+        def schedule():
+            nonlocal next_index
+            while (len(pending) <= self.prefetch
+                   and (page_count is None or next_index < page_count)):
+                pending.append(executor.submit(safe_fetcher, next_index))
+                next_index += 1
+
+        try:
+            schedule()
+            while len(pending) > 0:
+                page = pending.popleft().result()
+                if not page:
+                    return
+
+                if isinstance(page, Page) and page.page_count is not None:
+                    page_count = page.page_count
+
+                if self._is_last(page):
+                    yield from page
+                    return
+
+                schedule()
+                yield from page
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
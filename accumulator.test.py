@@ -1,6 +1,8 @@
+import threading
 import unittest
 
 from accumulator import Accumulator
+from model import Page
 
 
 def raise_fetcher(x: int):
@@ -21,6 +23,30 @@ def quiet_fetcher(x: int):
             return []
 
 
+class CountingFetcher:
+    '''
+    Serves fixed pages and records which page indices were requested.
+    '''
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requested = []
+        self.lock = threading.Lock()
+
+    def __call__(self, x: int):
+        with self.lock:
+            self.requested.append(x)
+
+        return self.pages[x] if x < len(self.pages) else []
+
+
+def marked_page(items, is_last=False, page_count=None):
+    page = Page(items)
+    page.is_last = is_last
+    page.page_count = page_count
+    return page
+
+
 class AccumulatorTest(unittest.TestCase):
     def test_pagination_with_exception_at_end(self):
         accumulator = Accumulator(raise_fetcher)
@@ -36,6 +62,63 @@ class AccumulatorTest(unittest.TestCase):
         generator = accumulator.generator()
         self.assertListEqual([1, 2, 3], [x for x in generator])
 
+    def test_short_page_ends_pagination(self):
+        fetcher = CountingFetcher([[1, 2, 3], [4, 5]])
+        accumulator = Accumulator(fetcher, page_size=3)
+
+        self.assertListEqual([1, 2, 3, 4, 5], list(accumulator.generator()))
+        self.assertListEqual([0, 1], fetcher.requested)
+
+    def test_last_page_marker_ends_pagination(self):
+        fetcher = CountingFetcher([marked_page([1, 2]),
+                                   marked_page([3, 4], is_last=True),
+                                   [5, 6]])
+        accumulator = Accumulator(fetcher)
+
+        self.assertListEqual([1, 2, 3, 4], list(accumulator.generator()))
+        self.assertListEqual([0, 1], fetcher.requested)
+
+    def test_prefetch_preserves_order(self):
+        pages = [[3 * x, 3 * x + 1, 3 * x + 2] for x in range(10)]
+        fetcher = CountingFetcher(pages)
+        accumulator = Accumulator(fetcher, prefetch=3)
+
+        self.assertListEqual(list(range(30)), list(accumulator.generator()))
+
+    def test_prefetch_with_exception_at_end(self):
+        accumulator = Accumulator(raise_fetcher, prefetch=2)
+
+        self.assertListEqual([1, 2, 3, 4, 5, 6],
+                             list(accumulator.generator()))
+
+    def test_prefetch_stays_within_page_count(self):
+        fetcher = CountingFetcher([marked_page([1], page_count=2),
+                                   marked_page([2], is_last=True, page_count=2)])
+        accumulator = Accumulator(fetcher, prefetch=1)
+        generator = accumulator.generator()
+
+        self.assertEqual(1, next(generator))
+        self.assertListEqual([2], list(generator))
+        self.assertListEqual([0, 1], sorted(fetcher.requested))
+
+    def test_prefetch_reads_ahead_of_consumer(self):
+        second_page_requested = threading.Event()
+
+        def fetcher(x: int):
+            match x:
+                case 0:
+                    # Only returns once page 1 is being fetched concurrently
+                    self.assertTrue(second_page_requested.wait(timeout=5))
+                    return [1]
+                case 1:
+                    second_page_requested.set()
+                    return [2]
+                case _:
+                    return []
+
+        accumulator = Accumulator(fetcher, prefetch=1)
+        self.assertListEqual([1, 2], list(accumulator.generator()))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,63 @@
+'''
+area_index.py
+
+Provides RouteAreaIndex, which maps route ids to the id of the area they are
+in, built from the route links on the area pages the scraper already fetches.
+This fills in Route.area_id at crawl time instead of downloading every route's
+own HTML page for its breadcrumb.
+
+An area page links to its own routes but may also link to routes deeper in
+the hierarchy, e.g. a list of classic climbs. When a route is linked from
+several areas, the deepest one (the longest area_chain) wins, which is the
+area the route is actually in.
+'''
+
+from typing import Dict, Iterable, List, Tuple
+
+from model import Area
+
+
+class RouteAreaIndex:
+    '''
+    Route id to (area depth, area id), see the module docstring.
+    '''
+
+    _areas: Dict[str, Tuple[int, int]]
+
+    def __init__(self):
+        self._areas = {}
+
+    def add(self, area: Area, route_ids: Iterable[str]):
+        self.add_route_areas({route_id: (len(area.area_chain), area.area_id)
+                              for route_id in route_ids})
+
+    def add_route_areas(self, route_areas: Dict[str, Tuple[int, int]]):
+        for route_id, (depth, area_id) in route_areas.items():
+            current = self._areas.get(route_id)
+            if current is None or depth > current[0]:
+                self._areas[route_id] = (depth, area_id)
+
+    def merge(self, other: 'RouteAreaIndex'):
+        self.add_route_areas(other._areas)
+
+    def area_id(self, route_id: str) -> int:
+        '''
+        Return the area_id of a route, or 0 if no crawled area links to it.
+        '''
+
+        current = self._areas.get(route_id)
+        return current[1] if current is not None else 0
+
+    def to_json(self) -> Dict[str, List[int]]:
+        return {route_id: [depth, area_id]
+                for route_id, (depth, area_id) in self._areas.items()}
+
+    @staticmethod
+    def from_json(dictionary: Dict[str, List[int]]) -> 'RouteAreaIndex':
+        index = RouteAreaIndex()
+        index.add_route_areas({route_id: (depth, area_id)
+                               for route_id, (depth, area_id) in dictionary.items()})
+        return index
+
+    def __len__(self) -> int:
+        return len(self._areas)
@@ -0,0 +1,59 @@
+import json
+import unittest
+
+from area_index import RouteAreaIndex
+from model import Area
+
+
+def area(area_id: int, *ancestors: int) -> Area:
+    return Area(area_id, 'Area %d' % area_id, 0.0, 0.0, [area_id, *ancestors, 0])
+
+
+class RouteAreaIndexTest(unittest.TestCase):
+    def test_deepest_area_wins(self):
+        index = RouteAreaIndex()
+        # A crag lists its classics, which are in its walls
+        index.add(area(3, 2, 1), ['10'])
+        index.add(area(2, 1), ['10', '11'])
+        index.add(area(1), ['10', '11', '12'])
+
+        self.assertEqual(3, index.area_id('10'))
+        self.assertEqual(2, index.area_id('11'))
+        self.assertEqual(1, index.area_id('12'))
+        self.assertEqual(0, index.area_id('13'))
+        self.assertEqual(3, len(index))
+
+    def test_first_of_equally_deep_areas_wins(self):
+        index = RouteAreaIndex()
+        index.add(area(2, 1), ['10'])
+        index.add(area(3, 1), ['10'])
+        self.assertEqual(2, index.area_id('10'))
+
+    def test_merge(self):
+        index = RouteAreaIndex()
+        index.add(area(2, 1), ['10', '11'])
+        other = RouteAreaIndex()
+        other.add(area(3, 2, 1), ['10'])
+        other.add(area(1), ['11', '12'])
+
+        index.merge(other)
+        self.assertEqual(3, index.area_id('10'))
+        self.assertEqual(2, index.area_id('11'))
+        self.assertEqual(1, index.area_id('12'))
+        self.assertEqual(1, other.area_id('11'))
+
+    def test_json_round_trip(self):
+        index = RouteAreaIndex()
+        index.add(area(3, 2, 1), ['10'])
+        index.add(area(1), ['10', '11'])
+
+        read = RouteAreaIndex.from_json(json.loads(json.dumps(index.to_json())))
+        self.assertDictEqual({'10': [4, 3], '11': [2, 1]}, read.to_json())
+        # Depths survive, so a later shallower area still loses
+        read.add(area(2, 1), ['10', '11'])
+        self.assertEqual(3, read.area_id('10'))
+        self.assertEqual(2, read.area_id('11'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+'''
+Shows the query plan and latency of the queries the recommenders, notebooks
+and area_id backfill run, on the tables alone (schema version 1) and after
+migrating to the current schema, see schema.py.
+
+The rows are copied from a database, or a synthetic one shaped like a real
+crawl when no database is given. The database itself is not modified.
+
+Usage:
+python3 bench_schema.py [DATABASE] [--reviews N] [--samples N]
+'''
+
+import argparse
+import io
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import redirect_stderr
+from typing import List, Tuple
+
+from schema import migrate
+
+DEFAULT_SYNTHETIC_REVIEWS = 1_000_000
+DEFAULT_SAMPLES = 200
+
+# Name, query, and the reviews columns whose values of a random review are its
+# parameters
+QUERIES: List[Tuple[str, str, Tuple[str, ...]]] = [
+    ('is_good_recommendation',
+     'SELECT score FROM reviews WHERE 1=1 AND user_id = ? AND route_id = ?',
+     ('user_id', 'route_id')),
+    ('get_climbs_for_user', 'SELECT route_id, score FROM reviews WHERE user_id = ?',
+     ('user_id',)),
+    ('get_users_for_climb', 'SELECT user_id FROM reviews WHERE route_id = ?', ('route_id',)),
+    ('get_users', 'SELECT user_id, COUNT(*) AS review_count FROM reviews GROUP BY user_id '
+                  'LIMIT 1000', ()),
+    ('get_area_ids', 'SELECT id, name FROM routes WHERE area_id = 0 OR area_id IS NULL', ()),
+]
+
+
+def fill_synthetic(conn: sqlite3.Connection, review_count: int):
+    rng = random.Random(0)
+    route_count = max(review_count // 20, 1)
+    user_count = max(review_count // 10, 1)
+    # Most routes were crawled with their area
+    conn.executemany('INSERT INTO routes VALUES (?, ?, ?)',
+                     ((route_id, 'Route %d' % route_id, 0 if rng.random() < 0.01 else 1)
+                      for route_id in range(route_count)))
+    conn.executemany('INSERT OR IGNORE INTO reviews VALUES (?, ?, ?)',
+                     ((rng.randrange(route_count), rng.randrange(user_count), rng.randint(0, 4))
+                      for _ in range(review_count)))
+    conn.commit()
+
+
+def copy_tables(conn: sqlite3.Connection, source: str):
+    conn.execute('ATTACH DATABASE ? AS source', [f'file:{source}?mode=ro'])
+    for table in ('routes', 'reviews'):
+        conn.execute('INSERT INTO %s SELECT * FROM source.%s' % (table, table))
+    conn.commit()
+    conn.execute('DETACH DATABASE source')
+
+
+def measure(conn: sqlite3.Connection, samples: List[sqlite3.Row]):
+    for name, query, columns in QUERIES:
+        plan = '; '.join(row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + query,
+                                                         [0] * len(columns)))
+        latencies = []
+        for sample in samples if columns else samples[:max(len(samples) // 20, 1)]:
+            started = time.perf_counter()
+            conn.execute(query, [sample[column] for column in columns]).fetchall()
+            latencies.append(time.perf_counter() - started)
+
+        print('%-24s %10.3f ms median %10.3f ms max   %s'
+              % (name, statistics.median(latencies) * 1e3, max(latencies) * 1e3, plan))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database', nargs='?')
+    parser.add_argument('--reviews', type=int, default=DEFAULT_SYNTHETIC_REVIEWS,
+                        help='Size of the synthetic database when none is given')
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES,
+                        help='Runs of each query, with the parameters of random reviews')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        with redirect_stderr(io.StringIO()):
+            migrate(conn, 1)
+
+        started = time.perf_counter()
+        if args.database is not None:
+            copy_tables(conn, args.database)
+        else:
+            fill_synthetic(conn, args.reviews)
+        review_count = conn.execute('SELECT count(*) FROM reviews').fetchone()[0]
+        print('%d reviews, loaded in %.1fs' % (review_count, time.perf_counter() - started),
+              file=sys.stderr)
+        if review_count == 0:
+            print('ERROR: no reviews to query', file=sys.stderr)
+            exit(1)
+
+        samples = conn.execute('SELECT user_id, route_id FROM reviews ORDER BY random() LIMIT ?',
+                               [args.samples]).fetchall()
+
+        print('Before:')
+        measure(conn, samples)
+
+        started = time.perf_counter()
+        with redirect_stderr(io.StringIO()):
+            migrate(conn)
+        print('Migrated in %.1fs' % (time.perf_counter() - started), file=sys.stderr)
+
+        print('After:')
+        measure(conn, samples)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
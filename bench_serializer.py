@@ -0,0 +1,81 @@
+'''
+Compares serializer.from_jsonl() with serializer.from_jsonl_fast() on a
+scraper.py output file, or on a synthetic one shaped like a real crawl (mostly
+ticks and ratings) when no file is given.
+
+Usage:
+python3 bench_serializer.py [data.jsonl] [--lines N]
+'''
+
+import argparse
+import io
+import json
+import random
+import sys
+import time
+
+from serializer import from_jsonl, from_jsonl_fast
+
+DEFAULT_SYNTHETIC_LINES = 500_000
+
+
+def synthetic_jsonl(line_count: int) -> bytes:
+    rng = random.Random(0)
+    lines = []
+    route_id = 105_700_000
+    while len(lines) < line_count:
+        route_id += 1
+        lines.append(json.dumps({'routeId': str(route_id), 'routeName': 'Route %d' % route_id,
+                                 'areaId': 105_800_000 + route_id % 1000}))
+        for _ in range(rng.randint(0, 20)):
+            lines.append(json.dumps({'routeId': str(route_id),
+                                     'userId': rng.randint(1, 200_000_000),
+                                     'ratings': ['5.%d' % rng.randint(5, 13)]}))
+        for _ in range(rng.randint(0, 60)):
+            lines.append(json.dumps({'routeId': str(route_id),
+                                     'userId': rng.randint(1, 200_000_000),
+                                     'text': rng.choice(['', 'Sent it', 'Lead / Onsight.']),
+                                     'date': '20%02d-%02d-%02dT00:00:00' % (
+                                         rng.randint(0, 23), rng.randint(1, 12),
+                                         rng.randint(1, 28))}))
+        for _ in range(rng.randint(0, 10)):
+            lines.append(json.dumps({'route_id': str(route_id),
+                                     'user_id': rng.randint(1, 200_000_000),
+                                     'score': rng.randint(0, 4)}))
+
+    return ('\n'.join(lines[:line_count]) + '\n').encode()
+
+
+def measure(name: str, decode) -> list:
+    started = time.perf_counter()
+    entities = list(decode())
+    elapsed = time.perf_counter() - started
+    print('%-16s %8.2fs %10.0f entities/s' % (name, elapsed, len(entities) / elapsed))
+    return entities
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?')
+    parser.add_argument('--lines', type=int, default=DEFAULT_SYNTHETIC_LINES,
+                        help='Size of the synthetic input when no path is given')
+    args = parser.parse_args()
+
+    if args.path is not None:
+        with open(args.path, 'rb') as file:
+            data = file.read()
+    else:
+        data = synthetic_jsonl(args.lines)
+
+    print('%d lines, %.1f MB' % (data.count(b'\n'), len(data) / 1e6), file=sys.stderr)
+
+    expected = measure('from_jsonl', lambda: from_jsonl(io.StringIO(data.decode())))
+    actual = measure('from_jsonl_fast', lambda: from_jsonl_fast(io.BytesIO(data)))
+    if actual != expected:
+        print('ERROR: from_jsonl_fast decoded different entities', file=sys.stderr)
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+'''
+checkpoint.py
+
+Provides the Checkpoint class, which records how far a scraper.py crawl has
+progressed so that a crawl that died can be resumed instead of restarted.
+
+The checkpoint file is an append-only jsonl log. Each line records one
+finished unit of work together with the size of the output file at the moment
+that unit was fully written, for example
+
+{"areaPage": "3", "offset": 52311, "routeAreas": {"105717310": [4, 105833381]}}
+{"routeId": "105717310", "offset": 60112}
+{"routePage": 0, "offset": 9123377}
+
+On resume the output is truncated back to the last recorded offset, which
+drops any half-written route or area page, and the crawl skips every finished
+area page, route page and route. Area pages also record the route to area
+mapping they contributed to the RouteAreaIndex, so that routes crawled after a
+resume still get their area_id.
+'''
+
+import json
+import os
+import sys
+from typing import BinaryIO, Optional, Set
+
+from area_index import RouteAreaIndex
+
+
+class Checkpoint:
+    '''
+    Progress of a crawl. A Checkpoint without a path only keeps the progress
+    in memory, which lets the scraper use the same code path whether or not
+    checkpointing was requested.
+    '''
+
+    path: Optional[str]
+    area_pages: Set[str]
+    route_pages: Set[int]
+    route_ids: Set[str]
+    route_areas: RouteAreaIndex
+    offset: int
+
+    def __init__(self, path: Optional[str] = None, resume: bool = False):
+        self.path = path
+        self.area_pages = set()
+        self.route_pages = set()
+        self.route_ids = set()
+        self.route_areas = RouteAreaIndex()
+        self.offset = 0
+        self._file: Optional[BinaryIO] = None
+
+        if path is None:
+            return
+
+        if resume and os.path.exists(path):
+            self._load()
+
+        self._file = open(path, 'ab' if resume else 'wb')
+
+    def _load(self):
+        with open(self.path, 'rb') as file:
+            for line in file:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # A crash can leave a torn last line behind
+                    print('Ignoring checkpoint line %r' % line, file=sys.stderr)
+                    continue
+
+                match event:
+                    case {'areaPage': str(page), 'offset': int(offset)}:
+                        self.area_pages.add(page)
+                        self.route_areas.merge(
+                            RouteAreaIndex.from_json(event.get('routeAreas', {})))
+                    case {'routePage': int(page), 'offset': int(offset)}:
+                        self.route_pages.add(page)
+                    case {'routeId': str(route_id), 'offset': int(offset)}:
+                        self.route_ids.add(route_id)
+                    case _:
+                        print('Unexpected checkpoint event %s' % event,
+                              file=sys.stderr)
+                        continue
+
+                self.offset = max(self.offset, offset)
+
+    def _record(self, event: dict, offset: int):
+        self.offset = offset
+        if self._file is None:
+            return
+
+        event['offset'] = offset
+        self._file.write(json.dumps(event).encode() + b'\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def finish_area_page(self, page: str, offset: int,
+                         route_areas: Optional[RouteAreaIndex] = None):
+        self.area_pages.add(page)
+        event = {'areaPage': page}
+        if route_areas is not None:
+            self.route_areas.merge(route_areas)
+            event['routeAreas'] = route_areas.to_json()
+
+        self._record(event, offset)
+
+    def finish_route_page(self, page: int, offset: int):
+        self.route_pages.add(page)
+        self._record({'routePage': page}, offset)
+
+    def finish_route(self, route_id: str, offset: int):
+        self.route_ids.add(route_id)
+        self._record({'routeId': route_id}, offset)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
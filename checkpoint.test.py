@@ -0,0 +1,101 @@
+import argparse
+import io
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+
+from area_index import RouteAreaIndex
+from checkpoint import Checkpoint
+from model import Route
+from scraper import open_output
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'data.jsonl.checkpoint')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_progress(self):
+        checkpoint = Checkpoint(self.path)
+        route_areas = RouteAreaIndex()
+        route_areas.add_route_areas({'10': (2, 5)})
+        checkpoint.finish_area_page('3', 100, route_areas)
+        checkpoint.finish_route('10', 250)
+        checkpoint.finish_route_page(0, 300)
+        checkpoint.close()
+
+    def resume(self) -> Checkpoint:
+        checkpoint = Checkpoint(self.path, resume=True)
+        self.addCleanup(checkpoint.close)
+        return checkpoint
+
+    def test_round_trip(self):
+        self.write_progress()
+
+        checkpoint = self.resume()
+        self.assertSetEqual({'3'}, checkpoint.area_pages)
+        self.assertSetEqual({'10'}, checkpoint.route_ids)
+        self.assertSetEqual({0}, checkpoint.route_pages)
+        self.assertEqual(5, checkpoint.route_areas.area_id('10'))
+        self.assertEqual(300, checkpoint.offset)
+
+        # Resuming appends to the log
+        checkpoint.finish_route('11', 400)
+        checkpoint.close()
+        self.assertSetEqual({'10', '11'}, self.resume().route_ids)
+
+    def test_without_resume_starts_over(self):
+        self.write_progress()
+
+        checkpoint = Checkpoint(self.path)
+        checkpoint.close()
+        self.assertEqual(0, self.resume().offset)
+
+    def test_torn_last_line_is_ignored(self):
+        self.write_progress()
+        with open(self.path, 'ab') as file:
+            file.write(b'{"routeId": "12", "off')
+
+        with redirect_stderr(io.StringIO()):
+            checkpoint = self.resume()
+        self.assertSetEqual({'10'}, checkpoint.route_ids)
+        self.assertEqual(300, checkpoint.offset)
+
+    def test_resume_truncates_output_to_offset(self):
+        self.write_progress()
+        output_path = os.path.join(self.directory.name, 'data.jsonl')
+        with open(output_path, 'wb') as file:
+            # A half-written route after the last recorded unit
+            file.write(b'x' * 300 + b'{"routeId": "11"')
+
+        args = argparse.Namespace(database=None, output=output_path, checkpoint=None,
+                                  resume=True, compress_threads=0)
+        with redirect_stderr(io.StringIO()):
+            output = open_output(argparse.ArgumentParser(), args)
+        self.assertEqual(300, output.offset)
+        output.write_entity(Route('11', 'Route', 5))
+        output.close()
+        output.file.close()
+
+        with open(output_path, 'rb') as file:
+            self.assertEqual(b'x' * 300 + b'{"routeId": "11", "routeName": "Route", '
+                             b'"areaId": 5}\n', file.read())
+
+    def test_resume_requires_output_as_long_as_offset(self):
+        self.write_progress()
+        output_path = os.path.join(self.directory.name, 'data.jsonl')
+        with open(output_path, 'wb') as file:
+            file.write(b'x' * 10)
+
+        args = argparse.Namespace(database=None, output=output_path, checkpoint=None,
+                                  resume=True, compress_threads=0)
+        with redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            open_output(argparse.ArgumentParser(), args)
+
+
+if __name__ == '__main__':
+    unittest.main()
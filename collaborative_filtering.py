@@ -7,116 +7,198 @@ Think:
 - standardize the two approaches (knn vs collab_filtering)
   - this probably looks like building a test suite and defining a
     recommendation interface
+
+Reviews are read from the database's columnar snapshot when a fresh one
+exists (python3 snapshot.py DATABASE), and from SQLite otherwise.
+
+The user x route matrix is a sparse (CSR) matrix of the positive review
+scores over the whole reviews table, see ReviewMatrix. Similarities to every
+other user and the predicted scores of every route are sparse products, and
+the top routes are picked with a partial sort. An lsh.LSHIndex of the matrix
+finds similar users approximately instead, without comparing every user.
+
+get_recommendations() keeps the matrix of each database it was called for
+loaded until the database changes, see load_matrix(). recommendation_service.py
+also caches the results and reloads the matrix in the background.
 '''
 
-from functools import cache
+import threading
+from typing import Dict, Optional, Tuple
 
 import sqlite3
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
-
-
-def fetcher(conn):
-    @cache
-    def cached_fetcher(sql):
-        reviews_df = pd.read_sql_query(sql, conn)
-        return reviews_df.pivot_table(
-            index='user_id', 
-            columns='route_id', 
-            values='score',
-            fill_value=0
-        )
-
-    return cached_fetcher
+from scipy import sparse
+
+from lsh import LSHIndex
+from snapshot import database_stamp, open_snapshot
+
+
+class ReviewMatrix:
+    '''
+    The reviews as a users x routes CSR matrix. Row i is the user
+    user_ids[i], column j the route route_ids[j]. A user's reviews of the same
+    route are averaged, and only positive scores are stored, so a stored
+    entry always means the user rated the route.
+    '''
+
+    matrix: sparse.csr_matrix
+    user_ids: np.ndarray
+    route_ids: np.ndarray
+
+    def __init__(self, user_ids: np.ndarray, route_ids: np.ndarray, scores: np.ndarray):
+        '''
+        Build the matrix from one (user_id, route_id, score) triple per review.
+        '''
+
+        self.user_ids, users = np.unique(user_ids, return_inverse=True)
+        self.route_ids, routes = np.unique(route_ids, return_inverse=True)
+        shape = (len(self.user_ids), len(self.route_ids))
+
+        # Duplicates are summed when converting, so divide by their count
+        totals = sparse.csr_matrix((np.asarray(scores, dtype=np.float64), (users, routes)),
+                                   shape=shape)
+        counts = sparse.csr_matrix((np.ones(len(users)), (users, routes)), shape=shape)
+        totals.data /= counts.data
+        totals.data[totals.data < 0] = 0
+        totals.eliminate_zeros()
+        self.matrix = totals
+        self._norms = np.sqrt(np.asarray(self.matrix.multiply(self.matrix).sum(axis=1))
+                              ).ravel()
+
+    @staticmethod
+    def load(db_path: str) -> 'ReviewMatrix':
+        snapshot = open_snapshot(db_path)
+        if snapshot is not None:
+            reviews = snapshot.table('reviews')
+            return ReviewMatrix(reviews['user_id'], reviews['route_id'], reviews['score'])
+
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute('SELECT user_id, route_id, score FROM reviews;').fetchall()
+        finally:
+            conn.close()
+
+        columns = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        return ReviewMatrix(columns[:, 0], columns[:, 1], columns[:, 2])
+
+    def user_index(self, user_id: int) -> Optional[int]:
+        i = np.searchsorted(self.user_ids, user_id)
+        return int(i) if i < len(self.user_ids) and self.user_ids[i] == user_id else None
+
+    def similarities(self, i: int) -> np.ndarray:
+        '''
+        Cosine similarity of user i's row to every row, 0 for users who rated
+        none of the routes user i rated, and for user i itself.
+        '''
+
+        dots = (self.matrix @ self.matrix[i].T).toarray().ravel()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarities = dots / (self._norms * self._norms[i])
+        similarities[~np.isfinite(similarities)] = 0
+        similarities[i] = 0
+        return similarities
+
+    def recommend(self, user_id: int, n_recommendations: int = 300,
+                  similarity_threshold: float = 0.3,
+                  neighbour_index: Optional[LSHIndex] = None) -> pd.DataFrame:
+        '''
+        See get_recommendations(). With a neighbour_index of self.matrix, only
+        the similar users it finds are used instead of comparing every user.
+        '''
+
+        empty = pd.DataFrame(columns=['route_id', 'predicted_score'])
+        i = self.user_index(user_id)
+        if i is None:
+            return empty
+
+        if neighbour_index is None:
+            candidates, similarities = None, self.similarities(i)
+        else:
+            candidates, similarities = neighbour_index.similarities(i)
+        # Users sharing a rated route are exactly those with a positive similarity
+        neighbours = np.flatnonzero(similarities > max(similarity_threshold, 0))
+        if len(neighbours) == 0:
+            return empty
+
+        # Weighted average of the neighbours' scores, over the neighbours who
+        # rated each route
+        weights = similarities[neighbours]
+        if candidates is not None:
+            neighbours = candidates[neighbours]
+        ratings = self.matrix[neighbours]
+        weighted_sums = ratings.T @ weights
+        rated = ratings.copy()
+        rated.data[:] = 1
+        weight_sums = rated.T @ weights
+
+        weight_sums[self.matrix[i].indices] = 0
+        candidates = np.flatnonzero(weight_sums > 0)
+        if len(candidates) == 0:
+            return empty
+
+        predictions = weighted_sums[candidates] / weight_sums[candidates]
+        if len(candidates) > n_recommendations:
+            top = np.argpartition(-predictions, n_recommendations - 1)[:n_recommendations]
+            candidates, predictions = candidates[top], predictions[top]
+        order = np.argsort(-predictions, kind='stable')
+
+        return pd.DataFrame({
+            'route_id': self.route_ids[candidates[order]],
+            'predicted_score': predictions[order],
+        })
+
+
+def read_user_reviews(db_path: str, user_id: int) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Return the routes a user gave a positive score, and those scores, from
+    SQLite (through the reviews_by_user index).
+    '''
+
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        rows = conn.execute('SELECT route_id, score FROM reviews WHERE user_id = ? AND score > 0;',
+                            [user_id]).fetchall()
+    finally:
+        conn.close()
+
+    reviews = np.array(rows, dtype=np.int64).reshape(-1, 2)
+    return reviews[:, 0], reviews[:, 1]
+
+
+# The matrix last loaded per database, with the database_stamp() it was loaded at
+_loaded_matrices: Dict[str, Tuple[dict, ReviewMatrix]] = {}
+_loaded_matrices_lock = threading.Lock()
+
+
+def load_matrix(db_path: str) -> ReviewMatrix:
+    '''
+    Return the ReviewMatrix of db_path, loading it only if the database
+    changed since the last call for it.
+    '''
+
+    # Stamped before loading, so that a commit during the load is seen next time
+    stamp = database_stamp(db_path)
+    with _loaded_matrices_lock:
+        loaded = _loaded_matrices.get(db_path)
+    if loaded is not None and loaded[0] == stamp:
+        return loaded[1]
+
+    reviews = ReviewMatrix.load(db_path)
+    with _loaded_matrices_lock:
+        _loaded_matrices[db_path] = (stamp, reviews)
+    return reviews
 
 
 def get_recommendations(user_id, db_path, n_recommendations=300, similarity_threshold=0.3):
-    # Connect to database
-    conn = sqlite3.connect(db_path)
-
-    # fetch = fetcher(conn)
-
-    # Load reviews data
-    query = 'SELECT user_id, route_id, score FROM reviews LIMIT 50000;'
-
-#     query = '''SELECT neighbor.route_id, neighbor.user_id, neighbor.score FROM reviews user
-# JOIN reviews neighbor
-# ON user.route_id = neighbor.route_id
-# WHERE user.user_id = 112156524
-# LIMIT 5000;'''
-    reviews_df = pd.read_sql_query(query, conn)
-
-    # Create a user-item matrix
-    user_route_matrix = reviews_df.pivot_table(
-        index='user_id', 
-        columns='route_id', 
-        values='score',
-        fill_value=0
-    )
-
-    # user_route_matrix = fetch(query)
-
-    # Get the target user's ratings
-    if user_id not in user_route_matrix.index:
-        return pd.DataFrame(columns=['route_id', 'predicted_score'])
-
-    # Calculate cosine similarity between the target user and all other users
-    similarities = {}
-    target_user_ratings = user_route_matrix.loc[user_id].values.reshape(1, -1)
-
-    for other_user in user_route_matrix.index:
-        if other_user == user_id:
-            continue
-
-        other_user_ratings = user_route_matrix.loc[other_user].values.reshape(1, -1)
-
-        # Skip users with no common rated items
-        if np.sum(np.logical_and(target_user_ratings > 0, other_user_ratings > 0)) == 0:
-            continue
-
-        sim = cosine_similarity(target_user_ratings, other_user_ratings)[0][0]
-        if not np.isnan(sim) and sim > similarity_threshold:
-            similarities[other_user] = sim
-
-    # If no similar users found, return empty recommendations
-    if not similarities:
-        return pd.DataFrame(columns=['route_id', 'predicted_score'])
-
-    # Get routes that similar users have rated but target user hasn't
-    target_user_routes = set(user_route_matrix.columns[user_route_matrix.loc[user_id] > 0])
-
-    # Calculate predicted scores for unrated routes
-    predictions = {}
-
-    for route in user_route_matrix.columns:
-        if route in target_user_routes:
-            continue  # Skip routes the user has already rated
-
-        # Weighted average of similar users' ratings
-        weighted_sum = 0
-        sim_sum = 0
-
-        for other_user, similarity in similarities.items():
-            if user_route_matrix.loc[other_user, route] > 0:  # If the similar user rated this route
-                weighted_sum += similarity * user_route_matrix.loc[other_user, route]
-                sim_sum += similarity
-
-        if sim_sum > 0:
-            predictions[route] = weighted_sum / sim_sum
-
-    # Create dataframe with predictions
-    recommendations = pd.DataFrame({
-        'route_id': list(predictions.keys()),
-        'predicted_score': list(predictions.values())
-    })
-
-    # Sort by predicted score and return top n recommendations
-    recommendations = recommendations.sort_values('predicted_score', ascending=False).head(n_recommendations)
-
-    conn.close()
-
-    return recommendations
+    '''
+    Predict the scores user_id would give the routes they have not rated, as
+    the average of the scores of the users whose cosine similarity to them is
+    over similarity_threshold, weighted by that similarity. Return the
+    n_recommendations best routes with their predicted_score, best first.
+    '''
+
+    return load_matrix(db_path).recommend(user_id, n_recommendations, similarity_threshold)
 
 
 def get_recommendations_to_list(user_id, db_path):
@@ -0,0 +1,91 @@
+import io
+import math
+import os
+import sqlite3
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+
+from collaborative_filtering import ReviewMatrix, get_recommendations, load_matrix
+from schema import TABLES
+from snapshot import export_snapshot
+
+# (route_id, user_id, score). User 1 rated routes 10 and 11. User 2 agrees
+# with them on 10 and rated 12 and 13; user 3 only shares route 11 and rated
+# 12; user 4 shares nothing.
+REVIEWS = [
+    (10, 1, 4), (11, 1, 2),
+    (10, 2, 4), (12, 2, 3), (13, 2, 1),
+    (11, 3, 4), (12, 3, 1), (12, 3, 3),
+    (14, 4, 4),
+    # A score of 0 does not count as rating the route
+    (14, 1, 0),
+]
+
+
+class RecommendationsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, 'test.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(TABLES)
+        conn.executemany('INSERT INTO reviews VALUES (?, ?, ?)', REVIEWS)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_weighted_average_of_similar_users(self):
+        # User 3's two reviews of route 12 average to 2
+        similarity_2 = 16 / (math.sqrt(20) * math.sqrt(26))
+        similarity_3 = 8 / (math.sqrt(20) * math.sqrt(20))
+        expected = {
+            12: (similarity_2 * 3 + similarity_3 * 2) / (similarity_2 + similarity_3),
+            13: 1.0,
+        }
+
+        recommendations = get_recommendations(1, self.db_path)
+        self.assertListEqual([12, 13], recommendations['route_id'].tolist())
+        for route_id, score in zip(recommendations['route_id'],
+                                   recommendations['predicted_score']):
+            self.assertAlmostEqual(expected[route_id], score)
+
+    def test_threshold_and_limit(self):
+        # Only user 2 is similar enough
+        recommendations = get_recommendations(1, self.db_path, similarity_threshold=0.5)
+        self.assertListEqual([12, 13], recommendations['route_id'].tolist())
+        self.assertAlmostEqual(3.0, recommendations['predicted_score'].iloc[0])
+
+        self.assertListEqual([12], get_recommendations(1, self.db_path, 1)['route_id'].tolist())
+        self.assertTrue(get_recommendations(1, self.db_path, similarity_threshold=0.99).empty)
+        self.assertTrue(get_recommendations(4, self.db_path).empty)
+        self.assertTrue(get_recommendations(99, self.db_path).empty)
+
+    def test_matrix_loaded_until_the_database_changes(self):
+        reviews = load_matrix(self.db_path)
+        self.assertIs(reviews, load_matrix(self.db_path))
+
+        # User 5 agrees with user 1 and rated route 15
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany('INSERT INTO reviews VALUES (?, ?, ?)',
+                         [(10, 5, 4), (11, 5, 2), (15, 5, 4)])
+        conn.commit()
+        conn.close()
+
+        self.assertIsNot(reviews, load_matrix(self.db_path))
+        self.assertEqual(15, get_recommendations(1, self.db_path)['route_id'].iloc[0])
+
+    def test_snapshot_matches_sqlite(self):
+        expected = ReviewMatrix.load(self.db_path)
+        with redirect_stderr(io.StringIO()):
+            export_snapshot(self.db_path)
+        actual = ReviewMatrix.load(self.db_path)
+
+        self.assertListEqual(expected.user_ids.tolist(), actual.user_ids.tolist())
+        self.assertListEqual(expected.route_ids.tolist(), actual.route_ids.tolist())
+        self.assertEqual(0, (expected.matrix != actual.matrix).nnz)
+
+
+if __name__ == '__main__':
+    unittest.main()
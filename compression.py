@@ -0,0 +1,401 @@
+'''
+compression.py
+
+Reads and writes bz2, gzip and xz files on several threads, the format being
+chosen by the file extension. The compression libraries release the GIL, so
+threads are enough to use every core.
+
+CompressedWriter compresses blocks of about block_size bytes in parallel,
+each as a complete stream of its own. Concatenated streams are a valid file
+for bzcat, zcat and xzcat, and for Python's bz2, gzip and lzma modules. A
+writer can be told to only end streams at marks, so that the file can be
+truncated back to a mark, which is what scraper.py checkpoints rely on.
+
+ParallelBZ2Reader decompresses a bz2 file block by block on a thread pool.
+bzip2 blocks start with a 48-bit magic number at any bit offset, and each is
+compressed independently, so a block can be cut out of the file, shifted to a
+byte boundary and decompressed as a single-block stream of its own. This works
+for files written by bzip2 itself as well as for multi-stream files. A block
+magic can in principle also occur inside compressed data; a block that fails
+to decompress is therefore retried with its following block appended.
+
+gzip and xz files are decompressed on one thread, as their streams cannot be
+split without decompressing them.
+
+Usage, decompressing to stdout like bzcat:
+python3 compression.py data.jsonl.bz2 [--threads N]
+'''
+
+import argparse
+import bz2
+import gzip
+import io
+import lzma
+import mmap
+import os
+import shutil
+import sys
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Callable, Deque, Dict, List, Optional, Tuple
+
+COMPRESSION_BY_EXTENSION = {
+    '.bz2': 'bz2',
+    '.gz': 'gzip',
+    '.xz': 'xz',
+}
+
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {
+    'bz2': lambda data: bz2.compress(data, 9),
+    'gzip': lambda data: gzip.compress(data, 6, mtime=0),
+    'xz': lambda data: lzma.compress(data, preset=6),
+}
+
+# Uncompressed bytes per stream. bz2 compresses 900kB blocks at level 9
+# regardless, so one block per stream costs nothing and keeps reads parallel.
+# gzip and xz compress better over longer inputs.
+DEFAULT_BLOCK_SIZES = {
+    'bz2': 800_000,
+    'gzip': 4 * 1024 * 1024,
+    'xz': 8 * 1024 * 1024,
+}
+
+BZ2_BLOCK_MAGIC = 0x314159265359
+BZ2_END_MAGIC = 0x177245385090
+# File bytes searched for bz2 block boundaries at a time
+BZ2_SCAN_BYTES = 16 * 1024 * 1024
+# Blocks appended to one that fails to decompress before giving up
+BZ2_MAX_MERGED_BLOCKS = 3
+
+
+def compression_of(path: str) -> Optional[str]:
+    '''
+    Return the compression the extension of path calls for, or None.
+    '''
+
+    return COMPRESSION_BY_EXTENSION.get(os.path.splitext(path)[1].lower())
+
+
+class CompressedWriter(io.RawIOBase):
+    '''
+    Compresses what is written to file in blocks, on threads threads (all
+    cores by default). Up to two blocks per thread are compressed ahead of the
+    one being written.
+
+    If cut_at_marks is set, a block only ends at a call to mark(), once at
+    least block_size bytes are buffered. Every block written to file is
+    recorded as (uncompressed end offset, file end offset), see
+    written_blocks().
+    '''
+
+    file: BinaryIO
+    offset: int
+    compressed_offset: int
+
+    def __init__(self, file: BinaryIO, compression: str, threads: Optional[int] = None,
+                 block_size: Optional[int] = None, cut_at_marks: bool = False,
+                 compressed_offset: int = 0):
+        super().__init__()
+        self.file = file
+        self.offset = 0
+        self.compressed_offset = compressed_offset
+        self._compress = COMPRESSORS[compression]
+        self._block_size = block_size or DEFAULT_BLOCK_SIZES[compression]
+        self._cut_at_marks = cut_at_marks
+        self._threads = threads or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(self._threads)
+        self._buffer = bytearray()
+        self._pending: Deque[Tuple[Future, int]] = deque()
+        self._written: List[Tuple[int, int]] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        self.offset += len(data)
+        if not self._cut_at_marks and len(self._buffer) >= self._block_size:
+            self._submit()
+
+        return len(data)
+
+    def mark(self):
+        '''
+        Allow a block to end here.
+        '''
+
+        if len(self._buffer) >= self._block_size:
+            self._submit()
+
+    def _submit(self):
+        if not self._buffer:
+            return
+
+        self._pending.append((self._executor.submit(self._compress, bytes(self._buffer)),
+                              self.offset))
+        self._buffer.clear()
+        self._drain(wait=len(self._pending) > 2 * self._threads)
+
+    def _drain(self, wait: bool):
+        while self._pending and (wait or self._pending[0][0].done()):
+            future, end = self._pending.popleft()
+            compressed = future.result()
+            self.file.write(compressed)
+            self.compressed_offset += len(compressed)
+            self._written.append((end, self.compressed_offset))
+            wait = False
+
+    def written_blocks(self) -> List[Tuple[int, int]]:
+        '''
+        Return the blocks written to file since the last call, oldest first.
+        '''
+
+        written = self._written
+        self._written = []
+        return written
+
+    def flush(self):
+        # Only what is already compressed; buffered bytes stay in the block
+        if not self.closed:
+            self._drain(wait=False)
+            self.file.flush()
+
+    def finish(self):
+        '''
+        Compress and write everything written so far, ending the block.
+        '''
+
+        self._submit()
+        while self._pending:
+            self._drain(wait=True)
+        self.file.flush()
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            self.finish()
+        finally:
+            self._executor.shutdown()
+            # super().close() flushes, so the file goes last
+            super().close()
+            self.file.close()
+
+
+def _bits(data, start: int, length: int) -> int:
+    '''
+    Return length bits of data from bit offset start, as an integer.
+    '''
+
+    first = start // 8
+    last = (start + length + 7) // 8
+    value = int.from_bytes(data[first:last], 'big')
+    return (value >> (last * 8 - start - length)) & ((1 << length) - 1)
+
+
+def _magic_needles(magic: int) -> List[Tuple[int, bytes]]:
+    # At bit shift s within its first byte, the 48-bit magic fully covers the
+    # 5 bytes after that one, whatever s is
+    return [(shift, (magic << (8 - shift)).to_bytes(7, 'big')[1:6]) for shift in range(8)]
+
+
+_BZ2_NEEDLES = [(magic, _magic_needles(magic)) for magic in (BZ2_BLOCK_MAGIC, BZ2_END_MAGIC)]
+
+
+def bz2_markers(data, start: int, end: int) -> List[Tuple[int, bool]]:
+    '''
+    Return the bit offset of every block magic (True) and end of stream magic
+    (False) starting in bytes [start, end) of data, in order.
+    '''
+
+    markers = []
+    search_end = min(end + 8, len(data))
+    for magic, needles in _BZ2_NEEDLES:
+        for shift, needle in needles:
+            position = data.find(needle, start, search_end)
+            while position >= 0:
+                bit = (position - 1) * 8 + shift
+                if (start * 8 <= bit < end * 8 and bit + 48 <= len(data) * 8
+                        and _bits(data, bit, 48) == magic):
+                    markers.append((bit, magic == BZ2_BLOCK_MAGIC))
+                position = data.find(needle, position + 1, search_end)
+
+    return sorted(markers)
+
+
+def decompress_bz2_block(data, start: int, end: int) -> bytes:
+    '''
+    Decompress the bz2 block from bit offset start, where its magic is, to
+    bit offset end, where the next block or the end of stream magic is.
+    '''
+
+    length = end - start
+    # A single-block stream's CRC is the block's, which follows the magic
+    crc = _bits(data, start + 48, 32)
+    value = (_bits(data, start, length) << 80) | (BZ2_END_MAGIC << 32) | crc
+    padding = -(length + 80) % 8
+    stream = b'BZh9' + (value << padding).to_bytes((length + 80 + padding) // 8, 'big')
+    return bz2.decompress(stream)
+
+
+class ParallelBZ2Reader(io.RawIOBase):
+    '''
+    Reads the decompressed contents of the bz2 file at path, decompressing up
+    to two blocks per thread ahead of the reader on threads threads (all cores
+    by default). See the module docstring.
+    '''
+
+    def __init__(self, path: str, threads: Optional[int] = None):
+        super().__init__()
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._data = (mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                      if size > 0
+                      else b'')
+        self._threads = threads or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(self._threads)
+        self._markers: List[Tuple[int, bool]] = []
+        self._scanned = 0
+        self._blocks = self._decompressed_blocks()
+        self._chunk = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def _marker(self, i: int) -> Optional[Tuple[int, bool]]:
+        while i >= len(self._markers) and self._scanned < len(self._data):
+            end = min(self._scanned + BZ2_SCAN_BYTES, len(self._data))
+            self._markers.extend(bz2_markers(self._data, self._scanned, end))
+            self._scanned = end
+
+        return self._markers[i] if i < len(self._markers) else None
+
+    def _block_bits(self, i: int, blocks: int) -> Tuple[int, int]:
+        # Markers are only scanned on the reading thread
+        end = self._marker(i + blocks)
+        if end is None:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+        return self._markers[i][0], end[0]
+
+    def _decompressed_blocks(self):
+        pending: Deque[Tuple[int, Future]] = deque()
+        i = 0
+        # Markers before next_i are inside a block that needed merging
+        next_i = 0
+        while True:
+            while len(pending) < 2 * self._threads and self._marker(i) is not None:
+                if self._markers[i][1]:
+                    try:
+                        start, end = self._block_bits(i, 1)
+                        future = self._executor.submit(decompress_bz2_block, self._data,
+                                                       start, end)
+                    except EOFError as e:
+                        future = Future()
+                        future.set_exception(e)
+                    pending.append((i, future))
+                i += 1
+
+            if not pending:
+                return
+
+            block_i, future = pending.popleft()
+            if block_i < next_i:
+                future.cancel()
+                continue
+
+            try:
+                yield future.result()
+                next_i = block_i + 1
+                continue
+            except (OSError, EOFError, ValueError) as e:
+                error = e
+
+            for blocks in range(2, BZ2_MAX_MERGED_BLOCKS + 2):
+                try:
+                    yield decompress_bz2_block(self._data, *self._block_bits(block_i, blocks))
+                    next_i = block_i + blocks
+                    break
+                except (OSError, EOFError, ValueError):
+                    pass
+            else:
+                raise error
+
+    def readinto(self, buffer) -> int:
+        while not self._chunk:
+            chunk = next(self._blocks, None)
+            if chunk is None:
+                return 0
+
+            self._chunk = memoryview(chunk)
+
+        length = min(len(buffer), len(self._chunk))
+        buffer[:length] = self._chunk[:length]
+        self._chunk = self._chunk[length:]
+        return length
+
+    def close(self):
+        if self.closed:
+            return
+
+        self._blocks.close()
+        self._executor.shutdown(cancel_futures=True)
+        self._chunk = memoryview(b'')
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+        super().close()
+
+
+def open_input(path: str, threads: Optional[int] = None) -> BinaryIO:
+    '''
+    Open path for reading in binary mode, decompressing it according to its
+    extension. bz2 files are decompressed on threads threads (all cores by
+    default), the others on one.
+    '''
+
+    match compression_of(path):
+        case 'bz2' if threads != 1:
+            return io.BufferedReader(ParallelBZ2Reader(path, threads), 1024 * 1024)
+        case 'bz2':
+            return bz2.open(path, 'rb')
+        case 'gzip':
+            return gzip.open(path, 'rb')
+        case 'xz':
+            return lzma.open(path, 'rb')
+
+    return open(path, 'rb')
+
+
+def open_output(path: str, threads: Optional[int] = None, append: bool = False) -> BinaryIO:
+    '''
+    Open path for writing in binary mode, compressing it on threads threads
+    (all cores by default) according to its extension.
+    '''
+
+    file = open(path, 'ab' if append else 'wb')
+    compression = compression_of(path)
+    if compression is None:
+        return file
+
+    return CompressedWriter(file, compression, threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Threads decompressing bz2 input, defaults to the number of cores')
+    args = parser.parse_args()
+
+    with open_input(args.path, args.threads) as file:
+        shutil.copyfileobj(file, sys.stdout.buffer, 1024 * 1024)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import bz2
+import gzip
+import lzma
+import os
+import random
+import tempfile
+import unittest
+
+import compression
+from compression import CompressedWriter, open_input, open_output
+
+# Several bz2 blocks at level 1, with the block boundaries at varying bit offsets
+random.seed(0)
+DATA = b''.join(b'{"routeId": "%d", "userId": %d, "score": %d}\n'
+                % (random.randrange(10 ** 9), random.randrange(10 ** 9), random.randrange(5))
+                for _ in range(20_000))
+
+
+class CompressionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def write(self, name, data):
+        with open(self.path(name), 'wb') as file:
+            file.write(data)
+        return self.path(name)
+
+    def test_bz2_blocks_in_parallel(self):
+        path = self.write('single.jsonl.bz2', bz2.compress(DATA, 1) + bz2.compress(b'tail\n'))
+        with open_input(path, 3) as file:
+            self.assertEqual(DATA + b'tail\n', file.read())
+
+    def test_bz2_empty(self):
+        with open_input(self.write('empty.bz2', bz2.compress(b'')), 2) as file:
+            self.assertEqual(b'', file.read())
+        with open_input(self.write('zero.bz2', b''), 2) as file:
+            self.assertEqual(b'', file.read())
+
+    def test_bz2_truncated(self):
+        path = self.write('truncated.bz2', bz2.compress(DATA, 1)[:100_000])
+        with self.assertRaises(EOFError):
+            with open_input(path, 2) as file:
+                file.read()
+
+    def test_bz2_false_block_magic(self):
+        # Pretend the magic also occurs inside the first block's data
+        bz2_markers = compression.bz2_markers
+
+        def with_false_markers(data, start, end):
+            markers = bz2_markers(data, start, end)
+            if start == 0:
+                markers += [(markers[0][0] + 1000, True), (markers[0][0] + 2000, False)]
+            return sorted(markers)
+
+        path = self.write('data.bz2', bz2.compress(DATA, 1))
+        compression.bz2_markers = with_false_markers
+        try:
+            with open_input(path, 2) as file:
+                self.assertEqual(DATA, file.read())
+        finally:
+            compression.bz2_markers = bz2_markers
+
+    def test_round_trip(self):
+        for name, decompress in (('data.bz2', bz2.decompress), ('data.gz', gzip.decompress),
+                                 ('data.xz', lzma.decompress), ('data.jsonl', bytes)):
+            with open_output(self.path(name), 2) as file:
+                for start in range(0, len(DATA), 1000):
+                    file.write(DATA[start:start + 1000])
+
+            with open(self.path(name), 'rb') as file:
+                self.assertEqual(DATA, decompress(file.read()), name)
+            with open_input(self.path(name)) as file:
+                self.assertEqual(DATA, file.read(), name)
+
+    def test_blocks_end_at_marks(self):
+        with open(self.path('marked.bz2'), 'wb') as file:
+            writer = CompressedWriter(file, 'bz2', 2, block_size=100, cut_at_marks=True)
+            writer.write(b'a' * 150)
+            writer.write(b'b' * 150)
+            writer.mark()
+            writer.write(b'c' * 10)
+            writer.mark()
+            writer.finish()
+            blocks = writer.written_blocks()
+            writer.close()
+
+        self.assertEqual([300, 310], [end for end, _ in blocks])
+        with open(self.path('marked.bz2'), 'rb') as file:
+            first_stream = file.read(blocks[0][1])
+        self.assertEqual(b'a' * 150 + b'b' * 150, bz2.decompress(first_stream))
+
+
+if __name__ == '__main__':
+    unittest.main()
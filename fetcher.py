@@ -10,10 +10,19 @@ import json
 import re
 import requests
 import sys
-from datetime import datetime
-from typing import Generator, List
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Generator, List, Optional, Tuple
 
-from model import Area, Route, RouteRating, RouteReview, RouteTick
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from http_cache import CacheMiss, ResponseCache
+from metrics import REGISTRY
+from model import Area, Page, Route, RouteRating, RouteReview, RouteTick
+from scheduler import THROTTLE_STATUSES, AdaptiveLimiter, RequestScheduler
 
 # Constants related to themountainproject's API
 MTN_PROJECT_API = 'https://www.mountainproject.com/api/v2'
@@ -21,14 +30,309 @@ MTN_PROJECT_ROOT = 'https://www.mountainproject.com'
 PAGE_SIZE = 250
 
 # Constants related to how text is formatted in the API responses
+AREA_ROUTE_LINK_PATTERN = re.compile(r'href="(?:https://www.mountainproject.com)?/route/(\d+)/')
 AREA_HIERARCHY_PATTERN = re.compile(r'<script type="application/ld\+json">(.+?)</script>', re.DOTALL)
 GENERIC_SITEMAP_URL_PATTERN = re.compile(r'<loc>(.*?)</loc>')
 GPS_PATTERN = re.compile(r'<td>GPS:</td>\s*<td>\s*(-?\d+\.\d+), (-?\d+\.\d+)')
 SITEMAP_AREA_PATTERN = re.compile(r'https://www.mountainproject.com/area/(\d+)/([^/<]+)')
-SITEMAP_ROUTE_PATTERN = re.compile(r'<loc>https://www.mountainproject.com/route/(\d+)/([^/]+)</loc>')
+SITEMAP_ENTRY_PATTERN = re.compile(r'<(url|sitemap)>(.*?)</\1>', re.DOTALL)
+SITEMAP_LASTMOD_PATTERN = re.compile(r'<lastmod>(.*?)</lastmod>')
+SITEMAP_ROUTE_PATTERN = re.compile(r'https://www.mountainproject.com/route/(\d+)/([^/<]+)')
 SITEMAP_AREA_PAGE_PATTERN = re.compile(r'https://www.mountainproject.com/sitemap-areas-(\d+).xml')
 TICK_DATE_FORMAT = '%b %d, %Y, %I:%M %p'
 
+# Constants related to the shared HTTP session, see configure_session()
+DEFAULT_POOL_SIZE = 16
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_TIMEOUT_SECONDS = 30
+RETRY_STATUSES = (500, 502, 504)
+
+# Upper bounds for the request scheduler, see make_scheduler()
+DEFAULT_API_MAX_RATE = 20.0
+DEFAULT_HTML_MAX_RATE = 5.0
+DEFAULT_API_MAX_CONCURRENCY = 32
+DEFAULT_HTML_MAX_CONCURRENCY = 8
+
+_cache: Optional[ResponseCache] = None
+_scheduler: Optional[RequestScheduler] = None
+_retries = DEFAULT_RETRIES
+_backoff_factor = DEFAULT_BACKOFF_FACTOR
+_adapter: Optional[HTTPAdapter] = None
+_adapter_lock = threading.Lock()
+# Held while get_session() configures the default session
+_default_session_lock = threading.Lock()
+_thread_state = threading.local()
+_failed_runs = 0
+_failed_runs_lock = threading.Lock()
+
+
+def configure_session(pool_size: int = DEFAULT_POOL_SIZE,
+                      retries: int = DEFAULT_RETRIES,
+                      backoff_factor: float = DEFAULT_BACKOFF_FACTOR) -> None:
+    '''
+    (Re)create the connection pool shared by every fetch in this process.
+
+    pool_size is the maximum number of keep-alive connections kept per host;
+    threads that need a connection while all of them are busy wait for one.
+    Connection errors, read timeouts and 5xx responses are retried up to
+    retries times, sleeping backoff_factor * 2^n seconds between attempts.
+    Throttling responses (429 and 503) are retried by get_text() instead, so
+    that the request scheduler sees them and slows down.
+    '''
+
+    global _adapter, _retries, _backoff_factor
+
+    _retries = retries
+    _backoff_factor = backoff_factor
+
+    retry = Retry(total=retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUSES,
+                  respect_retry_after_header=False,
+                  allowed_methods=frozenset(['GET']),
+                  raise_on_status=False)
+
+    with _adapter_lock:
+        _adapter = HTTPAdapter(pool_maxsize=pool_size,
+                               pool_block=True,
+                               max_retries=retry)
+
+
+def get_session() -> requests.Session:
+    '''
+    Return this thread's session. requests.Session keeps cookie state that is
+    not safe to share between threads, so each thread gets its own session,
+    but all of them are mounted on the same adapter and therefore share one
+    thread-safe urllib3 connection pool.
+    '''
+
+    if _adapter is None:
+        with _default_session_lock:
+            if _adapter is None:
+                configure_session()
+
+    adapter = _adapter
+    session = getattr(_thread_state, 'session', None)
+    if session is None or _thread_state.adapter is not adapter:
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _thread_state.session = session
+        _thread_state.adapter = adapter
+
+    return session
+
+
+def configure_cache(cache: Optional[ResponseCache]) -> None:
+    '''
+    Serve get_text() through an on-disk response cache, or stop doing so when
+    cache is None.
+    '''
+
+    global _cache
+    _cache = cache
+
+
+def configure_scheduler(scheduler: Optional[RequestScheduler]) -> None:
+    '''
+    Pace get_text() requests with an adaptive scheduler, or send them as soon
+    as they are made when scheduler is None.
+    '''
+
+    global _scheduler
+    _scheduler = scheduler
+
+
+def make_scheduler(api_max_rate: float = DEFAULT_API_MAX_RATE,
+                   html_max_rate: float = DEFAULT_HTML_MAX_RATE,
+                   api_max_concurrency: int = DEFAULT_API_MAX_CONCURRENCY,
+                   html_max_concurrency: int = DEFAULT_HTML_MAX_CONCURRENCY
+                   ) -> RequestScheduler:
+    '''
+    Build a scheduler with separate limits for the /api/v2 endpoints and for
+    HTML and sitemap pages. Rates are in requests per second; each limiter
+    starts low and ramps up to its maximum while latency stays flat.
+    '''
+
+    return RequestScheduler(
+        MTN_PROJECT_API,
+        AdaptiveLimiter('api', api_max_rate, api_max_concurrency),
+        AdaptiveLimiter('html', html_max_rate, html_max_concurrency))
+
+
+def endpoint_of(url: str) -> str:
+    '''
+    The endpoint type of a URL, used to label metrics.
+    '''
+
+    if url.startswith(MTN_PROJECT_API):
+        for suffix, endpoint in (('/ratings', 'ratings'), ('/ticks', 'ticks'),
+                                 ('/stars', 'reviews')):
+            if suffix + '?' in url:
+                return endpoint
+        return 'api'
+
+    if '/sitemap' in url:
+        return 'sitemap'
+    if '/area/' in url:
+        return 'area'
+    if '/route/' in url:
+        return 'route'
+
+    return 'other'
+
+
+def _timed_get(url: str, headers: Optional[Dict[str, str]]) -> requests.Response:
+    endpoint = endpoint_of(url)
+    started = time.monotonic()
+    try:
+        response = get_session().get(url, headers=headers,
+                                     timeout=DEFAULT_TIMEOUT_SECONDS)
+    except Exception as e:
+        REGISTRY.inc('mp_http_errors_total',
+                     {'endpoint': endpoint, 'status': type(e).__name__})
+        raise
+
+    REGISTRY.observe('mp_http_request_seconds', time.monotonic() - started,
+                     {'endpoint': endpoint})
+    REGISTRY.inc('mp_http_requests_total',
+                 {'endpoint': endpoint, 'status': response.status_code})
+    REGISTRY.inc('mp_http_response_bytes_total', {'endpoint': endpoint},
+                 len(response.content))
+    if response.status_code >= 400:
+        REGISTRY.inc('mp_http_errors_total',
+                     {'endpoint': endpoint, 'status': response.status_code})
+
+    return response
+
+
+def _send(url: str, headers: Optional[Dict[str, str]]) -> requests.Response:
+    if _scheduler is None:
+        return _timed_get(url, headers)
+
+    with _scheduler.limiter_for(url).slot() as slot:
+        response = _timed_get(url, headers)
+        slot.status = response.status_code
+        return response
+
+
+def _throttle_delay(response: requests.Response, attempt: int) -> float:
+    retry_after = response.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        return float(retry_after)
+
+    return _backoff_factor * 2 ** attempt
+
+
+def get_text(url: str) -> str:
+    '''
+    GET url through the shared session and return the body, raising
+    requests.HTTPError if the final attempt did not succeed. Requests are
+    paced by the scheduler, if one is configured.
+
+    When a cache is configured, a cached copy turns the request into a
+    conditional one and a 304 response is answered from the cache. In offline
+    mode the network is never used and uncached URLs raise CacheMiss.
+    '''
+
+    cached = _cache.lookup(url) if _cache is not None else None
+
+    if _cache is not None and _cache.offline:
+        if cached is None:
+            raise CacheMiss(url)
+
+        REGISTRY.inc('mp_cache_hits_total', {'endpoint': endpoint_of(url)})
+        return cached.text
+
+    headers = cached.conditional_headers() if cached is not None else None
+    response = _send(url, headers)
+    for attempt in range(_retries):
+        if response.status_code not in THROTTLE_STATUSES:
+            break
+
+        time.sleep(_throttle_delay(response, attempt))
+        response = _send(url, headers)
+
+    if response.status_code == 304 and cached is not None:
+        REGISTRY.inc('mp_cache_hits_total', {'endpoint': endpoint_of(url)})
+        return cached.text
+
+    response.raise_for_status()
+
+    if _cache is not None:
+        _cache.store(url, response.text, response.headers.get('ETag'),
+                     response.headers.get('Last-Modified'))
+
+    return response.text
+
+
+@dataclass
+class SitemapEntry:
+    url: str
+    lastmod: Optional[datetime]
+    '''
+    Timezone-aware time the page was last modified, or None if the sitemap
+    does not say.
+    '''
+
+
+def parse_lastmod(text: str) -> Optional[datetime]:
+    try:
+        parsed = datetime.fromisoformat(text.strip())
+    except ValueError:
+        return None
+
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+
+
+def parse_sitemap(xml: str) -> List[SitemapEntry]:
+    '''
+    Return the <url> or <sitemap> entries of a sitemap with their <lastmod>.
+    '''
+
+    entries = []
+    for _, body in SITEMAP_ENTRY_PATTERN.findall(xml):
+        loc = GENERIC_SITEMAP_URL_PATTERN.search(body)
+        if loc is None:
+            continue
+
+        lastmod = SITEMAP_LASTMOD_PATTERN.search(body)
+        entries.append(SitemapEntry(loc.group(1).strip(),
+                                    parse_lastmod(lastmod.group(1))
+                                    if lastmod is not None
+                                    else None))
+
+    if len(entries) == 0:
+        # Not wrapped in <url> elements, fall back to the bare <loc> list
+        entries = [SitemapEntry(url, None)
+                   for url in GENERIC_SITEMAP_URL_PATTERN.findall(xml)]
+
+    return entries
+
+
+def area_sitemap_url(i) -> str:
+    return '{}/sitemap-areas-{}.xml'.format(MTN_PROJECT_ROOT, i)
+
+
+def route_sitemap_url(i) -> str:
+    return '{}/sitemap-routes-{}.xml'.format(MTN_PROJECT_ROOT, i)
+
+
+def _count_failed_run():
+    global _failed_runs
+    with _failed_runs_lock:
+        _failed_runs += 1
+
+
+def failed_runs() -> int:
+    '''
+    The number of safe_run() calls so far, on any thread, that swallowed an
+    error.
+    '''
+
+    return _failed_runs
+
 
 def safe_run(callable):
     try:
@@ -36,25 +340,41 @@ def safe_run(callable):
     except KeyboardInterrupt as e:
         raise e
     except Exception as e:
+        _count_failed_run()
         print(e, file=sys.stderr)
     except:
-        pass
+        _count_failed_run()
 
     return None
 
 
+def to_page(i: int, data, result: List) -> Page:
+    '''
+    Wrap the parsed results of the ith page of an API response, marking
+    whether it is the last page so that accumulators can stop early.
+    '''
+
+    page = Page(result)
+
+    match data:
+        case {'total': int(total)}:
+            page.page_count = -(-total // PAGE_SIZE)
+
+    page.is_last = (len(data['data']) < PAGE_SIZE
+                    or (page.page_count is not None and i + 1 >= page.page_count))
+
+    return page
+
+
 def fetch_ratings(i: int, route_id: int) -> List[RouteRating]:
     '''
     Fetch the ith page of user suggested ratings for some route.
     '''
 
-    page_request = requests.get('{}/routes/{}/ratings?per_page={}&page={}'
-                                .format(MTN_PROJECT_API, route_id, PAGE_SIZE,
-                                        i + 1))
+    data = json.loads(get_text('{}/routes/{}/ratings?per_page={}&page={}'
+                               .format(MTN_PROJECT_API, route_id, PAGE_SIZE,
+                                       i + 1)))
 
-    page_request.raise_for_status()
-
-    data = page_request.json()
     result = []
     for obj in data['data']:
         match obj:
@@ -63,7 +383,7 @@ def fetch_ratings(i: int, route_id: int) -> List[RouteRating]:
             case _:
                 pass
 
-    return result
+    return to_page(i, data, result)
 
 
 def fetch_reviews(i: int, route_id: int) -> List[RouteReview]:
@@ -71,13 +391,10 @@ def fetch_reviews(i: int, route_id: int) -> List[RouteReview]:
     Fetch the ith page of user reviews for some route.
     '''
 
-    page_request = requests.get('{}/routes/{}/stars?per_page={}&page={}'
-                                .format(MTN_PROJECT_API, route_id, PAGE_SIZE,
-                                        i + 1))
+    data = json.loads(get_text('{}/routes/{}/stars?per_page={}&page={}'
+                               .format(MTN_PROJECT_API, route_id, PAGE_SIZE,
+                                       i + 1)))
 
-    page_request.raise_for_status()
-
-    data = page_request.json()
     result = []
     for obj in data['data']:
         match obj:
@@ -87,7 +404,7 @@ def fetch_reviews(i: int, route_id: int) -> List[RouteReview]:
                 print(f'ERROR: invalid score object ' + str(other),
                       file=sys.stderr)
 
-    return result
+    return to_page(i, data, result)
 
 
 def fetch_ticks(i: int, route_id: int) -> List[RouteTick]:
@@ -95,28 +412,26 @@ def fetch_ticks(i: int, route_id: int) -> List[RouteTick]:
     Fetch the ith page of ticks for some route.
     '''
 
-    page_request = requests.get('{}/routes/{}/ticks?per_page={}&page={}'
-                                .format(MTN_PROJECT_API, route_id, PAGE_SIZE,
-                                        i + 1))
+    data = json.loads(get_text('{}/routes/{}/ticks?per_page={}&page={}'
+                               .format(MTN_PROJECT_API, route_id, PAGE_SIZE,
+                                       i + 1)))
 
-    page_request.raise_for_status()
-    data = page_request.json()
     result = []
     for obj in data['data']:
         match obj:
             case {'date': datestring, 'text': text, 'user': {'id': uid}}:
-                parsed_date = datetime(1970, 1, 1, 0, 0, 0)
                 try:
                     parsed_date = datetime.strptime(
                         datestring, TICK_DATE_FORMAT)
-                except:
-                    pass
+                except (TypeError, ValueError):
+                    # Unknown, rather than a date that other ticks share
+                    parsed_date = None
 
                 result.append(RouteTick(route_id, uid, text, parsed_date))
             case _:
                 pass
 
-    return result
+    return to_page(i, data, result)
 
 
 def parse_breadcrumb(dictionary) -> int:
@@ -131,17 +446,19 @@ def parse_breadcrumb(dictionary) -> int:
     return int(SITEMAP_AREA_PATTERN.match(dictionary['item']).group(1))
 
 
-def fetch_area(area_url: str) -> Area:
+def fetch_area_with_routes(area_url: str) -> Tuple[Area, List[str]]:
+    '''
+    Fetch an area page and return the area along with the ids of the routes
+    its page links to, see area_index.RouteAreaIndex.
+    '''
+
     area_id, area_short_name = [cons(x)
                                 for cons, x
                                 in zip([int, str],
                                        SITEMAP_AREA_PATTERN.match(area_url)
                                             .group(1, 2))]
 
-    area_xml_request = requests.get(area_url)
-
-    area_xml_request.raise_for_status()
-    xml = area_xml_request.text
+    xml = get_text(area_url)
 
     gps_matches = GPS_PATTERN.findall(xml)
     assert len(gps_matches) == 1, 'Wrong number of GPS matches (%d)' % len(gps_matches)
@@ -160,23 +477,32 @@ def fetch_area(area_url: str) -> Area:
             case other:
                 raise Exception("Could not parse hierarchy " + str(other))
 
-    return Area(area_id, area_short_name, latitude, longitude, hierarchy)
+    route_ids = list(dict.fromkeys(AREA_ROUTE_LINK_PATTERN.findall(xml)))
 
+    return (Area(area_id, area_short_name, latitude, longitude, hierarchy),
+            route_ids)
 
-def fetch_areas(i: int) -> Generator[Area, None, None]:
+
+def fetch_area(area_url: str) -> Area:
+    return fetch_area_with_routes(area_url)[0]
+
+
+def fetch_area_entries(i: int) -> List[SitemapEntry]:
     '''
-    Fetch the ith page of areas.
+    Fetch the ith area sitemap page and return the area urls it lists.
     '''
 
     print(f'fetch_areas({i})', file=sys.stderr)
 
-    page_request = requests.get('{}/sitemap-areas-{}.xml'
-                                .format(MTN_PROJECT_ROOT, i))
+    return parse_sitemap(get_text(area_sitemap_url(i)))
 
-    page_request.raise_for_status()
-    xml = page_request.text
 
-    urls = GENERIC_SITEMAP_URL_PATTERN.findall(xml)
+def fetch_areas(i: int) -> Generator[Area, None, None]:
+    '''
+    Fetch the ith page of areas.
+    '''
+
+    urls = [entry.url for entry in fetch_area_entries(i)]
 
     areas = (safe_run(lambda: fetch_area(url)) for url in urls)
 
@@ -186,10 +512,8 @@ def fetch_areas(i: int) -> Generator[Area, None, None]:
 def get_area_id_from_route_id(
   route_id: int, route_name: str, mock_ids: bool = True) -> int:
     def safe():
-        html_request = requests.get('{}/route/{}/{}'
-                            .format(MTN_PROJECT_ROOT, route_id, route_name))
-        html_request.raise_for_status()
-        html = html_request.text
+        html = get_text('{}/route/{}/{}'
+                        .format(MTN_PROJECT_ROOT, route_id, route_name))
 
         hierarchy = AREA_HIERARCHY_PATTERN.findall(html)
         assert len(hierarchy) == 2, 'No hierarchy found for route ' + route_id
@@ -207,23 +531,34 @@ def get_area_id_from_route_id(
     return result if result is not None else 0
 
 
-def fetch_routes(i: int) -> List[Route]:
+def fetch_route_entries(i: int) -> List[Tuple[Route, Optional[datetime]]]:
     '''
-    Fetch the ith page of routes.
+    Fetch the ith page of routes along with their sitemap lastmod.
     '''
 
-    page_request = requests.get('{}/sitemap-routes-{}.xml'
-                                .format(MTN_PROJECT_ROOT, i))
+    result = []
+    for entry in parse_sitemap(get_text(route_sitemap_url(i))):
+        match = SITEMAP_ROUTE_PATTERN.fullmatch(entry.url)
+        if match is None:
+            continue
+
+        id, name = match.group(1, 2)
+        result.append((Route(id, name, get_area_id_from_route_id(id, name)),
+                       entry.lastmod))
+
+    return result
+
 
-    page_request.raise_for_status()
-    xml = page_request.text
+def fetch_routes(i: int) -> List[Route]:
+    '''
+    Fetch the ith page of routes.
+    '''
 
-    return [Route(id, name, get_area_id_from_route_id(id, name))
-            for id, name in SITEMAP_ROUTE_PATTERN.findall(xml)]
+    return [route for route, _ in fetch_route_entries(i)]
 
 
 def get_sitemap() -> str:
-    return requests.get('https://www.mountainproject.com/sitemap.xml').text
+    return get_text('{}/sitemap.xml'.format(MTN_PROJECT_ROOT))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,134 @@
+import json
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import fetcher
+from model import RouteTick
+
+
+class SessionTest(unittest.TestCase):
+    def tearDown(self):
+        fetcher.configure_session()
+
+    def test_one_session_per_thread_on_a_shared_adapter(self):
+        fetcher.configure_session(pool_size=4, retries=2)
+        sessions = {}
+
+        def get(name):
+            sessions[name] = (fetcher.get_session(), fetcher.get_session())
+
+        threads = [threading.Thread(target=get, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for first, second in sessions.values():
+            self.assertIs(first, second)
+        self.assertEqual(3, len({id(first) for first, _ in sessions.values()}))
+
+        adapters = {id(session.get_adapter('https://www.mountainproject.com'))
+                    for session, _ in sessions.values()}
+        self.assertEqual(1, len(adapters))
+        adapter = sessions[0][0].get_adapter('https://www.mountainproject.com')
+        self.assertEqual(4, adapter._pool_maxsize)
+        self.assertEqual(2, adapter.max_retries.total)
+
+    def test_default_session_is_configured_once(self):
+        configure_session = fetcher.configure_session
+        barrier = threading.Barrier(8)
+        calls = []
+
+        def slow_configure_session():
+            calls.append(None)
+            time.sleep(0.01)
+            configure_session()
+
+        def get():
+            barrier.wait()
+            fetcher.get_session()
+
+        threads = [threading.Thread(target=get) for _ in range(8)]
+        with mock.patch.object(fetcher, '_adapter', None), \
+                mock.patch.object(fetcher, 'configure_session', slow_configure_session):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(1, len(calls))
+
+    def test_reconfiguring_replaces_the_session(self):
+        session = fetcher.get_session()
+        fetcher.configure_session(pool_size=2)
+
+        replaced = fetcher.get_session()
+        self.assertIsNot(session, replaced)
+        self.assertEqual(2, replaced.get_adapter('https://www.mountainproject.com')
+                         ._pool_maxsize)
+
+
+class SitemapTest(unittest.TestCase):
+    def test_parse_lastmod(self):
+        self.assertEqual(datetime(2024, 3, 1, 12, 30, tzinfo=timezone(timedelta(hours=-7))),
+                         fetcher.parse_lastmod(' 2024-03-01T12:30:00-07:00 '))
+        # Naive timestamps and plain dates are taken as UTC
+        self.assertEqual(datetime(2024, 3, 1, 12, 30, tzinfo=timezone.utc),
+                         fetcher.parse_lastmod('2024-03-01T12:30:00'))
+        self.assertEqual(datetime(2024, 3, 1, tzinfo=timezone.utc),
+                         fetcher.parse_lastmod('2024-03-01'))
+        self.assertIsNone(fetcher.parse_lastmod('yesterday'))
+
+    def test_parse_sitemap(self):
+        xml = '''<urlset>
+<url><loc>https://www.mountainproject.com/area/1</loc>
+<lastmod>2024-03-01T12:30:00+00:00</lastmod></url>
+<url><loc> https://www.mountainproject.com/area/2 </loc></url>
+<url><loc>https://www.mountainproject.com/area/3</loc><lastmod>soon</lastmod></url>
+<url><lastmod>2024-03-01</lastmod></url>
+</urlset>'''
+
+        self.assertListEqual([
+            fetcher.SitemapEntry('https://www.mountainproject.com/area/1',
+                                 datetime(2024, 3, 1, 12, 30, tzinfo=timezone.utc)),
+            fetcher.SitemapEntry('https://www.mountainproject.com/area/2', None),
+            fetcher.SitemapEntry('https://www.mountainproject.com/area/3', None),
+        ], fetcher.parse_sitemap(xml))
+
+    def test_parse_sitemap_index(self):
+        xml = '''<sitemapindex>
+<sitemap><loc>https://www.mountainproject.com/sitemap-areas-0.xml</loc>
+<lastmod>2024-03-01</lastmod></sitemap>
+</sitemapindex>'''
+
+        self.assertListEqual([
+            fetcher.SitemapEntry('https://www.mountainproject.com/sitemap-areas-0.xml',
+                                 datetime(2024, 3, 1, tzinfo=timezone.utc)),
+        ], fetcher.parse_sitemap(xml))
+
+    def test_parse_bare_locs(self):
+        self.assertListEqual([fetcher.SitemapEntry('a', None), fetcher.SitemapEntry('b', None)],
+                             fetcher.parse_sitemap('<loc>a</loc>\n<loc>b</loc>'))
+
+
+class TicksTest(unittest.TestCase):
+    def test_unparseable_dates_are_none(self):
+        data = {'total': 3, 'data': [
+            {'date': 'Mar 3, 2019, 9:44 am', 'text': 'Sent', 'user': {'id': 7}},
+            {'date': '-', 'text': 'Fell', 'user': {'id': 7}},
+            {'date': None, 'text': '', 'user': {'id': 8}},
+        ]}
+
+        with mock.patch.object(fetcher, 'get_text', return_value=json.dumps(data)):
+            page = fetcher.fetch_ticks(0, 10)
+        self.assertListEqual([RouteTick(10, 7, 'Sent', datetime(2019, 3, 3, 9, 44)),
+                              RouteTick(10, 7, 'Fell', None),
+                              RouteTick(10, 8, '', None)], list(page))
+        self.assertTrue(page.is_last)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+'''
+http_cache.py
+
+Provides ResponseCache, a persistent on-disk cache of HTTP response bodies used
+by fetcher.get_text(). Each entry is stored in its own file named after the
+sha256 of its URL, and remembers the ETag and Last-Modified headers of the
+response so that a re-crawl can send a conditional request and get a bodyless
+304 back for anything that has not changed.
+
+The cache is bounded by a size budget. When a store pushes it over the budget,
+the least recently used entries are evicted until it is back under
+EVICTION_TARGET of the budget.
+
+In offline mode nothing is sent over the network: hits are served from disk
+and misses raise CacheMiss, which lets parsing and output changes be rerun
+against a previous crawl.
+'''
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+EVICTION_TARGET = 0.9
+ENTRY_SUFFIX = '.entry'
+
+
+class CacheMiss(Exception):
+    '''
+    Raised in offline mode when a URL has never been cached.
+    '''
+
+
+@dataclass
+class CachedResponse:
+    url: str
+    text: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+    def conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+
+        return headers
+
+
+@dataclass
+class _IndexEntry:
+    size: int
+    last_used: float
+
+
+class ResponseCache:
+    '''
+    Thread-safe, size-bounded, LRU cache of response bodies keyed by URL.
+
+    Entry files hold one line of JSON metadata followed by the UTF-8 body.
+    Recency is kept in each file's mtime, so it survives restarts.
+    '''
+
+    directory: str
+    max_bytes: int
+    offline: bool
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES,
+                 offline: bool = False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._index: Dict[str, _IndexEntry] = {}
+        self._total_bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(ENTRY_SUFFIX):
+                    continue
+
+                stat = os.stat(os.path.join(root, name))
+                key = name[:-len(ENTRY_SUFFIX)]
+                self._index[key] = _IndexEntry(stat.st_size, stat.st_mtime)
+                self._total_bytes += stat.st_size
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ENTRY_SUFFIX)
+
+    def lookup(self, url: str) -> Optional[CachedResponse]:
+        key = self.key(url)
+        try:
+            with open(self._path(key), 'rb') as file:
+                meta = json.loads(file.readline())
+                body = file.read()
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            print('Discarding corrupt cache entry for %s: %s' % (url, e),
+                  file=sys.stderr)
+            self._remove(key)
+            return None
+
+        if meta.get('url') != url:
+            return None
+
+        self.touch(url)
+
+        return CachedResponse(url, body.decode(), meta.get('etag'),
+                              meta.get('lastModified'))
+
+    def touch(self, url: str):
+        '''
+        Mark url as recently used.
+        '''
+
+        key = self.key(url)
+        now = time.time()
+        try:
+            os.utime(self._path(key), (now, now))
+        except FileNotFoundError:
+            return
+
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None:
+                entry.last_used = now
+
+    def store(self, url: str, text: str, etag: Optional[str],
+              last_modified: Optional[str]):
+        key = self.key(url)
+        path = self._path(key)
+        meta = {'url': url, 'etag': etag, 'lastModified': last_modified}
+        data = json.dumps(meta).encode() + b'\n' + text.encode()
+
+        # Write to a temporary file first so that readers, including other
+        # processes sharing the directory, never see a partial entry.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+
+        with self._lock:
+            previous = self._index.get(key)
+            if previous is not None:
+                self._total_bytes -= previous.size
+
+            self._index[key] = _IndexEntry(len(data), time.time())
+            self._total_bytes += len(data)
+
+            if self._total_bytes > self.max_bytes:
+                self._evict(int(self.max_bytes * EVICTION_TARGET))
+
+    def _evict(self, target_bytes: int):
+        # Called with the lock held
+        for key in sorted(self._index, key=lambda k: self._index[k].last_used):
+            if self._total_bytes <= target_bytes:
+                break
+
+            self._total_bytes -= self._index.pop(key).size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _remove(self, key: str):
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry is not None:
+                self._total_bytes -= entry.size
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def size(self) -> int:
+        return self._total_bytes
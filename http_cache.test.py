@@ -0,0 +1,51 @@
+import tempfile
+import time
+import unittest
+
+from http_cache import ResponseCache
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_store_and_lookup(self):
+        cache = ResponseCache(self.directory.name)
+        cache.store('https://a', 'body', '"etag"', None)
+
+        cached = cache.lookup('https://a')
+        self.assertEqual('body', cached.text)
+        self.assertDictEqual({'If-None-Match': '"etag"'},
+                             cached.conditional_headers())
+        self.assertIsNone(cache.lookup('https://b'))
+
+    def test_entries_survive_restart(self):
+        ResponseCache(self.directory.name).store('https://a', 'body', None,
+                                                 'Mon, 01 Jan 2024 00:00:00 GMT')
+
+        cache = ResponseCache(self.directory.name)
+        self.assertEqual('body', cache.lookup('https://a').text)
+        self.assertGreater(cache.size(), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ResponseCache(self.directory.name, max_bytes=10 ** 6)
+        cache.store('https://a', 'x' * 1000, None, None)
+        entry_size = cache.size()
+        cache.max_bytes = int(2.5 * entry_size)
+
+        cache.store('https://b', 'x' * 1000, None, None)
+        time.sleep(0.01)
+        cache.lookup('https://a')
+        cache.store('https://c', 'x' * 1000, None, None)
+
+        self.assertIsNotNone(cache.lookup('https://a'))
+        self.assertIsNone(cache.lookup('https://b'))
+        self.assertIsNotNone(cache.lookup('https://c'))
+        self.assertLessEqual(cache.size(), cache.max_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
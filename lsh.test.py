@@ -0,0 +1,90 @@
+import unittest
+
+import numpy as np
+from scipy import sparse
+
+from collaborative_filtering import ReviewMatrix
+from lsh import LSHIndex, default_bits, measure_recall
+
+
+def clustered_matrix(rows=2000, clusters=20, columns_per_cluster=30, per_row=8, seed=0):
+    '''
+    Rows each rating a few of their cluster's columns, so that rows of the
+    same cluster are often similar.
+    '''
+
+    rng = np.random.default_rng(seed)
+    row_indexes = np.repeat(np.arange(rows), per_row)
+    cluster = np.repeat(rng.integers(0, clusters, rows), per_row)
+    column_indexes = cluster * columns_per_cluster + rng.integers(0, columns_per_cluster,
+                                                                  len(row_indexes))
+    scores = rng.integers(1, 5, len(row_indexes)).astype(np.float64)
+    return sparse.csr_matrix((scores, (row_indexes, column_indexes)),
+                             shape=(rows, clusters * columns_per_cluster))
+
+
+class LSHIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.matrix = clustered_matrix()
+        self.normalized = sparse.diags(1 / np.sqrt(
+            np.asarray(self.matrix.multiply(self.matrix).sum(axis=1)).ravel())) @ self.matrix
+
+    def exact_neighbours(self, i, threshold):
+        similarities = (self.normalized @ self.normalized[i].T).toarray().ravel()
+        similarities[i] = 0
+        return np.flatnonzero(similarities > threshold)
+
+    def test_neighbours_are_exact_matches(self):
+        index = LSHIndex(self.matrix, tables=8, bits=12, probes=1)
+        found = 0
+        for i in range(0, 2000, 50):
+            actual = index.neighbours(i, 0.3)
+            self.assertTrue(set(actual) <= set(self.exact_neighbours(i, 0.3)))
+            self.assertNotIn(i, actual)
+            found += len(actual)
+        self.assertGreater(found, 0)
+
+    def test_probing_every_bucket_is_exact(self):
+        # With one bit, the probe reads the only other bucket
+        index = LSHIndex(self.matrix, tables=1, bits=1, probes=1)
+        self.assertEqual(1.0, measure_recall(index, samples=50)['recall'])
+
+    def test_knobs_trade_recall_for_candidates(self):
+        narrow = measure_recall(LSHIndex(self.matrix, tables=2, bits=12, probes=0), samples=50)
+        wide = measure_recall(LSHIndex(self.matrix, tables=32, bits=6, probes=2), samples=50)
+        self.assertLess(narrow['candidates'], wide['candidates'])
+        self.assertLess(narrow['recall'], wide['recall'])
+        self.assertLessEqual(narrow['similarity_recall'], 1.0)
+        self.assertGreater(wide['recall'], 0.9)
+
+    def test_default_bits_grow_with_rows(self):
+        self.assertEqual(1, default_bits(0))
+        self.assertEqual(1, default_bits(300))
+        self.assertEqual(10, default_bits(200_000))
+        self.assertEqual(12, default_bits(800_000))
+        self.assertEqual(63, default_bits(2**70))
+
+        # Buckets stay about as large with four times the rows
+        small = LSHIndex(self.matrix, tables=1)
+        large = LSHIndex(clustered_matrix(rows=8000), tables=1)
+        self.assertEqual(small.bits + 2, large.bits)
+        self.assertGreater(large.nbytes, small.nbytes)
+
+    def test_recommend_with_index(self):
+        rows, columns = self.matrix.nonzero()
+        reviews = ReviewMatrix(rows + 100, columns + 1000, np.asarray(self.matrix[rows, columns])
+                               .ravel())
+        index = LSHIndex(reviews.matrix, tables=1, bits=1, probes=1)
+        for user_id in (100, 517, 2099):
+            expected = reviews.recommend(user_id, 20)
+            actual = reviews.recommend(user_id, 20, neighbour_index=index)
+            self.assertListEqual(expected['route_id'].tolist(), actual['route_id'].tolist())
+            np.testing.assert_allclose(expected['predicted_score'], actual['predicted_score'])
+
+    def test_bits(self):
+        with self.assertRaises(ValueError):
+            LSHIndex(self.matrix, bits=64)
+
+
+if __name__ == '__main__':
+    unittest.main()
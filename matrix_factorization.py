@@ -0,0 +1,291 @@
+'''
+matrix_factorization.py
+
+A matrix-factorization recommender, beside the user-kNN of
+collaborative_filtering.py. Each user and each route gets a vector of
+factors, fitted so that the mean score plus the dot product of a user's and
+a route's factors approximates the score the user gave the route (over the
+positive scores of collaborative_filtering.ReviewMatrix).
+
+The factors are fitted by alternating least squares with weighted-lambda
+regularization: holding the route factors fixed, each user's factors are the
+solution of a small ridge regression over the routes they rated, and the
+other way around. Each half-step solves a block of users (routes) at once,
+summing the outer products of the fixed factors of their ratings a chunk of
+ratings at a time to bound memory.
+
+The model is a directory of .npy files, opened with mmap, plus model.json
+with the training parameters and the state of the database it was trained
+on, as snapshot.py does. Saving writes a sibling directory and then swaps it
+in, so a failed save leaves the previous model in place. Scoring a user is one product of the
+route factors with the user's factors, and a partial sort for the top routes,
+so it does not depend on the number of users.
+
+Usage:
+python3 matrix_factorization.py DATABASE [--factors N] [--regularization L]
+                                         [--iterations N]
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from collaborative_filtering import ReviewMatrix, read_user_reviews
+from snapshot import database_stamp, replacing_directory
+
+MODEL_SUFFIX = '.factors'
+METADATA_FILE_NAME = 'model.json'
+DEFAULT_FACTORS = 32
+DEFAULT_REGULARIZATION = 0.1
+DEFAULT_ITERATIONS = 10
+# Users (routes) solved at once, and ratings whose outer products are summed at
+# once while solving
+SOLVE_BLOCK_ROWS = 4096
+SOLVE_BLOCK_ENTRIES = 8192
+
+
+def default_directory(db_path: str) -> str:
+    return db_path + MODEL_SUFFIX
+
+
+def solve_factors(ratings: sparse.csr_matrix, fixed: np.ndarray,
+                  regularization: float) -> np.ndarray:
+    '''
+    Return the factors of each row of ratings (centered scores, one column
+    per row of fixed) minimizing the squared error of their dot products with
+    the fixed factors of the columns the row rated, plus regularization times
+    the number of those columns times the squared norm of the factors. Rows
+    rating nothing get zero factors.
+    '''
+
+    count, factors = ratings.shape[0], fixed.shape[1]
+    fixed = fixed.astype(np.float32)
+    solved = np.zeros((count, factors))
+    identity = np.eye(factors)
+    for start in range(0, count, SOLVE_BLOCK_ROWS):
+        end = min(start + SOLVE_BLOCK_ROWS, count)
+        indptr = ratings.indptr[start:end + 1]
+        rated_counts = np.diff(indptr)
+        entry_rows = np.repeat(np.arange(end - start), rated_counts)
+        grams = np.zeros((end - start, factors * factors), dtype=np.float32)
+        targets = np.zeros((end - start, factors), dtype=np.float32)
+        # Sum the outer products of a chunk of ratings at a time, with a sparse
+        # product mapping each rating to its row, so that a route rated by
+        # many users does not need them all at once. In float32, which halves
+        # the time of the products; the systems are solved in float64.
+        for first in range(indptr[0], indptr[-1], SOLVE_BLOCK_ENTRIES):
+            last = min(first + SOLVE_BLOCK_ENTRIES, indptr[-1])
+            columns = fixed[ratings.indices[first:last]]
+            chunk_rows = entry_rows[first - indptr[0]:last - indptr[0]]
+            to_rows = sparse.csr_matrix((np.ones(last - first, dtype=np.float32),
+                                         (chunk_rows, np.arange(last - first))),
+                                        shape=(end - start, last - first))
+            grams += to_rows @ (columns[:, :, None] * columns[:, None, :]).reshape(
+                -1, factors * factors)
+            targets += to_rows @ (columns * ratings.data[first:last, None].astype(np.float32))
+
+        rated = rated_counts > 0
+        grams = grams.reshape(-1, factors, factors)[rated].astype(np.float64)
+        grams += (regularization * rated_counts[rated])[:, None, None] * identity
+        solved[start:end][rated] = np.linalg.solve(grams, targets[rated][..., None])[..., 0]
+
+    return solved
+
+
+class FactorModel:
+    '''
+    Trained factors: user_factors[i] are those of the user user_ids[i],
+    route_factors[j] those of the route route_ids[j].
+    '''
+
+    user_ids: np.ndarray
+    route_ids: np.ndarray
+    user_factors: np.ndarray
+    route_factors: np.ndarray
+    metadata: dict
+
+    def __init__(self, user_ids: np.ndarray, route_ids: np.ndarray, user_factors: np.ndarray,
+                 route_factors: np.ndarray, metadata: dict):
+        self.user_ids, self.route_ids = user_ids, route_ids
+        self.user_factors, self.route_factors = user_factors, route_factors
+        self.metadata = metadata
+
+    @property
+    def mean(self) -> float:
+        return self.metadata['mean']
+
+    @staticmethod
+    def load(directory: str) -> 'FactorModel':
+        with open(os.path.join(directory, METADATA_FILE_NAME)) as file:
+            metadata = json.load(file)
+
+        arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+                  for name in ('user_ids', 'route_ids', 'user_factors', 'route_factors')]
+        return FactorModel(*arrays, metadata)
+
+    def save(self, directory: str):
+        '''
+        Save the model in directory, replacing the model there once this one
+        is complete.
+        '''
+
+        with replacing_directory(directory) as building:
+            for name in ('user_ids', 'route_ids', 'user_factors', 'route_factors'):
+                np.save(os.path.join(building, name + '.npy'), getattr(self, name))
+            with open(os.path.join(building, METADATA_FILE_NAME), 'w') as file:
+                json.dump(self.metadata, file, indent=2)
+
+    def is_fresh(self, db_path: str) -> bool:
+        return self.metadata.get('stamp') == database_stamp(db_path)
+
+    def predict(self, user_id: int) -> Optional[np.ndarray]:
+        '''
+        Return the predicted score of every route for a user, or None for a
+        user without positive reviews when the model was trained.
+        '''
+
+        i = np.searchsorted(self.user_ids, user_id)
+        if i >= len(self.user_ids) or self.user_ids[i] != user_id:
+            return None
+
+        return self.route_factors @ self.user_factors[i] + self.mean
+
+    def recommend(self, user_id: int, rated_route_ids: np.ndarray,
+                  n_recommendations: int = 300) -> pd.DataFrame:
+        '''
+        Return the n_recommendations routes with the best predicted score
+        other than rated_route_ids, with their predicted_score, best first.
+        '''
+
+        predictions = self.predict(user_id)
+        if predictions is None:
+            return pd.DataFrame(columns=['route_id', 'predicted_score'])
+
+        rated_route_ids = np.asarray(rated_route_ids, dtype=self.route_ids.dtype)
+        rated = np.searchsorted(self.route_ids, rated_route_ids)
+        found = rated < len(self.route_ids)
+        found[found] = self.route_ids[rated[found]] == rated_route_ids[found]
+        predictions[rated[found]] = -np.inf
+        candidates = np.flatnonzero(np.isfinite(predictions))
+        predictions = predictions[candidates]
+        if len(candidates) > n_recommendations:
+            top = np.argpartition(-predictions, n_recommendations - 1)[:n_recommendations]
+            candidates, predictions = candidates[top], predictions[top]
+        order = np.argsort(-predictions, kind='stable')
+
+        return pd.DataFrame({
+            'route_id': self.route_ids[candidates[order]],
+            'predicted_score': predictions[order],
+        })
+
+
+def root_mean_squared_error(reviews: ReviewMatrix, user_factors: np.ndarray,
+                            route_factors: np.ndarray, mean: float) -> float:
+    matrix = reviews.matrix.tocoo()
+    predictions = np.einsum('ef,ef->e', user_factors[matrix.row], route_factors[matrix.col])
+    return float(np.sqrt(np.mean((matrix.data - mean - predictions) ** 2)))
+
+
+def train(reviews: ReviewMatrix, factors: int = DEFAULT_FACTORS,
+          regularization: float = DEFAULT_REGULARIZATION, iterations: int = DEFAULT_ITERATIONS,
+          seed: int = 0) -> FactorModel:
+    '''
+    Fit the factors of the reviews by alternating least squares, see the
+    module docstring.
+    '''
+
+    mean = float(reviews.matrix.data.mean()) if reviews.matrix.nnz else 0.0
+    centered = reviews.matrix.copy()
+    centered.data -= mean
+    centered_t = centered.T.tocsr()
+
+    rng = np.random.default_rng(seed)
+    user_factors = np.zeros((centered.shape[0], factors))
+    route_factors = rng.normal(0, 0.1, (centered.shape[1], factors))
+    for iteration in range(iterations):
+        user_factors = solve_factors(centered, route_factors, regularization)
+        route_factors = solve_factors(centered_t, user_factors, regularization)
+        print('Iteration %d: RMSE %.4f'
+              % (iteration + 1,
+                 root_mean_squared_error(reviews, user_factors, route_factors, mean)),
+              file=sys.stderr)
+
+    return FactorModel(reviews.user_ids, reviews.route_ids, user_factors.astype(np.float32),
+                       route_factors.astype(np.float32),
+                       {'mean': mean, 'factors': factors, 'regularization': regularization,
+                        'iterations': iterations})
+
+
+def build_model(db_path: str, directory: Optional[str] = None, factors: int = DEFAULT_FACTORS,
+                regularization: float = DEFAULT_REGULARIZATION,
+                iterations: int = DEFAULT_ITERATIONS) -> FactorModel:
+    '''
+    Train a model on the database's reviews and save it in directory,
+    replacing the model there.
+    '''
+
+    # Stamp before reading, so that a concurrent write makes the model stale
+    stamp = database_stamp(db_path)
+    started = time.perf_counter()
+    model = train(ReviewMatrix.load(db_path), factors, regularization, iterations)
+    model.metadata.update({'database': os.path.abspath(db_path), 'stamp': stamp})
+    model.save(directory or default_directory(db_path))
+    print('Trained the factors of %d users and %d routes in %.1fs'
+          % (len(model.user_ids), len(model.route_ids), time.perf_counter() - started),
+          file=sys.stderr)
+
+    return model
+
+
+def open_model(db_path: str, directory: Optional[str] = None) -> FactorModel:
+    directory = directory or default_directory(db_path)
+    if not os.path.exists(os.path.join(directory, METADATA_FILE_NAME)):
+        raise FileNotFoundError('No factor model in %s, train it with '
+                                'python3 matrix_factorization.py %s' % (directory, db_path))
+
+    return FactorModel.load(directory)
+
+
+def get_factor_recommendations(user_id, db_path, n_recommendations=300):
+    '''
+    Matrix-factorization counterpart of
+    collaborative_filtering.get_recommendations(), from the database's
+    trained model. Only the user's own reviews are read, to leave them out.
+    '''
+
+    rated_route_ids, _ = read_user_reviews(db_path, user_id)
+    return open_model(db_path).recommend(user_id, rated_route_ids, n_recommendations)
+
+
+def get_factor_recommendations_to_list(user_id, db_path):
+    return get_factor_recommendations(user_id, db_path)['route_id'].tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database')
+    parser.add_argument('--directory', default=None,
+                        help='Where to write the model (default: DATABASE%s)' % MODEL_SUFFIX)
+    parser.add_argument('--factors', type=int, default=DEFAULT_FACTORS,
+                        help='Factors per user and route (default %(default)s)')
+    parser.add_argument('--regularization', type=float, default=DEFAULT_REGULARIZATION,
+                        help='Weight of the squared norm of the factors, per rating '
+                             '(default %(default)s)')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS,
+                        help='Alternating least squares sweeps (default %(default)s)')
+    args = parser.parse_args()
+
+    build_model(args.database, args.directory, args.factors, args.regularization,
+                args.iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+from unittest import mock
+
+import numpy as np
+from scipy import sparse
+
+import matrix_factorization
+from collaborative_filtering import ReviewMatrix
+from matrix_factorization import (build_model, get_factor_recommendations, open_model,
+                                  root_mean_squared_error, solve_factors, train)
+from schema import TABLES
+
+
+def low_rank_reviews(users=300, routes=60, per_user=20, seed=0):
+    '''
+    (user_id, route_id, score) of scores from 1 to 4 that two factors explain.
+    '''
+
+    rng = np.random.default_rng(seed)
+    user_factors = rng.normal(0, 1, (users, 2))
+    route_factors = rng.normal(0, 1, (routes, 2))
+    user_ids = np.repeat(np.arange(users), per_user)
+    route_ids = np.concatenate([rng.choice(routes, per_user, replace=False)
+                                for _ in range(users)])
+    scores = np.clip(2.5 + 0.7 * np.einsum('ef,ef->e', user_factors[user_ids],
+                                           route_factors[route_ids]), 1, 4)
+    return user_ids + 1000, route_ids + 100, scores
+
+
+class SolveFactorsTest(unittest.TestCase):
+    def test_matches_each_row_solved_alone(self):
+        rng = np.random.default_rng(1)
+        ratings = sparse.random(50, 40, density=0.2, format='lil', random_state=2)
+        # A row with more ratings than a chunk, and an empty one
+        ratings[3] = rng.random(40) + 0.5
+        ratings[7] = 0
+        ratings = ratings.tocsr()
+        ratings.eliminate_zeros()
+        fixed = rng.normal(0, 1, (40, 4))
+
+        # Blocks and chunks ending within rows
+        with mock.patch.object(matrix_factorization, 'SOLVE_BLOCK_ROWS', 16), \
+                mock.patch.object(matrix_factorization, 'SOLVE_BLOCK_ENTRIES', 7):
+            solved = solve_factors(ratings, fixed, 0.5)
+
+        for i in range(50):
+            row = ratings[i]
+            if row.nnz == 0:
+                np.testing.assert_array_equal(np.zeros(4), solved[i])
+                continue
+            columns = fixed[row.indices]
+            expected = np.linalg.solve(columns.T @ columns + 0.5 * row.nnz * np.eye(4),
+                                       columns.T @ row.data)
+            np.testing.assert_allclose(expected, solved[i], rtol=1e-4, atol=1e-5)
+
+
+class FactorModelTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, 'test.db')
+        self.reviews = low_rank_reviews()
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(TABLES)
+        conn.executemany('INSERT INTO reviews VALUES (?, ?, ?)',
+                         zip(self.reviews[1].tolist(), self.reviews[0].tolist(),
+                             self.reviews[2].tolist()))
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_fits_low_rank_scores(self):
+        reviews = ReviewMatrix(*self.reviews)
+        with redirect_stderr(io.StringIO()):
+            model = train(reviews, factors=4, regularization=0.01, iterations=10)
+        self.assertLess(root_mean_squared_error(reviews, model.user_factors,
+                                                model.route_factors, model.mean), 0.15)
+
+    def test_recommendations(self):
+        with redirect_stderr(io.StringIO()):
+            trained = build_model(self.db_path, factors=4, iterations=5)
+        model = open_model(self.db_path)
+        self.assertTrue(model.is_fresh(self.db_path))
+        np.testing.assert_array_equal(trained.route_factors, model.route_factors)
+
+        rated = set(self.reviews[1][self.reviews[0] == 1000].tolist())
+        recommendations = get_factor_recommendations(1000, self.db_path, 10)
+        self.assertEqual(10, len(recommendations))
+        self.assertFalse(rated & set(recommendations['route_id'].tolist()))
+        scores = recommendations['predicted_score'].tolist()
+        self.assertListEqual(sorted(scores, reverse=True), scores)
+
+        # Every unrated route, best first
+        predictions = model.predict(1000)
+        unrated = [j for j, route_id in enumerate(model.route_ids) if route_id not in rated]
+        expected = model.route_ids[sorted(unrated, key=lambda j: -predictions[j])]
+        self.assertListEqual(expected.tolist(), get_factor_recommendations(
+            1000, self.db_path)['route_id'].tolist())
+
+        self.assertTrue(get_factor_recommendations(99, self.db_path).empty)
+
+    def test_save_replaces_the_model_once_complete(self):
+        with redirect_stderr(io.StringIO()):
+            build_model(self.db_path, factors=2, iterations=1)
+        model = open_model(self.db_path)
+        with mock.patch('numpy.save', side_effect=OSError), self.assertRaises(OSError), \
+                redirect_stderr(io.StringIO()):
+            build_model(self.db_path, factors=3, iterations=1)
+        self.assertEqual(2, open_model(self.db_path).route_factors.shape[1])
+
+        with redirect_stderr(io.StringIO()):
+            build_model(self.db_path, factors=3, iterations=1)
+        self.assertEqual(3, open_model(self.db_path).route_factors.shape[1])
+        self.assertListEqual(['test.db', 'test.db.factors'],
+                             sorted(os.listdir(self.directory.name)))
+        # The model opened before still reads its own files
+        self.assertEqual(len(model.route_ids), len(model.predict(1000)))
+        self.assertEqual(2, model.route_factors.shape[1])
+
+    def test_missing_model(self):
+        with self.assertRaises(FileNotFoundError):
+            get_factor_recommendations(1000, self.db_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+'''
+metrics.py
+
+In-process counters and latency histograms for the crawler, and a reporter
+thread that periodically writes them out as a JSON snapshot and as a
+Prometheus text exposition file (for node_exporter's textfile collector).
+
+fetcher records every HTTP request under REGISTRY, labelled with the endpoint
+type (ratings, ticks, reviews, area, route, sitemap), and scraper records each
+entity it writes, so a snapshot answers where crawl time and bytes go, what
+fails, and how many entities per second come out.
+'''
+
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DEFAULT_REPORT_INTERVAL_SECONDS = 30.0
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Optional[Dict[str, str]]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in (labels or {}).items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (key, value.replace('"', '\\"'))
+                             for key, value in pairs)
+
+
+@dataclass
+class Histogram:
+    buckets: Tuple[float, ...]
+    counts: List[int] = field(default_factory=list)
+    total: float = 0.0
+    count: int = 0
+
+    def __post_init__(self):
+        # One more bucket for everything above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+
+        self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        '''
+        Upper bound of the bucket holding the qth quantile, the same estimate
+        Prometheus' histogram_quantile() would make without interpolation.
+        '''
+
+        if self.count == 0:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+
+        return float('inf')
+
+
+class Metrics:
+    '''
+    Thread-safe registry of labelled counters, gauges and histograms.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._gauge_collectors: List[Callable[[], Dict[str, Dict[Labels, float]]]] = []
+        self.started = time.time()
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None,
+            value: float = 1):
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float,
+                labels: Optional[Dict[str, str]] = None,
+                buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def add_gauge_collector(self, collector: Callable[[], Dict[str, Dict[str, float]]]):
+        '''
+        Register a function returning {gauge name: {label value: value}} that
+        is called on every snapshot, e.g. for the request scheduler's limits.
+        The label is named "name".
+        '''
+
+        def collect():
+            return {gauge: {(('name', label),): value
+                            for label, value in values.items()}
+                    for gauge, values in collector().items()}
+
+        with self._lock:
+            self._gauge_collectors.append(collect)
+
+    def _gauges(self) -> Dict[str, Dict[Labels, float]]:
+        # Collectors may take their own locks, so call them without ours
+        with self._lock:
+            collectors = list(self._gauge_collectors)
+
+        gauges = {}
+        for collector in collectors:
+            for name, series in collector().items():
+                gauges.setdefault(name, {}).update(series)
+
+        return gauges
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {labels: (histogram.total, histogram.count,
+                                          histogram.quantile(0.5),
+                                          histogram.quantile(0.95))
+                                 for labels, histogram in series.items()}
+                          for name, series in self._histograms.items()}
+
+        gauges = self._gauges()
+
+        return {
+            'timestamp': time.time(),
+            'uptimeSeconds': time.time() - self.started,
+            'counters': {name: [{'labels': dict(labels), 'value': value}
+                                for labels, value in series.items()]
+                         for name, series in counters.items()},
+            'gauges': {name: [{'labels': dict(labels), 'value': value}
+                              for labels, value in series.items()]
+                       for name, series in gauges.items()},
+            'histograms': {name: [{'labels': dict(labels), 'count': count,
+                                   'sum': total, 'p50': p50, 'p95': p95}
+                                  for labels, (total, count, p50, p95) in series.items()]
+                           for name, series in histograms.items()},
+        }
+
+    def prometheus_text(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append('# TYPE %s counter' % name)
+                for labels, value in sorted(series.items()):
+                    lines.append('%s%s %s' % (name, _format_labels(labels), value))
+
+            for name, series in sorted(self._histograms.items()):
+                lines.append('# TYPE %s histogram' % name)
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float('inf'),),
+                                            histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append('%s_bucket%s %d' % (
+                            name, _format_labels(labels, (('le', le),)), cumulative))
+                    lines.append('%s_sum%s %s' % (name, _format_labels(labels), histogram.total))
+                    lines.append('%s_count%s %d' % (name, _format_labels(labels), histogram.count))
+
+        for name, series in sorted(self._gauges().items()):
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in sorted(series.items()):
+                lines.append('%s%s %s' % (name, _format_labels(labels), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Metrics()
+
+
+def _write_atomically(path: str, text: str):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as file:
+        file.write(text)
+    os.replace(temporary_path, path)
+
+
+def add_rates(snapshot: dict, previous: Optional[dict]) -> dict:
+    '''
+    Add a perSecond field to each counter series of snapshot, computed from
+    the change since the previous snapshot, or since start if there is none.
+    '''
+
+    if previous is None:
+        elapsed = snapshot['uptimeSeconds']
+        previous_values = {}
+    else:
+        elapsed = snapshot['timestamp'] - previous['timestamp']
+        previous_values = {(name, tuple(sorted(series['labels'].items()))): series['value']
+                           for name, all_series in previous['counters'].items()
+                           for series in all_series}
+
+    for name, all_series in snapshot['counters'].items():
+        for series in all_series:
+            before = previous_values.get((name, tuple(sorted(series['labels'].items()))), 0)
+            series['perSecond'] = ((series['value'] - before) / elapsed
+                                   if elapsed > 0
+                                   else 0.0)
+
+    return snapshot
+
+
+class MetricsReporter(threading.Thread):
+    '''
+    Daemon thread that writes REGISTRY to json_path and/or prometheus_path
+    every interval seconds, and once more when stopped.
+    '''
+
+    def __init__(self, json_path: Optional[str], prometheus_path: Optional[str],
+                 interval: float = DEFAULT_REPORT_INTERVAL_SECONDS,
+                 registry: Metrics = REGISTRY):
+        super().__init__(name='metrics-reporter', daemon=True)
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.registry = registry
+        self._stopped = threading.Event()
+        self._previous: Optional[dict] = None
+
+    def report(self):
+        if self.json_path is not None:
+            snapshot = add_rates(self.registry.snapshot(), self._previous)
+            self._previous = snapshot
+            _write_atomically(self.json_path, json.dumps(snapshot, indent=2))
+
+        if self.prometheus_path is not None:
+            _write_atomically(self.prometheus_path, self.registry.prometheus_text())
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.report()
@@ -0,0 +1,89 @@
+import json
+import os
+import tempfile
+import unittest
+
+from metrics import Histogram, Metrics, MetricsReporter, add_rates
+
+
+class HistogramTest(unittest.TestCase):
+    def test_buckets(self):
+        histogram = Histogram((0.1, 1.0))
+        for value in [0.05, 0.1, 0.5, 1.0, 2.0, 30.0]:
+            histogram.observe(value)
+
+        # Bounds are inclusive, and the last bucket takes everything above them
+        self.assertListEqual([2, 2, 2], histogram.counts)
+        self.assertEqual(6, histogram.count)
+        self.assertAlmostEqual(33.65, histogram.total)
+
+    def test_quantile(self):
+        histogram = Histogram((0.1, 1.0))
+        self.assertEqual(0.0, histogram.quantile(0.5))
+        for value in [0.05, 0.05, 0.5, 5.0]:
+            histogram.observe(value)
+
+        self.assertEqual(0.1, histogram.quantile(0.5))
+        self.assertEqual(1.0, histogram.quantile(0.75))
+        self.assertEqual(float('inf'), histogram.quantile(0.95))
+
+
+class MetricsTest(unittest.TestCase):
+    def test_prometheus_text(self):
+        metrics = Metrics()
+        metrics.inc('mp_requests_total', {'endpoint': 'ticks', 'status': 200})
+        metrics.inc('mp_requests_total', {'status': 200, 'endpoint': 'ticks'}, 2)
+        metrics.inc('mp_requests_total', {'endpoint': 'say "hi"'})
+        metrics.observe('mp_request_seconds', 0.2, {'endpoint': 'ticks'}, buckets=(0.1, 1.0))
+        metrics.observe('mp_request_seconds', 3.0, {'endpoint': 'ticks'}, buckets=(0.1, 1.0))
+        metrics.add_gauge_collector(lambda: {'mp_host_limit': {'www': 4}})
+
+        self.assertEqual('\n'.join([
+            '# TYPE mp_requests_total counter',
+            'mp_requests_total{endpoint="say \\"hi\\""} 1',
+            'mp_requests_total{endpoint="ticks",status="200"} 3',
+            '# TYPE mp_request_seconds histogram',
+            'mp_request_seconds_bucket{endpoint="ticks",le="0.1"} 0',
+            'mp_request_seconds_bucket{endpoint="ticks",le="1.0"} 1',
+            'mp_request_seconds_bucket{endpoint="ticks",le="+Inf"} 2',
+            'mp_request_seconds_sum{endpoint="ticks"} 3.2',
+            'mp_request_seconds_count{endpoint="ticks"} 2',
+            '# TYPE mp_host_limit gauge',
+            'mp_host_limit{name="www"} 4',
+        ]) + '\n', metrics.prometheus_text())
+
+    def test_snapshot_rates(self):
+        metrics = Metrics()
+        metrics.inc('mp_crawl_entities_total', {'type': 'Route'}, 10)
+        metrics.observe('mp_request_seconds', 0.2)
+        first = metrics.snapshot()
+        metrics.inc('mp_crawl_entities_total', {'type': 'Route'}, 30)
+        second = metrics.snapshot()
+        second['timestamp'] = first['timestamp'] + 2
+
+        add_rates(second, first)
+        self.assertListEqual([{'labels': {'type': 'Route'}, 'value': 40, 'perSecond': 15.0}],
+                             second['counters']['mp_crawl_entities_total'])
+        self.assertListEqual([{'labels': {}, 'count': 1, 'sum': 0.2, 'p50': 0.25, 'p95': 0.25}],
+                             first['histograms']['mp_request_seconds'])
+
+    def test_reporter_writes_on_stop(self):
+        metrics = Metrics()
+        metrics.inc('mp_requests_total')
+        with tempfile.TemporaryDirectory() as directory:
+            json_path = os.path.join(directory, 'metrics.json')
+            prometheus_path = os.path.join(directory, 'metrics.prom')
+            reporter = MetricsReporter(json_path, prometheus_path, interval=60,
+                                       registry=metrics)
+            reporter.start()
+            reporter.stop()
+
+            with open(json_path) as file:
+                self.assertEqual(1, json.load(file)['counters']['mp_requests_total'][0]['value'])
+            with open(prometheus_path) as file:
+                self.assertIn('mp_requests_total 1\n', file.read())
+            self.assertListEqual(['metrics.json', 'metrics.prom'], sorted(os.listdir(directory)))
+
+
+if __name__ == '__main__':
+    unittest.main()
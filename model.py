@@ -1,38 +1,56 @@
+'''
+Records for everything the scraper outputs.
+
+The records use __slots__, since an analysis or bulk load can hold millions of
+them. Ticks and reviews, by far the most numerous, can also be kept in a
+TickBatch or ReviewBatch: parallel arrays of ints, with tick texts interned
+and tick dates dictionary-encoded, at a fraction of the memory of the records.
+'''
+
+import sys
+from array import array
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Range of ReviewBatch.scores, signed bytes. Real scores are 0 to 4 stars.
+SCORE_MIN = -128
+SCORE_MAX = 127
 
 
-@dataclass
+@dataclass(slots=True)
 class Route:
     id: int
     name: str
     area_id: int
 
 
-@dataclass
+@dataclass(slots=True)
 class RouteRating:
     route_id: int
     user_id: int
     ratings: List[str]
 
 
-@dataclass
+@dataclass(slots=True)
 class RouteTick:
     route_id: int
     user_id: int
     text: str
-    date: datetime
+    date: Optional[datetime]
+    '''
+    None if the API gave a date that could not be parsed.
+    '''
 
 
-@dataclass
+@dataclass(slots=True)
 class RouteReview:
     route_id: int
     user_id: int
     score: int
 
 
-@dataclass
+@dataclass(slots=True)
 class Area:
     area_id: int
     area_name: str
@@ -44,3 +62,106 @@ class Area:
     area_id, and area_chain[-1] is always 0, to indicate the root area that is
     not stored but recognized as a valid area.
     '''
+
+
+class Page(list):
+    '''
+    One page of results from a paginated API, annotated with what the
+    response said about the pagination itself so that an Accumulator can stop
+    without requesting an empty page.
+    '''
+
+    is_last: bool = False
+    page_count: Optional[int] = None
+
+
+class TickBatch:
+    '''
+    Columnar RouteTicks. Tick i is (route_ids[i], user_ids[i], texts[i],
+    dates[date_codes[i]]). Iterating yields RouteTicks.
+    '''
+
+    __slots__ = ('route_ids', 'user_ids', 'texts', 'date_codes', 'dates', '_codes_by_date')
+
+    route_ids: array
+    user_ids: array
+    texts: List[str]
+    date_codes: array
+    dates: List[Optional[datetime]]
+
+    def __init__(self):
+        self.route_ids = array('q')
+        self.user_ids = array('q')
+        self.texts = []
+        self.date_codes = array('I')
+        self.dates = []
+        self._codes_by_date: Dict[Optional[datetime], int] = {}
+
+    def append(self, route_id: int, user_id: int, text: str, date: Optional[datetime]):
+        code = self._codes_by_date.get(date)
+        if code is None:
+            code = self._codes_by_date[date] = len(self.dates)
+            self.dates.append(date)
+
+        self.route_ids.append(route_id)
+        self.user_ids.append(user_id)
+        # Most texts are empty or a handful of stock phrases
+        self.texts.append(sys.intern(text))
+        self.date_codes.append(code)
+
+    def append_tick(self, tick: RouteTick):
+        self.append(tick.route_id, tick.user_id, tick.text, tick.date)
+
+    def rows(self) -> Iterator[Tuple[int, int, str, Optional[str]]]:
+        '''
+        (route_id, user_id, text, ISO date) tuples, as stored in the ticks table.
+        '''
+
+        isodates = [date.isoformat() if date is not None else None for date in self.dates]
+        return zip(self.route_ids, self.user_ids, self.texts,
+                   map(isodates.__getitem__, self.date_codes))
+
+    def __len__(self) -> int:
+        return len(self.route_ids)
+
+    def __iter__(self) -> Iterator[RouteTick]:
+        return map(RouteTick, self.route_ids, self.user_ids, self.texts,
+                   map(self.dates.__getitem__, self.date_codes))
+
+
+class ReviewBatch:
+    '''
+    Columnar RouteReviews. Iterating yields RouteReviews.
+    '''
+
+    __slots__ = ('route_ids', 'user_ids', 'scores')
+
+    route_ids: array
+    user_ids: array
+    scores: array
+
+    def __init__(self):
+        self.route_ids = array('q')
+        self.user_ids = array('q')
+        self.scores = array('b')
+
+    def append(self, route_id: int, user_id: int, score: int):
+        # Check before appending anything, so the columns stay aligned
+        if not SCORE_MIN <= score <= SCORE_MAX:
+            raise OverflowError('Score %d does not fit a ReviewBatch' % score)
+
+        self.route_ids.append(route_id)
+        self.user_ids.append(user_id)
+        self.scores.append(score)
+
+    def append_review(self, review: RouteReview):
+        self.append(review.route_id, review.user_id, review.score)
+
+    def rows(self) -> Iterator[Tuple[int, int, int]]:
+        return zip(self.route_ids, self.user_ids, self.scores)
+
+    def __len__(self) -> int:
+        return len(self.route_ids)
+
+    def __iter__(self) -> Iterator[RouteReview]:
+        return map(RouteReview, self.route_ids, self.user_ids, self.scores)
@@ -5,94 +5,224 @@ command line argument, or populate mydatabase.db if no arg is given.
 Usage with compressed data (default to mydatabase.db):
 bzcat data.bz2 | python3 populator.py
 
-Expects the sqlite database to support the following tables:
-CREATE TABLE areas (
-id INTEGER PRIMARY KEY,
-name TEXT NOT NULL,
-latitude DECIMAL(3,5) NOT NULL,
-longitude DECIMAL(3,5) NOT NULL,
-parent_id INTEGER);
-
-CREATE TABLE ratings (
-route_id INTEGER NOT NULL,
-user_id INTEGER NOT NULL,
-rating TEXT NOT NULL,
-FOREIGN KEY (route_id) REFERENCES routes (id)
-);
-
-CREATE TABLE reviews (
-route_id INTEGER NOT NULL,
-user_id INTEGER NOT NULL,
-score INTEGER NOT NULL,
-FOREIGN KEY (route_id) REFERENCES routes (id)
-);
-
-CREATE TABLE routes (
-id INTEGER PRIMARY KEY,
-name TEXT NOT NULL,
-area_id INTEGER);
-
-CREATE TABLE ticks (
-route_id INTEGER NOT NULL,
-user_id INTEGER NOT NULL,
-`text` TEXT NOT NULL,
-`date` TEXT NOT NULL,
-FOREIGN KEY (route_id) REFERENCES routes (id)
-);
+Or read the file directly, bz2, gzip and xz being picked by extension. bz2
+files are decompressed on every core with --jobs 0, and a large uncompressed
+file is decoded on every core:
+python3 populator.py mydatabase.db --input data.jsonl.bz2 --jobs 0
+
+Add --bulk for a much faster load of a full scrape into a fresh database. It
+inserts in batches, relaxes journaling and syncing for the duration of the
+load, rebuilds indexes once at the end, and reports rows/s per table.
+
+Add --upsert to load an overlapping dump, e.g. a nightly --since crawl, into
+an existing database. Rows are matched on their natural keys (see
+schema.NATURAL_KEYS): new rows are inserted, changed rows updated and unchanged rows
+left alone, so loading the same dump twice changes nothing. A rating row is
+deleted when its user's ratings for the route no longer include it. Existing
+duplicates are removed, keeping the last loaded, when the unique indexes are
+first created.
+
+The area_id backfill for routes crawled without one fetches route pages
+concurrently and stores their areas as they arrive. It only visits routes
+whose area_id is still 0 or NULL, so an interrupted backfill is resumed by
+running it again:
+python3 populator.py mydatabase.db --backfill-area-ids
+
+scraper.py --database loads a crawl as it runs, without an intermediate
+file, through the DatabaseWriter below.
+
+The database is created, or migrated to the current schema with its indexes,
+by schema.py before loading.
 '''
 
-import re
+import argparse
+import json
+import queue
 import sqlite3
 import sys
+import threading
+import time
 from collections import defaultdict
+from functools import partial
 from sqlite3 import Connection, Cursor
-from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
-from typing import Generator, Union
+from typing import Dict, Generator, Iterable, List, Optional, Tuple, Union
 
-from fetcher import get_area_id_from_route_id
-from model import Area, Route, RouteRating, RouteReview, RouteTick
-from serializer import from_jsonl
+from fetcher import (DEFAULT_HTML_MAX_CONCURRENCY, configure_scheduler,
+                     get_area_id_from_route_id, make_scheduler)
+from model import Area, ReviewBatch, Route, RouteRating, RouteReview, RouteTick, TickBatch
+from schema import ensure_natural_keys, migrate
+from serializer import from_jsonl_batches, from_jsonl_file
 
 DEFAULT_DATABASE_FILE_NAME = 'databasev2.db'
 
 
+INSERT_STATEMENTS = {
+    'areas': 'INSERT INTO areas (id, name, latitude, longitude, parent_id) VALUES (?, ?, ?, ?, ?)',
+    'routes': 'INSERT INTO routes (id, name, area_id) VALUES (?, ?, ?)',
+    'ratings': 'INSERT INTO ratings (route_id, user_id, rating) VALUES (?, ?, ?)',
+    'ticks': 'INSERT INTO ticks (route_id, user_id, `text`, `date`) VALUES (?, ?, ?, ?)',
+    'reviews': 'INSERT INTO reviews (route_id, user_id, score) VALUES (?, ?, ?)',
+}
+
+# Inserts that update a matching row instead, if anything changed. A route
+# crawled without an area keeps the one it has.
+UPSERT_STATEMENTS = {
+    'areas': INSERT_STATEMENTS['areas'] + (
+        ' ON CONFLICT (id) DO UPDATE SET name = excluded.name, latitude = excluded.latitude,'
+        ' longitude = excluded.longitude, parent_id = excluded.parent_id'
+        ' WHERE (name, latitude, longitude, parent_id)'
+        ' IS NOT (excluded.name, excluded.latitude, excluded.longitude, excluded.parent_id)'),
+    'routes': INSERT_STATEMENTS['routes'] + (
+        ' ON CONFLICT (id) DO UPDATE SET name = excluded.name,'
+        ' area_id = coalesce(nullif(excluded.area_id, 0), area_id)'
+        ' WHERE (name, area_id)'
+        ' IS NOT (excluded.name, coalesce(nullif(excluded.area_id, 0), area_id))'),
+    'ratings': INSERT_STATEMENTS['ratings'] + ' ON CONFLICT DO NOTHING',
+    'ticks': INSERT_STATEMENTS['ticks'] + (
+        ' ON CONFLICT (route_id, user_id, ifnull(`date`, `text`))'
+        ' DO UPDATE SET `text` = excluded.`text`'
+        ' WHERE `text` IS NOT excluded.`text`'),
+    'reviews': INSERT_STATEMENTS['reviews'] + (
+        ' ON CONFLICT (route_id, user_id) DO UPDATE SET score = excluded.score'
+        ' WHERE score IS NOT excluded.score'),
+}
+
+# Deletes the ratings of a route and user that are not in the json list given
+STALE_RATINGS_STATEMENT = ('DELETE FROM ratings WHERE route_id = ? AND user_id = ?'
+                           ' AND rating NOT IN (SELECT value FROM json_each(?))')
+
+# Rows per executemany in bulk loads
+DEFAULT_BULK_BATCH_ROWS = 50_000
+# Seconds between bulk load progress reports
+BULK_REPORT_INTERVAL_SECONDS = 10
+# Entities a DatabaseWriter holds before put() blocks, and how often it commits
+DEFAULT_LIVE_QUEUE_SIZE = 10_000
+DEFAULT_LIVE_COMMIT_ROWS = 10_000
+DEFAULT_LIVE_COMMIT_INTERVAL_SECONDS = 1.0
+# Area ids stored per UPDATE batch and transaction in the area_id backfill,
+# which also commits at least every BACKFILL_COMMIT_INTERVAL_SECONDS
+DEFAULT_BACKFILL_BATCH_ROWS = 500
+BACKFILL_COMMIT_INTERVAL_SECONDS = 5
+BACKFILL_REPORT_INTERVAL_SECONDS = 10
+ROUTES_WITHOUT_AREA_QUERY = 'SELECT id, name FROM routes WHERE area_id = 0 OR area_id IS NULL'
+# Settings for the duration of a bulk load. A crash mid-load can corrupt the
+# database, which is acceptable for a load that can simply be rerun. The
+# journal stays in memory rather than off, since failed batches are rolled
+# back to a savepoint.
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'temp_store': 'MEMORY',
+    # Negative sizes are in KiB
+    'cache_size': -512 * 1024,
+}
+
+
 def connect(file_name: str) -> Connection:
     return sqlite3.connect(file_name)
 
 
-def insert_entity(cursor: Cursor, item: Union[Route, RouteRating, RouteTick]):
+def entity_rows(item: Union[Area, Route, RouteRating, RouteReview, RouteTick,
+                            TickBatch, ReviewBatch]) -> Tuple[str, Iterable[tuple]]:
+    '''
+    Return the table an entity is stored in and its rows there.
+    '''
+
     match item:
         case Route(rid, rname, area_id):
-            cursor.execute('INSERT INTO routes (id, name, area_id) VALUES (?, ?, ?)',
-                           [rid, rname, area_id])
+            return 'routes', [(rid, rname, area_id)]
         case RouteRating(rid, uid, [*ratings]):
-            for rating in ratings:
-                cursor.execute('INSERT INTO ratings (route_id, user_id, rating) VALUES (?, ?, ?)',
-                               [rid, uid, rating])
+            return 'ratings', [(rid, uid, rating) for rating in ratings]
         case RouteTick(rid, uid, text, date):
-            cursor.execute('INSERT INTO ticks (route_id, user_id, `text`, `date`) VALUES (?, ?, ?, ?)',
-                           [rid, uid, text, date.isoformat()])
+            return 'ticks', [(rid, uid, text, date.isoformat() if date is not None else None)]
         case RouteReview(rid, uid, score):
-            cursor.execute('INSERT INTO reviews (route_id, user_id, score) VALUES (?, ?, ?)',
-                           [rid, uid, score])
+            return 'reviews', [(rid, uid, score)]
+        case TickBatch():
+            return 'ticks', item.rows()
+        case ReviewBatch():
+            return 'reviews', item.rows()
         case Area(aid, aname, lat, long, chain):
-            cursor.execute('INSERT INTO areas (id, name, latitude, longitude, parent_id) VALUES (?, ?, ?, ?, ?)',
-                           [aid, aname, lat, long, chain[1]])
+            return 'areas', [(aid, aname, lat, long, chain[1])]
+
+    raise TypeError('Cannot store %s' % type(item))
+
 
+def insert_entity(cursor: Cursor, item: Union[Area, Route, RouteRating, RouteReview, RouteTick,
+                                              TickBatch, ReviewBatch],
+                  upsert: bool = False):
+    table, rows = entity_rows(item)
+    if upsert and isinstance(item, RouteRating):
+        cursor.execute(STALE_RATINGS_STATEMENT,
+                       (item.route_id, item.user_id, json.dumps(item.ratings)))
 
-def populate_db():
-    file_name = (DEFAULT_DATABASE_FILE_NAME
-                 if len(sys.argv) == 1
-                 else sys.argv[1])
+    cursor.executemany((UPSERT_STATEMENTS if upsert else INSERT_STATEMENTS)[table], rows)
+
+
+def insert_one_by_one(cursor: Cursor, statement: str, rows: Iterable[tuple],
+                      instances_by_exception: Dict[str, int]) -> int:
+    '''
+    Execute statement for each row, reporting and skipping the rows that
+    fail. Return the number of rows changed.
+    '''
+
+    changed = 0
+    for row in rows:
+        try:
+            cursor.execute(statement, row)
+            changed += cursor.rowcount
+        except sqlite3.IntegrityError as e:
+            instances_by_exception['sqlite3.IntegrityError'] += 1
+            print(e, file=sys.stderr)
+        except Exception as e:
+            instances_by_exception['unknown'] += 1
+            print(e, file=sys.stderr)
+
+    return changed
+
+
+def insert_batch(cursor: Cursor, batch: Union[TickBatch, ReviewBatch], upsert: bool,
+                 instances_by_exception: Dict[str, int]):
+    '''
+    Insert the rows of a batch with one executemany. If that fails, roll it
+    back and insert them one by one, so that only the bad rows are skipped.
+    '''
+
+    table, rows = entity_rows(batch)
+    statement = (UPSERT_STATEMENTS if upsert else INSERT_STATEMENTS)[table]
+    rows = list(rows)
+    if not cursor.connection.in_transaction:
+        # Releasing a savepoint outside a transaction would commit
+        cursor.execute('BEGIN')
+    cursor.execute('SAVEPOINT batch')
+    try:
+        cursor.executemany(statement, rows)
+    except sqlite3.Error:
+        cursor.execute('ROLLBACK TO batch')
+        insert_one_by_one(cursor, statement, rows, instances_by_exception)
+    cursor.execute('RELEASE batch')
+
+
+def populate_db(file_name: str, entities: Iterable[
+  Union[Area, Route, RouteRating, RouteReview, RouteTick, TickBatch, ReviewBatch]],
+                upsert: bool = False):
+    '''
+    Insert entities one by one, or upsert them on their natural keys if
+    upsert is set, see the module docstring.
+    '''
 
     conn = connect(file_name)
+    if upsert:
+        ensure_natural_keys(conn)
+        conn.commit()
+    changes_before = conn.total_changes
     cursor = conn.cursor()
 
     instances_by_exception = defaultdict(int)
     route_counter = 0
 
-    for i, entity in enumerate(from_jsonl(sys.stdin)):
+    for i, entity in enumerate(entities):
         if route_counter % 10_000 == 0 or i % 100_000 == 0:
             print('[%d:%d] %s' % (route_counter, i, type(entity)),
                   file=sys.stderr)
@@ -101,7 +231,10 @@ def populate_db():
             route_counter += 1
 
         try:
-            insert_entity(cursor, entity)
+            if isinstance(entity, (TickBatch, ReviewBatch)):
+                insert_batch(cursor, entity, upsert, instances_by_exception)
+            else:
+                insert_entity(cursor, entity, upsert)
         except sqlite3.IntegrityError as e:
             instances_by_exception['sqlite3.IntegrityError'] += 1
             print(e, file=sys.stderr)
@@ -111,61 +244,439 @@ def populate_db():
 
     print('Completed with exceptions %s' % instances_by_exception,
           file=sys.stderr)
+    if upsert:
+        print('Inserted, updated or deleted %d rows' % (conn.total_changes - changes_before),
+              file=sys.stderr)
 
     conn.commit()
     conn.close()
 
 
-def print_route_with_area_id(row: int) -> None:
-    route_id, route_name = row
-    area_id = get_area_id_from_route_id(route_id, route_name, False)
-
-    print(route_id, area_id, flush=True)
-    print(route_id, area_id, file=sys.stderr)
-
-    return (route_id, area_id)
+class BulkLoader:
+    '''
+    Buffers rows per table and inserts them with executemany, batch_size rows
+    at a time. A batch that fails is rolled back to a savepoint and inserted
+    row by row, so that the bad rows are reported and skipped exactly as
+    populate_db() would.
+
+    With upsert, rows are upserted as in populate_db(), and rows_by_table
+    counts the rows actually inserted, updated or deleted. Ratings are
+    buffered per route and user, the last list of a batch replacing the
+    earlier ones.
+
+    Batches are inserted in a transaction that is left open: nothing is
+    committed until the caller commits the connection.
+    '''
+
+    conn: Connection
+    batch_size: int
+    upsert: bool
+    instances_by_exception: Dict[str, int]
+    rows_by_table: Dict[str, int]
+    seconds_by_table: Dict[str, float]
+
+    def __init__(self, conn: Connection, batch_size: int = DEFAULT_BULK_BATCH_ROWS,
+                 upsert: bool = False):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self._statements = UPSERT_STATEMENTS if upsert else INSERT_STATEMENTS
+        self._ratings: Dict[Tuple[int, int], List[str]] = {}
+        self.instances_by_exception = defaultdict(int)
+        self.rows_by_table = defaultdict(int)
+        self.seconds_by_table = defaultdict(float)
+        self._buffers: Dict[str, List[tuple]] = defaultdict(list)
+
+    def add(self, item: Union[Area, Route, RouteRating, RouteReview, RouteTick,
+                              TickBatch, ReviewBatch]):
+        if self.upsert and isinstance(item, RouteRating):
+            self._ratings[(item.route_id, item.user_id)] = item.ratings
+            if len(self._ratings) >= self.batch_size:
+                self._flush_ratings()
+            return
+
+        table, rows = entity_rows(item)
+        buffer = self._buffers[table]
+        buffer.extend(rows)
+        if len(buffer) >= self.batch_size:
+            self._flush(table)
+
+    def _flush(self, table: str):
+        rows = self._buffers.pop(table, [])
+        if not rows:
+            return
+
+        started = time.perf_counter()
+        cursor = self.conn.cursor()
+        if not self.conn.in_transaction:
+            # Releasing a savepoint outside a transaction would commit
+            cursor.execute('BEGIN')
+        cursor.execute('SAVEPOINT bulk_batch')
+        try:
+            cursor.executemany(self._statements[table], rows)
+            inserted = cursor.rowcount if self.upsert else len(rows)
+        except sqlite3.Error:
+            cursor.execute('ROLLBACK TO bulk_batch')
+            inserted = insert_one_by_one(cursor, self._statements[table], rows,
+                                         self.instances_by_exception)
+        cursor.execute('RELEASE bulk_batch')
+
+        self.rows_by_table[table] += inserted
+        self.seconds_by_table[table] += time.perf_counter() - started
+
+    def _flush_ratings(self):
+        ratings = self._ratings
+        self._ratings = {}
+        if not ratings:
+            return
+
+        started = time.perf_counter()
+        cursor = self.conn.cursor()
+        cursor.executemany(STALE_RATINGS_STATEMENT,
+                           [(route_id, user_id, json.dumps(user_ratings))
+                            for (route_id, user_id), user_ratings in ratings.items()])
+        self.rows_by_table['ratings'] += cursor.rowcount
+        self.seconds_by_table['ratings'] += time.perf_counter() - started
+
+        self._buffers['ratings'].extend(
+            (route_id, user_id, rating)
+            for (route_id, user_id), user_ratings in ratings.items()
+            for rating in user_ratings)
+        self._flush('ratings')
+
+    def flush(self):
+        self._flush_ratings()
+        for table in list(self._buffers):
+            self._flush(table)
+
+    def report(self, elapsed: float):
+        for table, rows in sorted(self.rows_by_table.items()):
+            print('%-8s %12d rows %10.0f rows/s inserting, %10.0f rows/s overall'
+                  % (table, rows, rows / max(self.seconds_by_table[table], 1e-9),
+                     rows / max(elapsed, 1e-9)),
+                  file=sys.stderr)
 
 
-def get_area_ids():
-    file_name = (DEFAULT_DATABASE_FILE_NAME
-                 if len(sys.argv) == 1
-                 else sys.argv[1])
+def _drop_indexes(conn: Connection) -> List[str]:
+    '''
+    Drop the explicitly created indexes on the loaded tables and return the
+    statements that recreate them, which do nothing for an index that exists.
+    Indexes backing PRIMARY KEY and UNIQUE constraints cannot be dropped, and
+    unique indexes such as the natural key ones must keep rejecting
+    duplicates, so both are kept.
+    '''
+
+    indexes = conn.execute(
+        'SELECT name, sql FROM sqlite_master WHERE type = \'index\' AND sql IS NOT NULL '
+        'AND sql NOT LIKE \'CREATE UNIQUE %%\' '
+        'AND tbl_name IN (%s)' % ', '.join('?' * len(INSERT_STATEMENTS)),
+        list(INSERT_STATEMENTS)).fetchall()
+    for name, _ in indexes:
+        conn.execute('DROP INDEX "%s"' % name.replace('"', '""'))
+
+    # SQLite stores the statements without IF NOT EXISTS
+    return [sql.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1) for _, sql in indexes]
+
+
+def bulk_load_db(file_name: str, entities: Iterable[
+  Union[Area, Route, RouteRating, RouteReview, RouteTick, TickBatch, ReviewBatch]],
+                 batch_size: int = DEFAULT_BULK_BATCH_ROWS, upsert: bool = False):
+    '''
+    Load entities like populate_db(), many times faster: rows are inserted in
+    batches, journaling and syncing are off for the duration of the load, and
+    indexes are dropped before the load and rebuilt once after it, even if
+    the load fails.
+    '''
 
     conn = connect(file_name)
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT id, name FROM routes WHERE area_id = 0 OR area_id IS NULL;')
-    route_ids = cursor.fetchall()
-
-    with Pool(4) as pool:
-        pool.map(print_route_with_area_id, route_ids)
+    if upsert:
+        ensure_natural_keys(conn)
+        conn.commit()
+    previous_pragmas = {pragma: conn.execute('PRAGMA %s' % pragma).fetchone()[0]
+                        for pragma in BULK_LOAD_PRAGMAS}
+    for pragma, value in BULK_LOAD_PRAGMAS.items():
+        conn.execute('PRAGMA %s = %s' % (pragma, value))
+
+    started = time.perf_counter()
+    # Dropping an index commits, so they are rebuilt whatever happens next
+    index_statements = _drop_indexes(conn)
+    loader = BulkLoader(conn, batch_size, upsert)
+    last_report = started
+    try:
+        for entity in entities:
+            try:
+                loader.add(entity)
+            except Exception as e:
+                loader.instances_by_exception['unknown'] += 1
+                print(e, file=sys.stderr)
+
+            if time.perf_counter() - last_report >= BULK_REPORT_INTERVAL_SECONDS:
+                last_report = time.perf_counter()
+                loader.report(last_report - started)
+
+        loader.flush()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        try:
+            index_started = time.perf_counter()
+            for statement in index_statements:
+                conn.execute(statement)
+            conn.commit()
+            if index_statements:
+                print('Rebuilt %d indexes in %.1fs' % (len(index_statements),
+                                                       time.perf_counter() - index_started),
+                      file=sys.stderr)
+        finally:
+            for pragma, value in previous_pragmas.items():
+                conn.execute('PRAGMA %s = %s' % (pragma, value))
+            conn.close()
+
+    loader.report(time.perf_counter() - started)
+    print('Completed with exceptions %s' % dict(loader.instances_by_exception),
+          file=sys.stderr)
 
 
-def update_area_ids():
-    file_name = (DEFAULT_DATABASE_FILE_NAME
-                 if len(sys.argv) == 1
-                 else sys.argv[1])
+# What DatabaseWriter's thread gets instead of an entity when a commit is due
+_COMMIT_DUE = object()
+
+
+class DatabaseWriter:
+    '''
+    Loads entities into a database on a thread of its own, for a crawl that
+    writes straight into the database. Entities are upserted in batches
+    through a BulkLoader, and committed every commit_rows entities or
+    commit_interval seconds after the first uncommitted one, whichever comes
+    first. The queue from the crawl holds at most queue_size entities, and
+    put() blocks while it is full, which slows the crawl down to the pace of
+    the database.
+
+    committed is the number of entities put() so far that are committed. An
+    error on the writer thread, including an entity that cannot be stored, is
+    raised by the next put() or close(), and nothing after the last commit is
+    committed.
+    '''
+
+    committed: int
+
+    def __init__(self, file_name: str, queue_size: int = DEFAULT_LIVE_QUEUE_SIZE,
+                 commit_rows: int = DEFAULT_LIVE_COMMIT_ROWS,
+                 commit_interval: float = DEFAULT_LIVE_COMMIT_INTERVAL_SECONDS):
+        migrate(file_name)
+        self.committed = 0
+        self._queue = queue.Queue(queue_size)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run,
+                                        args=(file_name, commit_rows, commit_interval),
+                                        name='DatabaseWriter', daemon=True)
+        self._thread.start()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError('Writing to the database failed') from self._error
+
+    def put(self, entity: Optional[Union[Area, Route, RouteRating, RouteReview, RouteTick]]):
+        while True:
+            self._raise_error()
+            try:
+                # Time out now and then, to notice a writer that died
+                self._queue.put(entity, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def close(self):
+        '''
+        Commit everything put so far and stop the writer thread.
+        '''
+
+        if self._thread.is_alive():
+            self.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _run(self, file_name: str, commit_rows: int, commit_interval: float):
+        try:
+            conn = connect(file_name)
+        except BaseException as e:
+            self._error = e
+            return
+
+        started = time.perf_counter()
+        loader = BulkLoader(conn, commit_rows, upsert=True)
+        consumed = 0
+        deadline = None
+        try:
+            while True:
+                try:
+                    entity = self._queue.get(
+                        timeout=None if deadline is None
+                        else max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    entity = _COMMIT_DUE
+
+                if entity is None:
+                    break
+
+                if entity is not _COMMIT_DUE:
+                    # An entity that cannot be stored stops the writer, so that
+                    # it is never counted as committed
+                    loader.add(entity)
+                    consumed += 1
+                    if deadline is None:
+                        deadline = time.monotonic() + commit_interval
+
+                if deadline is not None and (consumed - self.committed >= commit_rows
+                                             or time.monotonic() >= deadline):
+                    loader.flush()
+                    conn.commit()
+                    self.committed = consumed
+                    deadline = None
+
+            loader.flush()
+            conn.commit()
+            self.committed = consumed
+        except BaseException as e:
+            self._error = e
+            return
+        finally:
+            conn.close()
+
+        loader.report(time.perf_counter() - started)
+        print('Completed with exceptions %s' % dict(loader.instances_by_exception),
+              file=sys.stderr)
+
+
+def fetch_route_area_id(route: Tuple[int, str]) -> Tuple[int, int]:
+    route_id, route_name = route
+    return route_id, get_area_id_from_route_id(route_id, route_name, False)
+
+
+class BackfillProgress:
+    '''
+    Counts of an area_id backfill, for its progress reports.
+    '''
+
+    total: int
+    done: int
+    updated: int
+    failed: int
+    started: float
+
+    def __init__(self, total: int):
+        self.total = total
+        self.done = 0
+        self.updated = 0
+        self.failed = 0
+        self.started = time.perf_counter()
+
+    def report(self):
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        rate = self.done / elapsed
+        remaining = (self.total - self.done) / rate if rate > 0 else float('inf')
+        print('%d/%d routes (%.1f%%), %d updated, %d without an area, %.1f routes/s, '
+              '%.0fs left'
+              % (self.done, self.total, 100 * self.done / max(self.total, 1), self.updated,
+                 self.failed, rate, remaining),
+              file=sys.stderr)
+
+
+def backfill_area_ids(file_name: str, threads: int = DEFAULT_HTML_MAX_CONCURRENCY,
+                      batch_size: int = DEFAULT_BACKFILL_BATCH_ROWS) -> BackfillProgress:
+    '''
+    Fetch the area of every route without one from its route page, on threads
+    threads, and store the areas with batched UPDATEs as they arrive. A batch
+    is committed every batch_size routes or BACKFILL_COMMIT_INTERVAL_SECONDS,
+    and on the way out of an interrupted backfill. Routes whose page yields no
+    area keep area_id 0, and are retried by the next backfill.
+    '''
 
     conn = connect(file_name)
-    cursor = conn.cursor()
-
-    pattern = re.compile(r'(\d+) (\d+)')
-    stdin = sys.stdin.read()
-    pairs = pattern.findall(stdin)
-
-    i = 0
-    for rid, aid in [map(int, x) for x in pairs]:
-        print(rid, aid)
-        cursor.execute('UPDATE routes SET area_id = ? WHERE id = ?',
-                       [aid, rid])
+    routes = conn.execute(ROUTES_WITHOUT_AREA_QUERY).fetchall()
+    progress = BackfillProgress(len(routes))
+    print('Backfilling the area_id of %d routes' % len(routes), file=sys.stderr)
+
+    # The requests are paced by the adaptive scheduler, so use enough threads
+    # for it to ramp up to its concurrency limit
+    configure_scheduler(make_scheduler())
+
+    batch: List[Tuple[int, int]] = []
+    last_commit = last_report = time.perf_counter()
+    try:
+        with ThreadPool(threads) as pool:
+            for route_id, area_id in pool.imap_unordered(fetch_route_area_id, routes):
+                progress.done += 1
+                if area_id:
+                    batch.append((area_id, route_id))
+                else:
+                    progress.failed += 1
+
+                now = time.perf_counter()
+                if (len(batch) >= batch_size
+                        or now - last_commit >= BACKFILL_COMMIT_INTERVAL_SECONDS):
+                    _update_area_ids(conn, batch)
+                    progress.updated += len(batch)
+                    batch = []
+                    last_commit = now
+
+                if now - last_report >= BACKFILL_REPORT_INTERVAL_SECONDS:
+                    progress.report()
+                    last_report = now
+    finally:
+        _update_area_ids(conn, batch)
+        progress.updated += len(batch)
+        conn.close()
+        progress.report()
+
+    return progress
+
+
+def _update_area_ids(conn: Connection, batch: List[Tuple[int, int]]):
+    conn.executemany('UPDATE routes SET area_id = ? WHERE id = ?', batch)
+    conn.commit()
 
-        i += 1
 
-        if i % 1_000 == 0:
-            print(i)
-            conn.commit()
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database', nargs='?', default=DEFAULT_DATABASE_FILE_NAME)
+    parser.add_argument('--input', default=None,
+                        help='Read this scraper.py output file instead of stdin, '
+                             'decompressing .bz2, .gz and .xz files')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Processes decoding --input, or threads decompressing it if '
+                             'it is bz2, 0 for one per core')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Load in batches with journaling and syncing relaxed, and '
+                             'rebuild indexes after the load')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BULK_BATCH_ROWS,
+                        help='Rows per insert batch with --bulk')
+    parser.add_argument('--upsert', action='store_true',
+                        help='Insert new rows and update changed ones, matching rows on '
+                             'their natural keys, instead of inserting every row')
+    parser.add_argument('--backfill-area-ids', action='store_true',
+                        help='Fetch and store the area_id of the routes without one, '
+                             'instead of loading')
+    parser.add_argument('--threads', type=int, default=DEFAULT_HTML_MAX_CONCURRENCY,
+                        help='Route pages fetched at once with --backfill-area-ids')
+    args = parser.parse_args()
+
+    migrate(args.database)
+    if args.backfill_area_ids:
+        backfill_area_ids(args.database, args.threads)
+    else:
+        load = (partial(bulk_load_db, batch_size=args.batch_size, upsert=args.upsert)
+                if args.bulk
+                else partial(populate_db, upsert=args.upsert))
+        if args.input is not None:
+            load(args.database, from_jsonl_file(args.input, args.jobs or None, batched=True))
+        else:
+            load(args.database, from_jsonl_batches(sys.stdin.buffer))
 
 
 if __name__ == '__main__':
-    # get_area_ids()
-    update_area_ids()
+    main()
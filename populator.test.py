@@ -0,0 +1,233 @@
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+from datetime import datetime
+from functools import partial
+from unittest import mock
+
+from model import Area, Route, RouteRating, RouteReview, RouteTick, TickBatch
+from populator import BulkLoader, DatabaseWriter, backfill_area_ids, bulk_load_db, populate_db
+from schema import migrate
+
+ENTITIES = [
+    Area(1, 'Area', 40.0, -105.0, [1, 0]),
+    Route(10, 'Route', 1),
+    RouteRating(10, 7, ['5.10a', 'PG13']),
+    RouteTick(10, 7, 'Sent', datetime(2020, 5, 1)),
+    RouteReview(10, 7, 4),
+    Route(10, 'Duplicate', 1),
+    Route(11, 'Other', 1),
+    RouteReview(11, 8, 3),
+]
+
+
+class BulkLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create(self, name):
+        path = os.path.join(self.directory.name, name)
+        with redirect_stderr(io.StringIO()):
+            migrate(path)
+        return path
+
+    def dump(self, path):
+        conn = sqlite3.connect(path)
+        tables = {table: conn.execute('SELECT * FROM %s ORDER BY 1, 2, 3' % table).fetchall()
+                  for table in ('areas', 'routes', 'ratings', 'ticks', 'reviews')}
+        indexes = conn.execute('SELECT name FROM sqlite_master WHERE type = \'index\' '
+                               'ORDER BY name').fetchall()
+        conn.close()
+        return tables, indexes
+
+    def test_same_rows_as_populate_db(self):
+        expected = self.create('expected.db')
+        actual = self.create('actual.db')
+        with redirect_stderr(io.StringIO()):
+            populate_db(expected, ENTITIES)
+            # A batch of 2 makes the duplicate route fail a batch, which must
+            # be retried row by row
+            bulk_load_db(actual, ENTITIES, batch_size=2)
+
+        self.assertEqual(self.dump(expected), self.dump(actual))
+        self.assertEqual('Route', self.dump(actual)[0]['routes'][0][1])
+
+    def test_failed_load_keeps_the_indexes(self):
+        path = self.create('test.db')
+        before = self.dump(path)[1]
+
+        def entities():
+            yield from ENTITIES[:3]
+            raise KeyboardInterrupt
+
+        with redirect_stderr(io.StringIO()), self.assertRaises(KeyboardInterrupt):
+            bulk_load_db(path, entities(), batch_size=1)
+
+        self.assertIn(('reviews_by_user',), before)
+        self.assertEqual(before, self.dump(path)[1])
+
+    def test_duplicate_in_a_batch_skips_only_that_row(self):
+        ticks = TickBatch()
+        for day in range(1, 13):
+            # The second tick repeats the first
+            ticks.append(10, 7, 'Tick %d' % day, datetime(2020, 5, max(day - 1, 1)))
+
+        for name, load in (('populate.db', populate_db),
+                           ('bulk.db', partial(bulk_load_db, batch_size=100))):
+            path = self.create(name)
+            log = io.StringIO()
+            with redirect_stderr(log):
+                load(path, [Route(10, 'Route', 1), ticks])
+
+            tables = self.dump(path)[0]
+            self.assertEqual(11, len(tables['ticks']), name)
+            self.assertNotIn((10, 7, 'Tick 2', '2020-05-01T00:00:00'), tables['ticks'], name)
+            self.assertIn("'sqlite3.IntegrityError': 1", log.getvalue(), name)
+
+    def test_upsert_is_idempotent(self):
+        delta = [
+            Route(10, 'Renamed', 0),
+            RouteRating(10, 7, ['5.10b', 'PG13']),
+            RouteTick(10, 7, 'Fell', datetime(2020, 5, 1)),
+            RouteTick(10, 7, 'Sent', datetime(2020, 6, 1)),
+            # Ticks whose date could not be parsed
+            RouteTick(10, 7, 'Undated', None),
+            RouteTick(10, 7, 'Also undated', None),
+            RouteReview(10, 7, 4),
+            RouteReview(11, 8, 1),
+        ]
+        expected = {
+            'areas': [(1, 'Area', 40, -105, 0)],
+            'routes': [(10, 'Renamed', 1), (11, 'Other', 1)],
+            'ratings': [(10, 7, '5.10b'), (10, 7, 'PG13')],
+            'ticks': [(10, 7, 'Also undated', None),
+                      (10, 7, 'Fell', '2020-05-01T00:00:00'),
+                      (10, 7, 'Sent', '2020-06-01T00:00:00'),
+                      (10, 7, 'Undated', None)],
+            'reviews': [(10, 7, 4), (11, 8, 1)],
+        }
+
+        for name, load in (('populate.db', populate_db),
+                           ('bulk.db', partial(bulk_load_db, batch_size=2))):
+            path = self.create(name)
+            with redirect_stderr(io.StringIO()):
+                for entities in (ENTITIES, ENTITIES, delta, delta):
+                    load(path, entities, upsert=True)
+
+            self.assertEqual(expected, self.dump(path)[0], name)
+
+    def test_upsert_removes_existing_duplicates(self):
+        path = self.create('legacy.db')
+        conn = sqlite3.connect(path)
+        conn.execute('DROP INDEX reviews_natural_key')
+        conn.executemany('INSERT INTO reviews VALUES (?, ?, ?)', [(10, 7, 4), (10, 7, 2)])
+        conn.commit()
+        conn.close()
+
+        with redirect_stderr(io.StringIO()):
+            populate_db(path, [RouteReview(11, 8, 3)], upsert=True)
+
+        self.assertEqual([(10, 7, 2), (11, 8, 3)], self.dump(path)[0]['reviews'])
+
+    def test_bulk_loader_leaves_committing_to_the_caller(self):
+        path = self.create('test.db')
+        conn = sqlite3.connect(path)
+        loader = BulkLoader(conn, batch_size=1)
+        with redirect_stderr(io.StringIO()):
+            for entity in ENTITIES:
+                loader.add(entity)
+            loader.flush()
+        conn.rollback()
+        conn.close()
+
+        self.assertEqual([], self.dump(path)[0]['routes'])
+
+    def test_database_writer(self):
+        expected = self.create('expected.db')
+        actual = os.path.join(self.directory.name, 'actual.db')
+        with redirect_stderr(io.StringIO()):
+            populate_db(expected, ENTITIES, upsert=True)
+            writer = DatabaseWriter(actual, queue_size=2, commit_rows=3, commit_interval=60)
+            for entity in ENTITIES:
+                writer.put(entity)
+            writer.close()
+
+        self.assertEqual(len(ENTITIES), writer.committed)
+        self.assertEqual(self.dump(expected), self.dump(actual))
+
+    def test_database_writer_error(self):
+        path = self.create('test.db')
+        with mock.patch('populator.BulkLoader.flush', side_effect=sqlite3.OperationalError), \
+                redirect_stderr(io.StringIO()):
+            writer = DatabaseWriter(path, commit_rows=1)
+            writer.put(ENTITIES[0])
+            with self.assertRaises(RuntimeError):
+                writer.close()
+
+    def test_database_writer_unstorable_entity(self):
+        path = self.create('test.db')
+        with redirect_stderr(io.StringIO()):
+            writer = DatabaseWriter(path, commit_rows=1)
+            with self.assertRaises(RuntimeError):
+                writer.put(ENTITIES[0])
+                writer.put('not an entity')
+                writer.put(ENTITIES[1])
+                writer.close()
+
+        # Only the area before it was stored, and nothing after it counts
+        self.assertEqual(1, writer.committed)
+        self.assertEqual([(1, 'Area', 40, -105, 0)], self.dump(path)[0]['areas'])
+        self.assertEqual([], self.dump(path)[0]['routes'])
+
+
+class BackfillAreaIdsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'test.db')
+        with redirect_stderr(io.StringIO()):
+            migrate(self.path)
+        conn = sqlite3.connect(self.path)
+        conn.executemany('INSERT INTO routes VALUES (?, ?, ?)',
+                         [(10, 'a', 0), (11, 'b', None), (12, 'c', 5), (13, 'gone', 0)])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def backfill(self, area_ids):
+        requested = []
+
+        def get_area_id(route_id, route_name, mock_ids):
+            requested.append(route_id)
+            return area_ids.get(route_id, 0)
+
+        with mock.patch('populator.get_area_id_from_route_id', get_area_id), \
+                mock.patch('populator.configure_scheduler'), \
+                redirect_stderr(io.StringIO()):
+            progress = backfill_area_ids(self.path, threads=2, batch_size=1)
+
+        return sorted(requested), progress
+
+    def test_backfill_resumes(self):
+        requested, progress = self.backfill({10: 1})
+        self.assertEqual([10, 11, 13], requested)
+        self.assertEqual((3, 1, 2), (progress.done, progress.updated, progress.failed))
+
+        requested, _ = self.backfill({11: 2})
+        self.assertEqual([11, 13], requested)
+
+        conn = sqlite3.connect(self.path)
+        self.assertEqual([(10, 1), (11, 2), (12, 5), (13, 0)],
+                         conn.execute('SELECT id, area_id FROM routes ORDER BY id').fetchall())
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
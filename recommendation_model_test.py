@@ -7,6 +7,7 @@ from sqlite3 import Cursor
 from typing import Callable, List, Literal, Optional, Union
 
 from collaborative_filtering import get_recommendations_to_list as collab_filtering
+from matrix_factorization import get_factor_recommendations_to_list as matrix_factorization
 
 
 class SourceOfTruth:
@@ -95,6 +96,8 @@ if __name__ == '__main__':
     scorer = TestScorer(source_of_truth)
     algorithms = (
         TestedAlgorithm(scorer, collab_filtering),
+        # Needs a model trained on db_path: python3 matrix_factorization.py db_path
+        TestedAlgorithm(scorer, matrix_factorization),
     )
 
     cursor.execute('''SELECT user_id FROM reviews;''')
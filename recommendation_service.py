@@ -0,0 +1,358 @@
+'''
+recommendation_service.py
+
+A resident recommender: it loads the review matrix of a database once (see
+collaborative_filtering.ReviewMatrix) and answers recommendation requests
+over local HTTP, on a TCP port or a Unix socket, so a request only costs the
+scoring.
+
+Results are kept in an LRU cache bounded both by entry count and by age.
+Before answering, the service reads SQLite's PRAGMA data_version on a
+connection it keeps open, which changes whenever another connection commits
+to the database. The request that notices a change starts reloading the
+matrix on a background thread, and requests, including that one, are
+answered from the matrix already loaded until the new one replaces it (and
+the cache is cleared). A reload that fails is logged and reported by
+/status, and the previous matrix stays in use until the next change. Any
+other failure is answered with a 500 and a JSON error.
+
+API (JSON responses):
+GET /recommendations?userId=ID[&n=300][&threshold=0.3]
+    {"userId": ID, "cached": false,
+     "recommendations": [{"routeId": 0, "predictedScore": 0.0}, ...]}
+GET /status
+    {"users": 0, "routes": 0, "dataVersion": 0, "generation": 1, "cacheEntries": 0,
+     "reloading": false, "loadError": null}
+
+Usage:
+python3 recommendation_service.py DATABASE [--port PORT | --socket PATH]
+'''
+
+import argparse
+import json
+import os
+import socketserver
+import sqlite3
+import stat
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Hashable, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+from collaborative_filtering import ReviewMatrix
+from lsh import LSHIndex
+
+DEFAULT_PORT = 8080
+DEFAULT_CACHE_ENTRIES = 10_000
+DEFAULT_CACHE_TTL_SECONDS = 300.0
+DEFAULT_RECOMMENDATIONS = 300
+DEFAULT_SIMILARITY_THRESHOLD = 0.3
+
+
+class LRUCache:
+    '''
+    Thread-safe cache of at most max_entries values, evicting the least
+    recently used first. A value expires ttl seconds after it was stored.
+    '''
+
+    max_entries: int
+    ttl: float
+
+    def __init__(self, max_entries: int = DEFAULT_CACHE_ENTRIES,
+                 ttl: float = DEFAULT_CACHE_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self._clock() >= entry[0]:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class _Loaded(NamedTuple):
+    reviews: ReviewMatrix
+    neighbour_index: Optional[LSHIndex]
+    # Counts loads, so that results of a previous load are never served
+    generation: int
+
+
+class RecommendationService:
+    '''
+    The loaded matrix and cached results of a database, see the module
+    docstring. With approximate, similar users are found with an
+    lsh.LSHIndex built at each load.
+    '''
+
+    db_path: str
+    approximate: bool
+    cache: LRUCache
+
+    def __init__(self, db_path: str, cache_entries: int = DEFAULT_CACHE_ENTRIES,
+                 cache_ttl: float = DEFAULT_CACHE_TTL_SECONDS, approximate: bool = False):
+        self.db_path = db_path
+        self.approximate = approximate
+        self.cache = LRUCache(cache_entries, cache_ttl)
+        self._conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True,
+                                     check_same_thread=False)
+        self._conn_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._reload_thread: Optional[threading.Thread] = None
+        self._load_error: Optional[str] = None
+        self._loaded: Optional[_Loaded] = None
+        # The version last loaded, or whose load failed
+        self._data_version = self.data_version()
+        # The first load makes the service wait, and fail if it does
+        self._load(self._data_version)
+
+    def data_version(self) -> int:
+        with self._conn_lock:
+            return self._conn.execute('PRAGMA data_version;').fetchone()[0]
+
+    def _load(self, version: int):
+        started = time.perf_counter()
+        reviews = ReviewMatrix.load(self.db_path)
+        neighbour_index = LSHIndex(reviews.matrix) if self.approximate else None
+        generation = self._loaded.generation + 1 if self._loaded is not None else 1
+        self._loaded = _Loaded(reviews, neighbour_index, generation)
+        self.cache.clear()
+        print('Loaded %d users and %d routes of data version %d in %.1fs'
+              % (len(reviews.user_ids), len(reviews.route_ids), version,
+                 time.perf_counter() - started), file=sys.stderr)
+
+    def _reload(self, version: int):
+        try:
+            self._load(version)
+            self._load_error = None
+        except Exception as e:
+            self._load_error = repr(e)
+            print('Reloading data version %d failed, still serving generation %d:'
+                  % (version, self._loaded.generation), file=sys.stderr)
+            traceback.print_exc()
+
+    def reload_if_changed(self, wait: bool = False) -> bool:
+        '''
+        Start reloading the matrix on a background thread if the database
+        changed since the last load, unless a reload is already running. With
+        wait, also wait for the running reload to finish. Return whether a
+        reload was started.
+        '''
+
+        with self._reload_lock:
+            thread = self._reload_thread
+            started = False
+            if thread is None or not thread.is_alive():
+                # Read before loading, so that a commit during the load is seen next time
+                version = self.data_version()
+                if version == self._data_version:
+                    return False
+
+                self._data_version = version
+                thread = self._reload_thread = threading.Thread(
+                    target=self._reload, args=(version,), name='reload', daemon=True)
+                thread.start()
+                started = True
+
+        if wait:
+            thread.join()
+        return started
+
+    def recommend(self, user_id: int, n_recommendations: int = DEFAULT_RECOMMENDATIONS,
+                  similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD
+                  ) -> Tuple[pd.DataFrame, bool]:
+        '''
+        Return collaborative_filtering.get_recommendations() of the loaded
+        matrix, and whether they came from the cache.
+        '''
+
+        self.reload_if_changed()
+        loaded = self._loaded
+        key = (loaded.generation, user_id, n_recommendations, similarity_threshold)
+        recommendations = self.cache.get(key)
+        if recommendations is not None:
+            return recommendations, True
+
+        recommendations = loaded.reviews.recommend(user_id, n_recommendations,
+                                                   similarity_threshold, loaded.neighbour_index)
+        self.cache.put(key, recommendations)
+        return recommendations, False
+
+    def status(self) -> dict:
+        loaded = self._loaded
+        thread = self._reload_thread
+        return {
+            'users': len(loaded.reviews.user_ids),
+            'routes': len(loaded.reviews.route_ids),
+            'dataVersion': self._data_version,
+            'generation': loaded.generation,
+            'cacheEntries': len(self.cache),
+            'reloading': thread is not None and thread.is_alive(),
+            'loadError': self._load_error,
+        }
+
+    def close(self):
+        thread = self._reload_thread
+        if thread is not None:
+            thread.join()
+        with self._conn_lock:
+            self._conn.close()
+
+
+class RecommendationHandler(BaseHTTPRequestHandler):
+    server: 'socketserver.BaseServer'
+
+    def send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def answer(self, service: RecommendationService) -> Tuple[int, dict]:
+        '''
+        Return the status and JSON body answering the request.
+        '''
+
+        url = urlsplit(self.path)
+        if url.path == '/status':
+            return 200, service.status()
+        if url.path != '/recommendations':
+            return 404, {'error': 'No such endpoint: %s' % url.path}
+
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            user_id = int(query['userId'])
+            n_recommendations = int(query.get('n', DEFAULT_RECOMMENDATIONS))
+            similarity_threshold = float(query.get('threshold', DEFAULT_SIMILARITY_THRESHOLD))
+        except (KeyError, ValueError):
+            return 400, {'error': 'Expected userId=ID, and optionally n=N and threshold=T'}
+        if n_recommendations < 1:
+            return 400, {'error': 'n must be at least 1'}
+
+        recommendations, cached = service.recommend(user_id, n_recommendations,
+                                                    similarity_threshold)
+        return 200, {
+            'userId': user_id,
+            'cached': cached,
+            'recommendations': [{'routeId': int(route_id), 'predictedScore': float(score)}
+                                for route_id, score in zip(recommendations['route_id'],
+                                                           recommendations['predicted_score'])],
+        }
+
+    def do_GET(self):
+        try:
+            status, body = self.answer(self.server.service)
+        except Exception as e:
+            print('Answering %s failed:' % self.path, file=sys.stderr)
+            traceback.print_exc()
+            status, body = 500, {'error': 'Internal error: %r' % e}
+
+        try:
+            self.send_json(status, body)
+        except ConnectionError:
+            # The client is gone, there is no one to answer
+            pass
+
+    def log_message(self, format: str, *args):
+        # The client address of a Unix socket is empty
+        print(format % args, file=sys.stderr)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service: RecommendationService, host: str = '127.0.0.1',
+                port: int = DEFAULT_PORT, socket_path: Optional[str] = None
+                ) -> socketserver.BaseServer:
+    '''
+    Return a threaded HTTP server answering from service, on socket_path if
+    given, and on host:port otherwise. A socket left at socket_path by an
+    earlier server is replaced, anything else there raises FileExistsError.
+    '''
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise FileExistsError('%s exists and is not a socket' % socket_path)
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, RecommendationHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RecommendationHandler)
+
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database')
+    listen = parser.add_mutually_exclusive_group()
+    listen.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='TCP port to listen on (default %(default)s)')
+    listen.add_argument('--socket', default=None, help='Unix socket to listen on instead')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on (default %(default)s)')
+    parser.add_argument('--cache-entries', type=int, default=DEFAULT_CACHE_ENTRIES,
+                        help='Results kept in the cache (default %(default)s)')
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_CACHE_TTL_SECONDS,
+                        help='Seconds a cached result is served (default %(default)s)')
+    parser.add_argument('--approximate', action='store_true',
+                        help='Find similar users with an LSH index, see lsh.py')
+    args = parser.parse_args()
+
+    service = RecommendationService(args.database, args.cache_entries, args.cache_ttl,
+                                    args.approximate)
+    try:
+        server = make_server(service, args.host, args.port, args.socket)
+    except FileExistsError as e:
+        service.close()
+        parser.error(str(e))
+    print('Serving on %s' % (args.socket or '%s:%d' % server.server_address[:2]),
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import io
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stderr
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from collaborative_filtering import ReviewMatrix, get_recommendations
+from recommendation_service import LRUCache, RecommendationService, make_server
+from schema import TABLES
+
+# (route_id, user_id, score), as in collaborative_filtering.test.py
+REVIEWS = [
+    (10, 1, 4), (11, 1, 2),
+    (10, 2, 4), (12, 2, 3), (13, 2, 1),
+    (11, 3, 4), (12, 3, 1), (12, 3, 3),
+    (14, 4, 4),
+]
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(2, len(cache))
+
+    def test_expires_entries(self):
+        now = [0.0]
+        cache = LRUCache(max_entries=10, ttl=5, clock=lambda: now[0])
+        cache.put('a', 1)
+        now[0] = 4.9
+        self.assertEqual(1, cache.get('a'))
+        now[0] = 5.0
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, len(cache))
+
+
+class RecommendationServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, 'test.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(TABLES)
+        conn.executemany('INSERT INTO reviews VALUES (?, ?, ?)', REVIEWS)
+        conn.commit()
+        conn.close()
+
+        with redirect_stderr(io.StringIO()):
+            self.service = RecommendationService(self.db_path)
+
+    def tearDown(self):
+        self.service.close()
+        self.directory.cleanup()
+
+    def recommend(self, *args):
+        with redirect_stderr(io.StringIO()):
+            return self.service.recommend(*args)
+
+    def add_user_5(self):
+        # User 5 agrees with user 1 and rated route 15
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany('INSERT INTO reviews VALUES (?, ?, ?)',
+                         [(10, 5, 4), (11, 5, 2), (15, 5, 4)])
+        conn.commit()
+        conn.close()
+
+    def wait_for_reload(self):
+        with redirect_stderr(io.StringIO()):
+            self.service.reload_if_changed(wait=True)
+
+    def test_cached_until_the_database_changes(self):
+        expected = get_recommendations(1, self.db_path)
+        recommendations, cached = self.recommend(1)
+        self.assertFalse(cached)
+        self.assertListEqual(expected['route_id'].tolist(),
+                             recommendations['route_id'].tolist())
+        self.assertTrue(self.recommend(1)[1])
+        self.assertFalse(self.recommend(1, 1)[1])
+
+        self.add_user_5()
+        loading = threading.Event()
+        load = ReviewMatrix.load
+
+        def slow_load(db_path):
+            loading.wait(5)
+            return load(db_path)
+
+        # Noticing the change starts the reload, answering from the loaded matrix
+        with mock.patch('recommendation_service.ReviewMatrix.load', side_effect=slow_load):
+            self.assertTrue(self.recommend(1)[1])
+            self.assertTrue(self.service.status()['reloading'])
+            self.assertEqual(1, self.service.status()['generation'])
+            loading.set()
+            self.wait_for_reload()
+
+        recommendations, cached = self.recommend(1)
+        self.assertFalse(cached)
+        self.assertEqual(15, recommendations['route_id'].iloc[0])
+        self.assertEqual(2, self.service.status()['generation'])
+        self.assertEqual(5, self.service.status()['users'])
+        self.assertFalse(self.service.status()['reloading'])
+
+    def test_failed_reload_keeps_serving(self):
+        expected = self.recommend(1)[0]['route_id'].tolist()
+        self.add_user_5()
+        with mock.patch('recommendation_service.ReviewMatrix.load',
+                        side_effect=sqlite3.OperationalError('disk I/O error')), \
+                redirect_stderr(io.StringIO()):
+            self.assertTrue(self.service.reload_if_changed(wait=True))
+
+        self.assertIn('disk I/O error', self.service.status()['loadError'])
+        self.assertEqual(1, self.service.status()['generation'])
+        self.assertListEqual(expected, self.recommend(1)[0]['route_id'].tolist())
+        # Not retried until the database changes again
+        self.assertFalse(self.service.reload_if_changed())
+
+    def test_approximate(self):
+        with redirect_stderr(io.StringIO()):
+            service = RecommendationService(self.db_path, approximate=True)
+        try:
+            self.assertListEqual([12, 13], service.recommend(1)[0]['route_id'].tolist())
+        finally:
+            service.close()
+
+    def serve(self, **kwargs):
+        server = make_server(self.service, **kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_http(self):
+        server = self.serve(port=0)
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        # The server logs each request
+        with redirect_stderr(io.StringIO()):
+            self.check_http(url)
+
+    def check_http(self, url):
+        with urlopen(url + '/recommendations?userId=1&n=1') as response:
+            body = json.load(response)
+        self.assertEqual(1, body['userId'])
+        self.assertFalse(body['cached'])
+        self.assertListEqual([12], [r['routeId'] for r in body['recommendations']])
+
+        with urlopen(url + '/recommendations?userId=99') as response:
+            self.assertListEqual([], json.load(response)['recommendations'])
+        with urlopen(url + '/status') as response:
+            self.assertEqual(4, json.load(response)['users'])
+
+        for path, status in [('/recommendations?userId=x', 400),
+                             ('/recommendations?userId=1&n=0', 400), ('/routes', 404)]:
+            with self.assertRaises(HTTPError) as context:
+                urlopen(url + path)
+            self.assertEqual(status, context.exception.code)
+            context.exception.close()
+
+        with mock.patch.object(self.service, 'recommend', side_effect=MemoryError), \
+                self.assertRaises(HTTPError) as context:
+            urlopen(url + '/recommendations?userId=1')
+        self.assertEqual(500, context.exception.code)
+        self.assertEqual('Internal error: MemoryError()', json.load(context.exception)['error'])
+        context.exception.close()
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix sockets are not available')
+    def test_unix_socket(self):
+        path = os.path.join(self.directory.name, 'service.sock')
+        self.serve(socket_path=path)
+
+        with socket.socket(socket.AF_UNIX) as client, redirect_stderr(io.StringIO()):
+            client.connect(path)
+            client.sendall(b'GET /recommendations?userId=1 HTTP/1.0\r\n\r\n')
+            response = b''
+            while chunk := client.recv(65536):
+                response += chunk
+
+        headers, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(headers.startswith(b'HTTP/1.0 200'))
+        self.assertListEqual([12, 13], [r['routeId'] for r in
+                                        json.loads(body)['recommendations']])
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix sockets are not available')
+    def test_unix_socket_keeps_other_files(self):
+        path = os.path.join(self.directory.name, 'service.sock')
+        with open(path, 'w') as file:
+            file.write('not a socket')
+
+        with self.assertRaises(FileExistsError):
+            make_server(self.service, socket_path=path)
+        with open(path) as file:
+            self.assertEqual('not a socket', file.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
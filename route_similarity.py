@@ -0,0 +1,240 @@
+'''
+route_similarity.py
+
+Precomputes, for every route, the k routes whose reviews are most similar
+(cosine similarity of the routes' columns in the users x routes review
+matrix, see collaborative_filtering.ReviewMatrix). The similarities are
+computed a block of routes at a time, so memory stays bounded by the block
+size rather than growing with the square of the number of routes.
+
+The index is a directory of .npy files opened with mmap: the sorted route
+ids, and for route i its neighbours (as indexes into the route ids, -1 past
+the last one) and their similarities, best first. index.json records the
+state of the database the index was built from, as snapshot.py does. A
+rebuild writes a sibling directory and then swaps it in, so a failed one
+leaves the previous index in place.
+
+Item-based recommendations then only add up the neighbour lists of the
+routes a user rated: a route's predicted score is the average of the user's
+scores of its neighbours, weighted by similarity.
+
+Usage:
+python3 route_similarity.py DATABASE [--k K] [--block-size N]
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from collaborative_filtering import ReviewMatrix, read_user_reviews
+from snapshot import database_stamp, replacing_directory
+
+INDEX_SUFFIX = '.route_similarity'
+METADATA_FILE_NAME = 'index.json'
+DEFAULT_NEIGHBOURS = 50
+# Routes whose similarities are computed at once. A block's products hold at
+# most this many times the number of routes entries.
+DEFAULT_BLOCK_SIZE = 256
+
+
+def default_directory(db_path: str) -> str:
+    return db_path + INDEX_SUFFIX
+
+
+def top_k_similar(matrix: sparse.csr_matrix, k: int = DEFAULT_NEIGHBOURS,
+                  block_size: int = DEFAULT_BLOCK_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Return the k most similar columns of matrix for each column, as an array
+    of their indexes (-1 where a column has fewer than k similar ones) and an
+    array of their cosine similarities, each with one row per column, best
+    first. Columns only sharing no row are not similar.
+    '''
+
+    columns = matrix.T.tocsr().astype(np.float32)
+    norms = np.sqrt(np.asarray(columns.multiply(columns).sum(axis=1))).ravel()
+    with np.errstate(divide='ignore'):
+        inverse_norms = np.where(norms > 0, 1 / norms, 0).astype(np.float32)
+    normalized = sparse.diags(inverse_norms) @ columns
+    normalized_t = normalized.T.tocsr()
+
+    count = normalized.shape[0]
+    neighbours = np.full((count, k), -1, dtype=np.int32)
+    similarities = np.zeros((count, k), dtype=np.float32)
+    for start in range(0, count, block_size):
+        block = (normalized[start:start + block_size] @ normalized_t).tocsr()
+        for row in range(block.shape[0]):
+            indices = block.indices[block.indptr[row]:block.indptr[row + 1]]
+            values = block.data[block.indptr[row]:block.indptr[row + 1]]
+            keep = (indices != start + row) & (values > 0)
+            indices, values = indices[keep], values[keep]
+            if len(values) > k:
+                top = np.argpartition(-values, k - 1)[:k]
+                indices, values = indices[top], values[top]
+
+            order = np.argsort(-values, kind='stable')
+            neighbours[start + row, :len(order)] = indices[order]
+            similarities[start + row, :len(order)] = values[order]
+
+    return neighbours, similarities
+
+
+class RouteSimilarityIndex:
+    '''
+    A built index, memory-mapped read-only.
+    '''
+
+    directory: str
+    metadata: dict
+    route_ids: np.ndarray
+    neighbours: np.ndarray
+    similarities: np.ndarray
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, METADATA_FILE_NAME)) as file:
+            self.metadata = json.load(file)
+
+        self.route_ids = np.load(os.path.join(directory, 'route_ids.npy'), mmap_mode='r')
+        self.neighbours = np.load(os.path.join(directory, 'neighbours.npy'), mmap_mode='r')
+        self.similarities = np.load(os.path.join(directory, 'similarities.npy'),
+                                    mmap_mode='r')
+
+    def is_fresh(self, db_path: str) -> bool:
+        return self.metadata['stamp'] == database_stamp(db_path)
+
+    def route_indexes(self, route_ids: np.ndarray) -> np.ndarray:
+        '''
+        Return the index of each route, or -1 for routes without reviews when
+        the index was built.
+        '''
+
+        route_ids = np.asarray(route_ids, dtype=self.route_ids.dtype)
+        indexes = np.searchsorted(self.route_ids, route_ids)
+        found = indexes < len(self.route_ids)
+        found[found] = self.route_ids[indexes[found]] == route_ids[found]
+        return np.where(found, indexes, -1)
+
+    def similar_routes(self, route_id: int) -> List[Tuple[int, float]]:
+        '''
+        Return (route_id, similarity) for the routes most similar to a route,
+        best first.
+        '''
+
+        i = self.route_indexes([route_id])[0]
+        if i < 0:
+            return []
+
+        valid = self.neighbours[i] >= 0
+        return list(zip(self.route_ids[self.neighbours[i][valid]].tolist(),
+                        self.similarities[i][valid].tolist()))
+
+    def recommend(self, route_ids: np.ndarray, scores: np.ndarray,
+                  n_recommendations: int = 300) -> pd.DataFrame:
+        '''
+        Predict the score of the neighbours of the routes a user gave scores,
+        other than those routes, see the module docstring. Return the
+        n_recommendations best with their predicted_score, best first.
+        '''
+
+        indexes = self.route_indexes(route_ids)
+        rated = indexes >= 0
+        indexes, scores = indexes[rated], np.asarray(scores, dtype=np.float64)[rated]
+
+        neighbours = self.neighbours[indexes]
+        valid = neighbours >= 0
+        weights = self.similarities[indexes][valid].astype(np.float64)
+        columns = neighbours[valid]
+        weighted_sums = np.bincount(columns, weights * np.broadcast_to(
+            scores[:, None], neighbours.shape)[valid], minlength=len(self.route_ids))
+        weight_sums = np.bincount(columns, weights, minlength=len(self.route_ids))
+
+        weight_sums[indexes] = 0
+        candidates = np.flatnonzero(weight_sums > 0)
+        predictions = weighted_sums[candidates] / weight_sums[candidates]
+        if len(candidates) > n_recommendations:
+            top = np.argpartition(-predictions, n_recommendations - 1)[:n_recommendations]
+            candidates, predictions = candidates[top], predictions[top]
+        order = np.argsort(-predictions, kind='stable')
+
+        return pd.DataFrame({
+            'route_id': self.route_ids[candidates[order]],
+            'predicted_score': predictions[order],
+        })
+
+
+def build_index(db_path: str, directory: Optional[str] = None, k: int = DEFAULT_NEIGHBOURS,
+                block_size: int = DEFAULT_BLOCK_SIZE) -> RouteSimilarityIndex:
+    '''
+    Build the index of the database's reviews in directory, replacing the
+    index there once the new one is complete, and return it.
+    '''
+
+    directory = directory or default_directory(db_path)
+    # Stamp before reading, so that a concurrent write makes the index stale
+    stamp = database_stamp(db_path)
+    started = time.perf_counter()
+    reviews = ReviewMatrix.load(db_path)
+    neighbours, similarities = top_k_similar(reviews.matrix, k, block_size)
+
+    # The index being replaced stays usable until the new one is complete
+    with replacing_directory(directory) as building:
+        np.save(os.path.join(building, 'route_ids.npy'), reviews.route_ids)
+        np.save(os.path.join(building, 'neighbours.npy'), neighbours)
+        np.save(os.path.join(building, 'similarities.npy'), similarities)
+        with open(os.path.join(building, METADATA_FILE_NAME), 'w') as file:
+            json.dump({'database': os.path.abspath(db_path), 'stamp': stamp, 'k': k,
+                       'routes': len(reviews.route_ids)}, file, indent=2)
+    print('Indexed the %d nearest of %d routes in %.1fs'
+          % (k, len(reviews.route_ids), time.perf_counter() - started), file=sys.stderr)
+
+    return RouteSimilarityIndex(directory)
+
+
+def open_index(db_path: str, directory: Optional[str] = None) -> RouteSimilarityIndex:
+    directory = directory or default_directory(db_path)
+    if not os.path.exists(os.path.join(directory, METADATA_FILE_NAME)):
+        raise FileNotFoundError('No route similarity index in %s, build it with '
+                                'python3 route_similarity.py %s' % (directory, db_path))
+
+    return RouteSimilarityIndex(directory)
+
+
+def get_item_recommendations(user_id, db_path, n_recommendations=300):
+    '''
+    Item-based counterpart of collaborative_filtering.get_recommendations(),
+    from the database's prebuilt index. Only the user's own reviews are read.
+    '''
+
+    route_ids, scores = read_user_reviews(db_path, user_id)
+    return open_index(db_path).recommend(route_ids, scores, n_recommendations)
+
+
+def get_item_recommendations_to_list(user_id, db_path):
+    return get_item_recommendations(user_id, db_path)['route_id'].tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database')
+    parser.add_argument('--directory', default=None,
+                        help='Where to write the index (default: DATABASE%s)' % INDEX_SUFFIX)
+    parser.add_argument('--k', type=int, default=DEFAULT_NEIGHBOURS,
+                        help='Neighbours kept per route (default %(default)s)')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE,
+                        help='Routes whose similarities are computed at once '
+                             '(default %(default)s)')
+    args = parser.parse_args()
+
+    build_index(args.database, args.directory, args.k, args.block_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import io
+import math
+import os
+import sqlite3
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+from unittest import mock
+
+import numpy as np
+
+from route_similarity import build_index, get_item_recommendations, open_index
+from schema import TABLES
+
+# (route_id, user_id, score). Route 10 was rated by users 1 and 2, route 11 by
+# users 1 and 3, route 12 by users 2 and 3 (twice), route 13 by user 2 and
+# route 14 only by user 4.
+REVIEWS = [
+    (10, 1, 4), (11, 1, 2),
+    (10, 2, 4), (12, 2, 3), (13, 2, 1),
+    (11, 3, 4), (12, 3, 1), (12, 3, 3),
+    (14, 4, 4),
+    # A score of 0 does not count as rating the route
+    (14, 1, 0),
+]
+
+SIMILARITIES = {
+    (10, 11): 8 / (math.sqrt(32) * math.sqrt(20)),
+    (10, 12): 12 / (math.sqrt(32) * math.sqrt(13)),
+    (10, 13): 4 / math.sqrt(32),
+    (11, 12): 8 / (math.sqrt(20) * math.sqrt(13)),
+    (12, 13): 3 / math.sqrt(13),
+}
+
+
+class RouteSimilarityTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, 'test.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(TABLES)
+        conn.executemany('INSERT INTO reviews VALUES (?, ?, ?)', REVIEWS)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def build(self, **kwargs):
+        with redirect_stderr(io.StringIO()):
+            return build_index(self.db_path, **kwargs)
+
+    def test_neighbours_match_exact_cosine(self):
+        # Blocks smaller than the number of routes must not change the result
+        index = self.build(k=10, block_size=2)
+        for route_id in (10, 11, 12, 13):
+            expected = sorted(((other, similarity)
+                               for pair, similarity in SIMILARITIES.items() if route_id in pair
+                               for other in pair if other != route_id),
+                              key=lambda neighbour: -neighbour[1])
+            actual = index.similar_routes(route_id)
+            self.assertListEqual([other for other, _ in expected], [other for other, _ in actual])
+            for (_, expected_similarity), (_, similarity) in zip(expected, actual):
+                self.assertAlmostEqual(expected_similarity, similarity, places=6)
+
+        self.assertListEqual([], index.similar_routes(14))
+        self.assertListEqual([], index.similar_routes(99))
+
+    def test_item_recommendations(self):
+        self.build(k=2, block_size=3)
+        self.assertListEqual([13, 12], [route_id for route_id, _ in
+                                        open_index(self.db_path).similar_routes(10)])
+
+        # User 1 gave route 10 a 4 and route 11 a 2. Route 13 is only a
+        # neighbour of route 10; route 12 of both.
+        expected = {
+            13: 4.0,
+            12: (SIMILARITIES[10, 12] * 4 + SIMILARITIES[11, 12] * 2)
+            / (SIMILARITIES[10, 12] + SIMILARITIES[11, 12]),
+        }
+        recommendations = get_item_recommendations(1, self.db_path)
+        self.assertListEqual([13, 12], recommendations['route_id'].tolist())
+        for route_id, score in zip(recommendations['route_id'],
+                                   recommendations['predicted_score']):
+            self.assertAlmostEqual(expected[route_id], score, places=6)
+
+        self.assertListEqual([13], get_item_recommendations(1, self.db_path, 1)['route_id']
+                             .tolist())
+        self.assertTrue(get_item_recommendations(4, self.db_path).empty)
+        self.assertTrue(get_item_recommendations(99, self.db_path).empty)
+        self.assertTrue(open_index(self.db_path).recommend(np.array([99]), np.array([4])).empty)
+
+    def test_missing_and_stale_index(self):
+        with self.assertRaises(FileNotFoundError):
+            open_index(self.db_path)
+
+        index = self.build()
+        self.assertTrue(index.is_fresh(self.db_path))
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('INSERT INTO reviews VALUES (15, 1, 4)')
+        conn.commit()
+        conn.close()
+        self.assertFalse(index.is_fresh(self.db_path))
+
+    def test_failed_rebuild_keeps_the_index(self):
+        self.build(k=2)
+        with mock.patch('route_similarity.top_k_similar', side_effect=MemoryError), \
+                self.assertRaises(MemoryError):
+            self.build(k=3)
+        with mock.patch('numpy.save', side_effect=OSError), self.assertRaises(OSError):
+            self.build(k=3)
+
+        self.assertEqual(2, open_index(self.db_path).metadata['k'])
+        self.assertListEqual(['test.db', 'test.db.route_similarity'],
+                             sorted(os.listdir(self.directory.name)))
+
+        self.build(k=3)
+        self.assertEqual(3, open_index(self.db_path).metadata['k'])
+        self.assertListEqual(['test.db', 'test.db.route_similarity'],
+                             sorted(os.listdir(self.directory.name)))
+
+
+if __name__ == '__main__':
+    unittest.main()
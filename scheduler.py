@@ -0,0 +1,177 @@
+'''
+scheduler.py
+
+Paces the requests fetcher sends so that a crawl runs as fast as the server
+comfortably allows, without hand-tuning.
+
+Each class of endpoint (the /api/v2 JSON API and the HTML/sitemap pages) has
+its own AdaptiveLimiter, which combines
+    - a token bucket, which spaces requests to at most `rate` per second, and
+    - a concurrency limit on requests in flight,
+both adjusted with AIMD (additive increase, multiplicative decrease). After
+every window of completed requests, if the window's p95 latency stays within
+LATENCY_TOLERANCE of the best p95 seen so far, the rate and concurrency step
+up. On a 429/503 response, a connection error, or a p95 above that, both are
+halved.
+'''
+
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+# A p95 latency this many times the baseline counts as the server slowing down
+LATENCY_TOLERANCE = 1.5
+# How fast the baseline follows latencies above it, so that a lasting change
+# in network conditions does not freeze the limits forever
+BASELINE_DRIFT = 0.05
+# Completed requests per adjustment
+WINDOW_SIZE = 20
+# Minimum seconds between two multiplicative decreases, so that a burst of
+# throttled responses to requests that were already in flight halves once
+DECREASE_COOLDOWN_SECONDS = 1.0
+THROTTLE_STATUSES = (429, 503)
+
+
+@dataclass
+class Slot:
+    '''
+    One request admitted by an AdaptiveLimiter. Set status to the response's
+    HTTP status code; a slot released without one counts as an error.
+    '''
+
+    started: float
+    status: Optional[int] = None
+
+
+class AdaptiveLimiter:
+    '''
+    Thread-safe token bucket plus concurrency limit for one endpoint class,
+    see the module docstring.
+    '''
+
+    name: str
+    max_rate: float
+    max_concurrency: int
+    rate: float
+    concurrency: float
+
+    def __init__(self, name: str, max_rate: float, max_concurrency: int,
+                 initial_rate: Optional[float] = None,
+                 initial_concurrency: int = 1):
+        self.name = name
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.min_rate = min(max_rate, 0.5)
+        self.rate = initial_rate if initial_rate is not None else max(self.min_rate, max_rate / 4)
+        self.rate_step = max_rate / 20
+        self.concurrency = min(initial_concurrency, max_concurrency)
+
+        self._cond = threading.Condition()
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._in_flight = 0
+        self._window: List[float] = []
+        self._baseline_p95: Optional[float] = None
+        self._last_decrease = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        # Allow a burst of one second worth of requests at most
+        self._tokens = min(max(1.0, self.rate),
+                           self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self) -> Slot:
+        with self._cond:
+            while True:
+                self._refill()
+                if self._in_flight < int(self.concurrency) and self._tokens >= 1:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    return Slot(time.monotonic())
+
+                timeout = ((1 - self._tokens) / self.rate
+                           if self._tokens < 1
+                           else None)
+                self._cond.wait(timeout=timeout)
+
+    def release(self, slot: Slot):
+        latency = time.monotonic() - slot.started
+        with self._cond:
+            self._in_flight -= 1
+
+            if slot.status is None or slot.status in THROTTLE_STATUSES:
+                self._decrease()
+            else:
+                self._window.append(latency)
+                if len(self._window) >= WINDOW_SIZE:
+                    self._adjust()
+
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        slot = self.acquire()
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    def _adjust(self):
+        window = sorted(self._window)
+        self._window = []
+        p95 = window[int(0.95 * (len(window) - 1))]
+
+        if self._baseline_p95 is None or p95 < self._baseline_p95:
+            self._baseline_p95 = p95
+        else:
+            self._baseline_p95 += (p95 - self._baseline_p95) * BASELINE_DRIFT
+
+        if p95 > self._baseline_p95 * LATENCY_TOLERANCE:
+            self._decrease()
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < DECREASE_COOLDOWN_SECONDS:
+            return
+
+        self._last_decrease = now
+        self._window = []
+        self.concurrency = max(1, self.concurrency / 2)
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._cond:
+            return {
+                'rate': self.rate,
+                'concurrency': int(self.concurrency),
+                'inFlight': self._in_flight,
+                'baselineP95': self._baseline_p95 or 0.0,
+            }
+
+
+class RequestScheduler:
+    '''
+    Routes each URL to the limiter for its endpoint class.
+    '''
+
+    api_prefix: str
+    api: AdaptiveLimiter
+    html: AdaptiveLimiter
+
+    def __init__(self, api_prefix: str, api: AdaptiveLimiter, html: AdaptiveLimiter):
+        self.api_prefix = api_prefix
+        self.api = api
+        self.html = html
+
+    def limiter_for(self, url: str) -> AdaptiveLimiter:
+        return self.api if url.startswith(self.api_prefix) else self.html
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {limiter.name: limiter.snapshot()
+                for limiter in (self.api, self.html)}
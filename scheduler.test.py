@@ -0,0 +1,73 @@
+import time
+import unittest
+
+import scheduler
+from scheduler import AdaptiveLimiter
+
+
+def complete_window(limiter: AdaptiveLimiter, latency: float = 0.01):
+    for _ in range(scheduler.WINDOW_SIZE):
+        with limiter.slot() as slot:
+            # Pretend the request took latency seconds
+            slot.started -= latency
+            slot.status = 200
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    def test_flat_latency_increases_limits(self):
+        limiter = AdaptiveLimiter('test', max_rate=1000, max_concurrency=4,
+                                  initial_rate=500)
+
+        for _ in range(10):
+            complete_window(limiter)
+
+        self.assertEqual(4, limiter.concurrency)
+        self.assertEqual(1000, limiter.rate)
+
+    def test_rising_latency_decreases_limits(self):
+        limiter = AdaptiveLimiter('test', max_rate=1000, max_concurrency=8,
+                                  initial_rate=800, initial_concurrency=8)
+
+        complete_window(limiter, latency=0.01)
+        complete_window(limiter, latency=0.1)
+
+        # The first window stepped the rate up before the second halved it
+        self.assertEqual(4, limiter.concurrency)
+        self.assertEqual((800 + limiter.rate_step) / 2, limiter.rate)
+
+    def test_throttling_halves_limits_once_per_cooldown(self):
+        limiter = AdaptiveLimiter('test', max_rate=1000, max_concurrency=8,
+                                  initial_rate=800, initial_concurrency=8)
+
+        for _ in range(3):
+            with limiter.slot() as slot:
+                slot.status = 429
+
+        self.assertEqual(4, limiter.concurrency)
+        self.assertEqual(400, limiter.rate)
+
+    def test_error_counts_as_throttling(self):
+        limiter = AdaptiveLimiter('test', max_rate=1000, max_concurrency=8,
+                                  initial_rate=800, initial_concurrency=8)
+
+        with self.assertRaises(ValueError):
+            with limiter.slot():
+                raise ValueError
+
+        self.assertEqual(4, limiter.concurrency)
+
+    def test_rate_is_paced(self):
+        limiter = AdaptiveLimiter('test', max_rate=20, max_concurrency=1,
+                                  initial_rate=20)
+        started = time.monotonic()
+
+        for _ in range(6):
+            with limiter.slot() as slot:
+                slot.status = 200
+
+        # One token is available up front, the other five take 1/20s each
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
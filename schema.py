@@ -0,0 +1,226 @@
+'''
+schema.py
+
+Creates the SQLite database populator.py loads, and migrates existing ones to
+the current schema. MIGRATIONS are applied once each, in order, and the
+number applied is kept in the database's user_version, so migrating an up to
+date database does nothing. A database created before this module, with the
+tables but no user_version, is migrated like any other.
+
+Besides the natural keys (see NATURAL_KEYS), the indexes follow the queries
+the recommenders and notebooks run:
+- reviews by user_id, for get_climbs_for_user() and get_users() in the
+  notebooks, and by (user_id, route_id) for
+  SourceOfTruth.is_good_recommendation(). The index includes the score, so
+  these never read the table.
+- reviews by route_id, for get_users_for_climb(), served by the natural key.
+- routes without an area, for the area_id backfill. The index only holds
+  those routes, so it shrinks as the backfill progresses.
+
+ANALYZE runs after migrating, so that the query planner knows how selective
+the indexes are. python3 bench_schema.py shows the query plans and latencies
+before and after.
+
+Usage:
+python3 schema.py DATABASE
+'''
+
+import argparse
+import sqlite3
+import sys
+from sqlite3 import Connection
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+# A NULL date is one the API gave but that could not be parsed
+TICKS_TABLE = '''
+CREATE TABLE IF NOT EXISTS ticks (
+route_id INTEGER NOT NULL,
+user_id INTEGER NOT NULL,
+`text` TEXT NOT NULL,
+`date` TEXT,
+FOREIGN KEY (route_id) REFERENCES routes (id)
+);
+'''
+
+TABLES = '''
+CREATE TABLE IF NOT EXISTS areas (
+id INTEGER PRIMARY KEY,
+name TEXT NOT NULL,
+latitude DECIMAL(3,5) NOT NULL,
+longitude DECIMAL(3,5) NOT NULL,
+parent_id INTEGER);
+
+CREATE TABLE IF NOT EXISTS ratings (
+route_id INTEGER NOT NULL,
+user_id INTEGER NOT NULL,
+rating TEXT NOT NULL,
+FOREIGN KEY (route_id) REFERENCES routes (id)
+);
+
+CREATE TABLE IF NOT EXISTS reviews (
+route_id INTEGER NOT NULL,
+user_id INTEGER NOT NULL,
+score INTEGER NOT NULL,
+FOREIGN KEY (route_id) REFERENCES routes (id)
+);
+
+CREATE TABLE IF NOT EXISTS routes (
+id INTEGER PRIMARY KEY,
+name TEXT NOT NULL,
+area_id INTEGER);
+''' + TICKS_TABLE
+
+# What crawls stored for unparseable tick dates before they were NULL
+UNKNOWN_TICK_DATE = '1970-01-01T00:00:00'
+
+# Columns identifying a row of the tables without a primary key. A user has
+# one review per route, any number of ratings, and one tick per route and date,
+# or per route and text for ticks without a date.
+NATURAL_KEYS = {
+    'ratings': ('route_id', 'user_id', 'rating'),
+    'reviews': ('route_id', 'user_id'),
+    'ticks': ('route_id', 'user_id', 'ifnull(`date`, `text`)'),
+}
+
+QUERY_INDEXES = '''
+CREATE INDEX IF NOT EXISTS reviews_by_user ON reviews (user_id, route_id, score);
+CREATE INDEX IF NOT EXISTS routes_without_area ON routes (id)
+WHERE area_id = 0 OR area_id IS NULL;
+'''
+
+# Rows ANALYZE samples per index, which keeps it fast on a full database
+ANALYSIS_LIMIT = 1000
+
+
+def _execute_script(script: str) -> Callable[[Connection], None]:
+    def execute(conn: Connection):
+        # executescript() would commit the migration's transaction
+        for statement in script.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+
+    return execute
+
+
+def ensure_natural_keys(conn: Connection) -> Dict[str, int]:
+    '''
+    Create the unique indexes on NATURAL_KEYS, first deleting the rows that
+    would violate them, and return the number deleted per table. Of rows with
+    the same key, the last inserted is kept. Does not commit.
+    '''
+
+    deleted = {}
+    for table, columns in NATURAL_KEYS.items():
+        index = '%s_natural_key' % table
+        if conn.execute('SELECT 1 FROM sqlite_master WHERE type = \'index\' AND name = ?',
+                        [index]).fetchone() is not None:
+            continue
+
+        cursor = conn.execute('DELETE FROM %s WHERE rowid NOT IN (SELECT max(rowid) FROM %s '
+                              'GROUP BY %s)' % (table, table, ', '.join(columns)))
+        deleted[table] = cursor.rowcount
+        conn.execute('CREATE UNIQUE INDEX %s ON %s (%s)' % (index, table, ', '.join(columns)))
+        print('Created %s, deleting %d duplicate rows' % (index, cursor.rowcount),
+              file=sys.stderr)
+
+    return deleted
+
+
+def allow_unknown_tick_dates(conn: Connection):
+    '''
+    Make ticks.date nullable, rebuilding the table if it was created NOT
+    NULL, replace the UNKNOWN_TICK_DATE placeholder with NULL, and recreate
+    the ticks natural key on NATURAL_KEYS. Does not commit.
+    '''
+
+    conn.execute('DROP INDEX IF EXISTS ticks_natural_key')
+    columns = {row[1]: row for row in conn.execute('PRAGMA table_info(ticks)')}
+    # Columns are (cid, name, type, notnull, default, pk)
+    if columns['date'][3]:
+        conn.execute('ALTER TABLE ticks RENAME TO ticks_not_null')
+        conn.execute(TICKS_TABLE)
+        conn.execute('INSERT INTO ticks (route_id, user_id, `text`, `date`) '
+                     'SELECT route_id, user_id, `text`, nullif(`date`, ?) '
+                     'FROM ticks_not_null ORDER BY rowid', [UNKNOWN_TICK_DATE])
+        conn.execute('DROP TABLE ticks_not_null')
+    else:
+        conn.execute('UPDATE ticks SET `date` = NULL WHERE `date` = ?', [UNKNOWN_TICK_DATE])
+
+    ensure_natural_keys(conn)
+
+
+# Version i of the schema is the one after the first i migrations
+MIGRATIONS: List[Tuple[str, Callable[[Connection], None]]] = [
+    ('Create tables', _execute_script(TABLES)),
+    ('Add natural key unique indexes', ensure_natural_keys),
+    ('Add indexes for the recommender and backfill queries', _execute_script(QUERY_INDEXES)),
+    ('Store unparseable tick dates as NULL', allow_unknown_tick_dates),
+]
+
+
+def schema_version(conn: Connection) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def analyze(conn: Connection):
+    conn.execute('PRAGMA analysis_limit = %d' % ANALYSIS_LIMIT)
+    conn.execute('ANALYZE')
+    conn.commit()
+
+
+def migrate(database: Union[str, Connection], target: Optional[int] = None) -> List[str]:
+    '''
+    Apply the migrations the database is missing, up to version target (the
+    latest by default), each in a transaction of its own, then ANALYZE if any
+    were applied. Return the descriptions of the migrations applied.
+    '''
+
+    conn = sqlite3.connect(database) if isinstance(database, str) else database
+    target = len(MIGRATIONS) if target is None else target
+    applied = []
+    try:
+        conn.commit()
+        for version in range(schema_version(conn), target):
+            description, apply = MIGRATIONS[version]
+            conn.execute('BEGIN')
+            try:
+                apply(conn)
+                conn.execute('PRAGMA user_version = %d' % (version + 1))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+            print('Migrated to version %d: %s' % (version + 1, description), file=sys.stderr)
+            applied.append(description)
+
+        if applied:
+            analyze(conn)
+    finally:
+        if isinstance(database, str):
+            conn.close()
+
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database')
+    parser.add_argument('--target', type=int, default=None,
+                        help='Migrate up to this version, defaults to the latest (%d)'
+                             % len(MIGRATIONS))
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    try:
+        if not migrate(conn, args.target):
+            # Nothing to migrate, but the statistics may be out of date
+            analyze(conn)
+        print('Schema version %d' % schema_version(conn), file=sys.stderr)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
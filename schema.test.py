@@ -0,0 +1,109 @@
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+
+from schema import MIGRATIONS, TABLES, migrate, schema_version
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'test.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def migrate(self, *args):
+        with redirect_stderr(io.StringIO()):
+            return migrate(self.path, *args)
+
+    def plan(self, conn, query, parameters=()):
+        return ' '.join(row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + query,
+                                                        parameters))
+
+    def test_fresh_database(self):
+        self.assertEqual(len(MIGRATIONS), len(self.migrate()))
+        self.assertEqual([], self.migrate())
+
+        conn = sqlite3.connect(self.path)
+        self.assertEqual(len(MIGRATIONS), schema_version(conn))
+        self.assertRegex(self.plan(conn, 'SELECT score FROM reviews '
+                                         'WHERE user_id = ? AND route_id = ?', [1, 2]),
+                         r'^SEARCH reviews USING .*INDEX')
+        self.assertIn('COVERING INDEX reviews_by_user',
+                      self.plan(conn, 'SELECT route_id, score FROM reviews WHERE user_id = ?', [1]))
+        self.assertIn('COVERING INDEX reviews_natural_key',
+                      self.plan(conn, 'SELECT user_id FROM reviews WHERE route_id = ?', [1]))
+        self.assertIn('routes_without_area',
+                      self.plan(conn, 'SELECT id, name FROM routes '
+                                      'WHERE area_id = 0 OR area_id IS NULL'))
+        # Analyzed, although the empty tables leave no statistics
+        self.assertIsNotNone(conn.execute('SELECT 1 FROM sqlite_master '
+                                          'WHERE name = \'sqlite_stat1\'').fetchone())
+        conn.close()
+
+    def test_existing_database(self):
+        conn = sqlite3.connect(self.path)
+        conn.executescript(TABLES)
+        conn.executemany('INSERT INTO reviews VALUES (?, ?, ?)',
+                         [(10, 7, 4), (10, 7, 2), (11, 7, 3)])
+        conn.commit()
+        conn.close()
+
+        self.migrate(1)
+        self.migrate()
+
+        conn = sqlite3.connect(self.path)
+        self.assertListEqual([(10, 7, 2), (11, 7, 3)],
+                             conn.execute('SELECT * FROM reviews ORDER BY 1').fetchall())
+        conn.close()
+
+    def test_unknown_tick_dates_become_null(self):
+        conn = sqlite3.connect(self.path)
+        # The ticks table as created before dates could be NULL
+        conn.executescript(TABLES.replace('`date` TEXT,', '`date` TEXT NOT NULL,'))
+        conn.executemany('INSERT INTO ticks VALUES (?, ?, ?, ?)',
+                         [(10, 7, 'a', '2020-05-01T00:00:00'),
+                          (10, 7, 'b', '1970-01-01T00:00:00'),
+                          (10, 7, 'c', '1970-01-01T00:00:00')])
+        conn.commit()
+        conn.close()
+
+        self.migrate(3)
+        self.migrate()
+
+        conn = sqlite3.connect(self.path)
+        # The placeholder had collapsed b and c into one tick
+        self.assertListEqual([(10, 7, 'a', '2020-05-01T00:00:00'), (10, 7, 'c', None)],
+                             conn.execute('SELECT * FROM ticks ORDER BY 3').fetchall())
+        # Undated ticks are told apart by their text
+        conn.execute('INSERT INTO ticks VALUES (10, 7, \'b\', NULL)')
+        for text, date in [('c', None), ('d', '2020-05-01T00:00:00')]:
+            with self.assertRaises(sqlite3.IntegrityError):
+                conn.execute('INSERT INTO ticks VALUES (10, 7, ?, ?)', [text, date])
+        conn.close()
+
+    def test_failed_migration_is_rolled_back(self):
+        conn = sqlite3.connect(self.path)
+        conn.executescript(TABLES)
+        # Leaves the natural key migration a name it cannot create its index under
+        conn.execute('CREATE TABLE reviews_natural_key (id INTEGER)')
+        conn.executemany('INSERT INTO ticks VALUES (?, ?, ?, ?)',
+                         [(10, 7, 'a', '2020'), (10, 7, 'b', '2020')])
+        conn.commit()
+        conn.close()
+
+        with self.assertRaises(sqlite3.Error):
+            self.migrate()
+
+        conn = sqlite3.connect(self.path)
+        self.assertEqual(1, schema_version(conn))
+        self.assertEqual(2, conn.execute('SELECT count(*) FROM ticks').fetchone()[0])
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
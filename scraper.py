@@ -13,7 +13,8 @@ area:
 route:
 {
     "routeId": "0",
-    "routeName": ""
+    "routeName": "",
+    "areaId": 0
 }
 
 rating:
@@ -28,7 +29,7 @@ tick:
     "routeId": "0",
     "userId": 0,
     "text": "",
-    "date": "YYYY-MM-DDThh-mm-ss" (Date.isoformat())
+    "date": "YYYY-MM-DDThh-mm-ss" (Date.isoformat()), or null if unparseable
 }
 
 review:
@@ -37,25 +38,76 @@ review:
     "user_id": 0,
     "score": 0
 }
+
+Pass --async to keep up to --concurrency requests in flight at once. The
+output is the same, in the same order, as a sequential crawl. Requests are
+paced by an adaptive scheduler (see scheduler.py) that ramps up to --api-rate
+and --html-rate while the server keeps up and backs off when it does not.
+
+Pass --output to write to a file. Progress is then recorded in a checkpoint
+file next to it, and --resume continues a crawl that died where it stopped.
+An --output ending in .bz2, .gz or .xz is compressed on --compress-threads
+threads, see compression.py.
+
+Pass --database instead of --output to load the crawl into a database as it
+runs, see populator.DatabaseWriter. Entities are upserted, so a crawl resumed
+with --resume leaves the database as a single crawl would.
+
+Pass --since with a timestamp or a state file to only fetch, and output, the
+areas and routes whose sitemap lastmod is newer. With a state file, the start
+time of each crawl in which no fetch failed is saved for the next run; after
+a failed fetch the state file is left as it was and the scraper exits with an
+error.
+
+Pass --shard i/N to crawl a deterministic 1/N of the sitemap pages, then
+combine the shard outputs with shards.py. Shards always crawl in full, so
+--shard cannot be combined with --since.
+
+Pass --metrics-json and/or --metrics-prom to get request latencies, bytes,
+errors and entity throughput per endpoint, see metrics.py.
 '''
 
+import argparse
+import asyncio
+import itertools
 import json
+import os
 import sys
-from dataclasses import asdict
-from typing import Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from functools import partial
+from typing import (AsyncGenerator, AsyncIterable, Awaitable, BinaryIO, Callable,
+                    Deque, Dict, Iterable, List, Optional, Set, Tuple)
 
 import fetcher
+import http_cache
 from accumulator import Accumulator as Acc
-from model import Route, RouteRating, RouteTick
+from area_index import RouteAreaIndex
+from checkpoint import Checkpoint
+from compression import CompressedWriter, compression_of
+from fetcher import safe_run
+from metrics import DEFAULT_REPORT_INTERVAL_SECONDS, REGISTRY, MetricsReporter
+from model import Area, Page, Route, RouteRating, RouteTick
+from populator import (DEFAULT_LIVE_COMMIT_INTERVAL_SECONDS, DEFAULT_LIVE_COMMIT_ROWS,
+                       DEFAULT_LIVE_QUEUE_SIZE, DatabaseWriter)
+from shards import MANIFEST_SUFFIX, ShardSpec, write_manifest
 
 ITERATIVE_MILESTONE = 100
 
+# Defaults for --async mode
+DEFAULT_CONCURRENCY = 8
+ASYNC_WINDOW_FACTOR = 4
+
+CHECKPOINT_SUFFIX = '.checkpoint'
+
 
 def stringify_entity(entity) -> Optional[str]:
     dictionary = None
     match entity:
-        case Route(rid, rname):
-            dictionary = {'routeId': rid, 'routeName': rname}
+        case Route(rid, rname, area_id):
+            dictionary = {'routeId': rid, 'routeName': rname, 'areaId': area_id}
         case RouteRating(rid, uid, ratings):
             dictionary = {'routeId': rid, 'userId': uid, 'ratings': ratings}
         case RouteTick(rid, uid, text, date):
@@ -63,7 +115,7 @@ def stringify_entity(entity) -> Optional[str]:
                 'routeId': rid,
                 'userId': uid,
                 'text': text,
-                'date': date.isoformat()
+                'date': date.isoformat() if date is not None else None
                 }
         case other:
             try:
@@ -76,49 +128,685 @@ def stringify_entity(entity) -> Optional[str]:
     return json.dumps(dictionary)
 
 
-def print_entity(entity):
-    stringified = stringify_entity(entity)
-    if stringified is not None:
-        print(stringify_entity(entity))
+class CrawlOutput:
+    '''
+    Writes crawl results as jsonl and records each finished unit of work in a
+    Checkpoint once its output has reached the disk.
+
+    With a CompressedWriter, units are only recorded once the compressed
+    block they end in is written, at the file offset where that block ends,
+    so that truncating the file to a checkpoint offset always leaves whole
+    compressed streams. Blocks only end between units.
+    '''
+
+    file: Optional[BinaryIO]
+    checkpoint: Checkpoint
+    offset: int
+    area_count: int
+    route_count: int
+
+    def __init__(self, file: Optional[BinaryIO], checkpoint: Checkpoint, offset: int = 0):
+        self.file = file
+        self.checkpoint = checkpoint
+        self.offset = offset
+        self.area_count = 0
+        self.route_count = 0
+        # Finished units waiting for their compressed block, by output offset
+        self._unrecorded: Deque[Tuple[int, Callable[[int], None]]] = deque()
+
+    def write_entity(self, entity):
+        stringified = stringify_entity(entity)
+        if stringified is not None:
+            line = stringified.encode() + b'\n'
+            self.file.write(line)
+            self.offset += len(line)
+            REGISTRY.inc('mp_crawl_entities_total', {'type': type(entity).__name__})
+
+    def _sync(self):
+        if isinstance(self.file, CompressedWriter):
+            self.file.mark()
+
+        self.file.flush()
+        if self.checkpoint.path is not None:
+            os.fsync(self.file.fileno())
+
+    def _finish(self, record: Callable[[int], None]):
+        '''
+        Call record with the checkpoint offset of the unit of work just
+        written, once it is on disk.
+        '''
+
+        self._sync()
+        if not isinstance(self.file, CompressedWriter):
+            record(self.offset)
+            return
+
+        self._unrecorded.append((self.offset, record))
+        self._record_written()
+
+    def _record_written(self):
+        for end, compressed_end in self.file.written_blocks():
+            while self._unrecorded and self._unrecorded[0][0] <= end:
+                self._unrecorded.popleft()[1](compressed_end)
+
+    def write_area_page(self, area_page: str, areas: Iterable[Tuple[Area, List[str]]]):
+        '''
+        Write the areas of an area sitemap page, given with the route ids each
+        area page links to, and add those routes to the route area index.
+        '''
+
+        route_areas = RouteAreaIndex()
+        for area, route_ids in areas:
+            if self.area_count % ITERATIVE_MILESTONE == 0:
+                print(f'areas[{self.area_count}]', file=sys.stderr)
+
+            self.write_entity(area)
+            route_areas.add(area, route_ids)
+            self.area_count += 1
+
+        # Routes written before the page is recorded need its areas too.
+        # Merging the same index again when it is recorded changes nothing.
+        self.checkpoint.route_areas.merge(route_areas)
+        self._finish(partial(self.checkpoint.finish_area_page, area_page,
+                             route_areas=route_areas))
+
+    def write_route(self, route: Route, entities: Iterable):
+        '''
+        Write a route's entities, as produced by route_entities(), filling in
+        the route's area_id from the areas crawled so far.
+        '''
+
+        if self.route_count % ITERATIVE_MILESTONE == 0:
+            print(f'routes[{self.route_count}]', file=sys.stderr)
+
+        if route.area_id == 0:
+            route.area_id = self.checkpoint.route_areas.area_id(route.id)
+
+        for entity in entities:
+            self.write_entity(entity)
+
+        self.route_count += 1
+        self._finish(partial(self.checkpoint.finish_route, route.id))
+
+    def finish_route_page(self, page: int):
+        self._finish(partial(self.checkpoint.finish_route_page, page))
+
+    def close(self):
+        if isinstance(self.file, CompressedWriter):
+            self.file.finish()
+            if self.checkpoint.path is not None:
+                os.fsync(self.file.fileno())
+            self._record_written()
+            self.file.close()
+        else:
+            self.file.flush()
+        self.checkpoint.close()
+
+
+class DatabaseCrawlOutput(CrawlOutput):
+    '''
+    Puts crawl results in a DatabaseWriter instead of writing jsonl. A unit
+    of work is recorded in the checkpoint once all of its entities are
+    committed; offset counts entities, and checkpoint offsets are 0 as there
+    is no file to truncate on resume.
+    '''
+
+    writer: DatabaseWriter
+
+    def __init__(self, writer: DatabaseWriter, checkpoint: Checkpoint):
+        super().__init__(None, checkpoint)
+        self.writer = writer
 
+    def write_entity(self, entity):
+        self.writer.put(entity)
+        self.offset += 1
+        REGISTRY.inc('mp_crawl_entities_total', {'type': type(entity).__name__})
 
-def handle_route(route: Route):
-    print_entity(route)
+    def _finish(self, record: Callable[[int], None]):
+        self._unrecorded.append((self.offset, record))
+        self._record_committed()
 
-    ratings_accumulator = Acc(lambda i: fetcher.fetch_ratings(i, route.id))
-    ticks_accumulator = Acc(lambda i: fetcher.fetch_ticks(i, route.id))
-    reviews_accumulator = Acc(lambda i: fetcher.fetch_reviews(i, route.id))
+    def _record_committed(self):
+        committed = self.writer.committed
+        while self._unrecorded and self._unrecorded[0][0] <= committed:
+            self._unrecorded.popleft()[1](0)
 
-    for rating in ratings_accumulator.generator():
-        print_entity(rating)
+    def close(self):
+        try:
+            self.writer.close()
+            self._record_committed()
+        finally:
+            self.checkpoint.close()
 
-    for tick in ticks_accumulator.generator():
-        print_entity(tick)
 
-    for review in reviews_accumulator.generator():
-        print_entity(review)
+def route_entities(route: Route, prefetch: int = 0):
+    '''
+    Yield the route followed by all of its ratings, ticks and reviews, in the
+    order they are written to the output. prefetch is passed on to each
+    Accumulator.
+    '''
 
+    yield route
 
-def scrape():
+    ratings_accumulator = Acc(lambda i: fetcher.fetch_ratings(i, route.id),
+                              prefetch=prefetch)
+    ticks_accumulator = Acc(lambda i: fetcher.fetch_ticks(i, route.id),
+                            prefetch=prefetch)
+    reviews_accumulator = Acc(lambda i: fetcher.fetch_reviews(i, route.id),
+                              prefetch=prefetch)
+
+    yield from ratings_accumulator.generator()
+    yield from ticks_accumulator.generator()
+    yield from reviews_accumulator.generator()
+
+
+@dataclass
+class CrawlScope:
+    '''
+    Decides which sitemap pages, areas and routes a crawl fetches.
+
+    With since set, only entries whose sitemap <lastmod> is at or after since
+    are fetched, which is what makes a delta crawl cheap. Entries without a
+    lastmod are always fetched. This relies on mountainproject.com bumping a
+    route's lastmod when its page changes, including new ticks and ratings.
+
+    With shard set, only the sitemap pages that shard owns are fetched.
+
+    The selected area pages, the listed route ids and the first empty route
+    page are recorded while crawling, for the shard manifest.
+    '''
+
+    since: Optional[datetime] = None
+    shard: Optional[ShardSpec] = None
+    page_lastmods: Dict[str, Optional[datetime]] = field(default_factory=dict)
+    selected_area_pages: List[str] = field(default_factory=list)
+    listed_route_ids: Set[str] = field(default_factory=set)
+    route_page_end: Optional[int] = None
+
+    def is_changed(self, lastmod: Optional[datetime]) -> bool:
+        return self.since is None or lastmod is None or lastmod >= self.since
+
+    def owns(self, page) -> bool:
+        return self.shard is None or self.shard.owns(page)
+
+    def select_area_pages(self, sitemap: str) -> List[str]:
+        '''
+        Read the sitemap index and return the area sitemap pages to crawl.
+        '''
+
+        self.page_lastmods = {entry.url: entry.lastmod
+                              for entry in fetcher.parse_sitemap(sitemap)}
+        self.selected_area_pages = [
+            area_page
+            for area_page in fetcher.SITEMAP_AREA_PAGE_PATTERN.findall(sitemap)
+            if self.owns(area_page) and self.is_changed(
+                self.page_lastmods.get(fetcher.area_sitemap_url(area_page)))]
+
+        return self.selected_area_pages
+
+    def wants_route_page(self, i: int) -> bool:
+        return self.owns(i) and self.is_changed(
+            self.page_lastmods.get(fetcher.route_sitemap_url(i)))
+
+    def select_routes(self, entries: List[Tuple[Route, Optional[datetime]]]) -> List[Route]:
+        routes = [route for route, lastmod in entries if self.is_changed(lastmod)]
+        self.listed_route_ids.update(route.id for route in routes)
+        return routes
+
+
+def fetch_changed_areas(entries: List[fetcher.SitemapEntry], scope: CrawlScope):
+    for entry in entries:
+        if scope.is_changed(entry.lastmod):
+            area = safe_run(lambda: fetcher.fetch_area_with_routes(entry.url))
+            if area is not None:
+                yield area
+
+
+def scrape(output: Optional[CrawlOutput] = None, scope: Optional[CrawlScope] = None,
+           prefetch: int = 0):
+    '''
+    Crawl every area and then every route in scope, skipping the work that
+    the output's checkpoint already records as finished. prefetch is the
+    number of ratings, ticks and reviews pages to fetch ahead per route.
+    '''
+
+    if output is None:
+        output = CrawlOutput(sys.stdout.buffer, Checkpoint())
+    if scope is None:
+        scope = CrawlScope()
+
+    checkpoint = output.checkpoint
     sitemap = fetcher.get_sitemap()
 
-    area_count = 0
-    area_pages = fetcher.SITEMAP_AREA_PAGE_PATTERN.findall(sitemap)
-    for area_page in area_pages:
-        for area in fetcher.fetch_areas(area_page):
-            if area_count % ITERATIVE_MILESTONE == 0:
-                print(f'areas[{area_count}]', file=sys.stderr)
+    for area_page in scope.select_area_pages(sitemap):
+        if area_page in checkpoint.area_pages:
+            continue
+
+        entries = fetcher.fetch_area_entries(area_page)
+        output.write_area_page(area_page, fetch_changed_areas(entries, scope))
+
+    for i in itertools.count():
+        if i in checkpoint.route_pages or not scope.wants_route_page(i):
+            continue
+
+        entries = safe_run(lambda: fetcher.fetch_route_entries(i))
+        if entries is None:
+            # The fetch failed, which says nothing about where the pages end
+            break
+
+        if not entries:
+            scope.route_page_end = i
+            break
+
+        for route in scope.select_routes(entries):
+            if route.id not in checkpoint.route_ids:
+                output.write_route(route, route_entities(route, prefetch))
+
+        output.finish_route_page(i)
+
+
+def read_since(value: str) -> Tuple[Optional[datetime], Optional[str], RouteAreaIndex]:
+    '''
+    Interpret --since, which is either a timestamp or the path of a state
+    file. Return the timestamp and, for a state file, its path so that it can
+    be updated once the crawl succeeds, along with the route area index of the
+    previous crawl, which covers routes in areas that are not refetched. A
+    missing state file means everything is crawled.
+    '''
+
+    since = fetcher.parse_lastmod(value)
+    if since is not None:
+        return since, None, RouteAreaIndex()
+
+    if not os.path.exists(value):
+        print('No state file %s, crawling everything' % value, file=sys.stderr)
+        return None, value, RouteAreaIndex()
+
+    with open(value) as file:
+        match json.load(file):
+            case {'crawlStarted': str(started), 'routeAreas': dict(route_areas)}:
+                return (fetcher.parse_lastmod(started), value,
+                        RouteAreaIndex.from_json(route_areas))
+            case {'crawlStarted': str(started)}:
+                return fetcher.parse_lastmod(started), value, RouteAreaIndex()
+            case other:
+                raise ValueError('Unexpected state file %s: %s' % (value, other))
+
+
+def write_state(path: str, crawl_started: datetime, route_areas: RouteAreaIndex):
+    '''
+    Record when the crawl that just finished started. The next --since run
+    refetches anything modified after that, including during this crawl.
+    '''
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as file:
+        json.dump({'crawlStarted': crawl_started.isoformat(),
+                   'routeAreas': route_areas.to_json()}, file)
+    os.replace(temporary_path, path)
+
+
+class HostLimiter:
+    '''
+    Runs blocking fetcher calls on worker threads while bounding how many of
+    them are in flight at once. Every request the scraper sends goes to
+    www.mountainproject.com, so this is the per-host concurrency limit.
+    '''
+
+    semaphore: asyncio.Semaphore
+
+    def __init__(self, concurrency: int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(self, function: Callable, *args):
+        async with self.semaphore:
+            return await asyncio.to_thread(function, *args)
+
+
+async def accumulate_async(limiter: HostLimiter,
+                           zero_indexed_fetcher: Callable[[int], Optional[List]]) -> List:
+    '''
+    Async counterpart of Accumulator.generator(). Pages are fetched one after
+    another, because the end of the data is only known from the last page, but
+    each fetch releases the event loop so other pages can be in flight.
+    '''
+
+    result = []
+    i = 0
+    while True:
+        page = await limiter.run(safe_run, partial(zero_indexed_fetcher, i))
+        if not page:
+            return result
+
+        result.extend(page)
+        if isinstance(page, Page) and page.is_last:
+            return result
+
+        i += 1
+
+
+async def route_entities_async(limiter: HostLimiter, route: Route) -> List:
+    ratings, ticks, reviews = await asyncio.gather(
+        accumulate_async(limiter, lambda i: fetcher.fetch_ratings(i, route.id)),
+        accumulate_async(limiter, lambda i: fetcher.fetch_ticks(i, route.id)),
+        accumulate_async(limiter, lambda i: fetcher.fetch_reviews(i, route.id)))
+
+    return [route, *ratings, *ticks, *reviews]
+
+
+async def area_page_entities_async(limiter: HostLimiter, scope: CrawlScope,
+                                   area_page: str) -> List:
+    entries = await limiter.run(fetcher.fetch_area_entries, area_page)
+    areas = await asyncio.gather(*(limiter.run(safe_run,
+                                               partial(fetcher.fetch_area_with_routes, entry.url))
+                                   for entry in entries
+                                   if scope.is_changed(entry.lastmod)))
+
+    return [area for area in areas if area is not None]
+
+
+async def route_pages_async(limiter: HostLimiter, scope: CrawlScope, skipped_pages: Set[int]
+                            ) -> AsyncGenerator[Tuple[int, List[Route]], None]:
+    for i in itertools.count():
+        if i in skipped_pages or not scope.wants_route_page(i):
+            continue
+
+        entries = await limiter.run(safe_run, partial(fetcher.fetch_route_entries, i))
+        if entries is None:
+            # The fetch failed, which says nothing about where the pages end
+            return
+
+        if not entries:
+            scope.route_page_end = i
+            return
+
+        yield i, scope.select_routes(entries)
+
+
+async def ordered_gather(coroutines: AsyncIterable[Awaitable], window: int):
+    '''
+    Schedule up to window coroutines at once and yield their results in the
+    order the coroutines were produced, regardless of completion order.
+    '''
+
+    pending = deque()
+    async for coroutine in coroutines:
+        pending.append(asyncio.ensure_future(coroutine))
+        if len(pending) >= window:
+            yield await pending.popleft()
+
+    while pending:
+        yield await pending.popleft()
+
+
+async def scrape_async(concurrency: int, output: Optional[CrawlOutput] = None,
+                       scope: Optional[CrawlScope] = None):
+    '''
+    Same crawl as scrape(), with up to concurrency HTTP requests in flight.
+
+    Output order is deterministic and identical to scrape(): areas in sitemap
+    order, then each route followed by its ratings, ticks and reviews. Up to
+    ASYNC_WINDOW_FACTOR * concurrency area pages or routes are buffered in
+    memory while earlier ones finish.
+    '''
+
+    if output is None:
+        output = CrawlOutput(sys.stdout.buffer, Checkpoint())
+    if scope is None:
+        scope = CrawlScope()
+
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=concurrency))
+
+    checkpoint = output.checkpoint
+    limiter = HostLimiter(concurrency)
+    window = ASYNC_WINDOW_FACTOR * concurrency
+
+    # Every coroutine below resolves to a callable that writes its results.
+    # The callables are run in the order the work was scheduled.
+    async def ready(write: Callable[[], None]) -> Callable[[], None]:
+        return write
+
+    async def area_page_writer(area_page: str) -> Callable[[], None]:
+        areas = await area_page_entities_async(limiter, scope, area_page)
+        return partial(output.write_area_page, area_page, areas)
+
+    async def route_writer(route: Route) -> Callable[[], None]:
+        entities = await route_entities_async(limiter, route)
+        return partial(output.write_route, route, entities)
+
+    sitemap = await limiter.run(fetcher.get_sitemap)
+    area_pages = scope.select_area_pages(sitemap)
+
+    async def area_page_coroutines():
+        for area_page in area_pages:
+            if area_page not in checkpoint.area_pages:
+                yield area_page_writer(area_page)
+
+    async for write in ordered_gather(area_page_coroutines(), window):
+        write()
+
+    async def route_coroutines():
+        async for i, routes in route_pages_async(limiter, scope, checkpoint.route_pages):
+            for route in routes:
+                if route.id not in checkpoint.route_ids:
+                    yield route_writer(route)
+
+            yield ready(partial(output.finish_route_page, i))
+
+    async for write in ordered_gather(route_coroutines(), window):
+        write()
+
+
+def open_output(parser: argparse.ArgumentParser, args: argparse.Namespace) -> CrawlOutput:
+    if args.database is not None:
+        checkpoint = Checkpoint(args.checkpoint
+                                if args.checkpoint is not None
+                                else args.database + CHECKPOINT_SUFFIX,
+                                resume=args.resume)
+        writer = DatabaseWriter(args.database, args.queue_size, args.commit_rows,
+                                args.commit_ms / 1000)
+        REGISTRY.add_gauge_collector(lambda: {
+            'mp_ingest_queue_depth': {'database': writer.queue_depth()},
+            'mp_ingest_committed_entities': {'database': writer.committed},
+        })
+        return DatabaseCrawlOutput(writer, checkpoint)
+
+    if args.output is None:
+        if args.resume or args.checkpoint is not None:
+            parser.error('--resume and --checkpoint require --output or --database')
+
+        return CrawlOutput(sys.stdout.buffer, Checkpoint())
+
+    checkpoint_path = (args.checkpoint
+                       if args.checkpoint is not None
+                       else args.output + CHECKPOINT_SUFFIX)
+    compression = compression_of(args.output)
+
+    def wrap(file: BinaryIO, offset: int) -> BinaryIO:
+        if compression is None:
+            return file
+
+        return CompressedWriter(file, compression, args.compress_threads or None,
+                                cut_at_marks=True, compressed_offset=offset)
+
+    if not args.resume:
+        return CrawlOutput(wrap(open(args.output, 'wb'), 0), Checkpoint(checkpoint_path))
+
+    checkpoint = Checkpoint(checkpoint_path, resume=True)
+    output_size = (os.path.getsize(args.output)
+                   if os.path.exists(args.output)
+                   else 0)
+    if output_size < checkpoint.offset:
+        parser.error('%s is shorter than its checkpoint %s records (%d < %d bytes)'
+                     % (args.output, checkpoint_path, output_size, checkpoint.offset))
+
+    # Drop whatever was written after the last finished unit of work. For a
+    # compressed output that is a block boundary, so whole streams remain.
+    file = open(args.output, 'ab')
+    file.truncate(checkpoint.offset)
+    print('Resuming %s at byte %d: %d area pages, %d route pages and %d routes done'
+          % (args.output, checkpoint.offset, len(checkpoint.area_pages),
+             len(checkpoint.route_pages), len(checkpoint.route_ids)),
+          file=sys.stderr)
+
+    # A compressed output's offset counts file bytes, the writer's own offset
+    # the uncompressed bytes written from here on
+    return CrawlOutput(wrap(file, checkpoint.offset), checkpoint,
+                       0 if compression is not None else checkpoint.offset)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scrape mountainproject.com into jsonl.')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='crawl with many requests in flight at once')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='maximum in-flight requests in --async mode (default %(default)s)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='ratings, ticks and reviews pages to fetch ahead of '
+                             'the one being written, without --async (default %(default)s)')
+    parser.add_argument('--pool-size', type=int, default=None,
+                        help='keep-alive connections to keep open (default: '
+                             'max(concurrency, %d))' % fetcher.DEFAULT_POOL_SIZE)
+    parser.add_argument('--retries', type=int, default=fetcher.DEFAULT_RETRIES,
+                        help='retries with exponential backoff on 5xx and '
+                             'connection errors (default %(default)s)')
+    parser.add_argument('--api-rate', type=float, default=fetcher.DEFAULT_API_MAX_RATE,
+                        help='maximum /api/v2 requests per second (default %(default)s)')
+    parser.add_argument('--html-rate', type=float, default=fetcher.DEFAULT_HTML_MAX_RATE,
+                        help='maximum HTML and sitemap requests per second '
+                             '(default %(default)s)')
+    parser.add_argument('--no-scheduler', action='store_true',
+                        help='send requests as fast as they are made, without '
+                             'adaptive pacing')
+    parser.add_argument('--output', default=None,
+                        help='write jsonl to this file instead of stdout')
+    parser.add_argument('--compress-threads', type=int, default=0,
+                        help='threads compressing an --output ending in .bz2, .gz or '
+                             '.xz (default: one per core)')
+    parser.add_argument('--database', default=None,
+                        help='load entities into this SQLite database as they are '
+                             'crawled, instead of writing jsonl')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_LIVE_QUEUE_SIZE,
+                        help='entities waiting for --database before the crawl '
+                             'blocks (default %(default)s)')
+    parser.add_argument('--commit-rows', type=int, default=DEFAULT_LIVE_COMMIT_ROWS,
+                        help='commit --database every this many entities '
+                             '(default %(default)s)')
+    parser.add_argument('--commit-ms', type=int,
+                        default=int(DEFAULT_LIVE_COMMIT_INTERVAL_SECONDS * 1000),
+                        help='or this many milliseconds after the first uncommitted '
+                             'entity (default %(default)s)')
+    parser.add_argument('--checkpoint', default=None,
+                        help='progress file (default: OUTPUT%s or DATABASE%s)'
+                             % (CHECKPOINT_SUFFIX, CHECKPOINT_SUFFIX))
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the work recorded in the checkpoint and '
+                             'append to the existing output')
+    parser.add_argument('--cache-dir', default=None,
+                        help='keep responses in this directory and revalidate '
+                             'them with conditional requests on later crawls')
+    parser.add_argument('--cache-size', type=int,
+                        default=http_cache.DEFAULT_MAX_BYTES // 1024 ** 2,
+                        help='cache budget in MiB (default %(default)s)')
+    parser.add_argument('--offline', action='store_true',
+                        help='replay a previous crawl from --cache-dir without '
+                             'touching the network')
+    parser.add_argument('--since', default=None,
+                        help='only fetch areas and routes modified since this '
+                             'ISO timestamp, or since the last successful crawl '
+                             'recorded in this state file')
+    parser.add_argument('--shard', type=ShardSpec.parse, default=None,
+                        help='i/N: only crawl the sitemap pages of shard i out of N, '
+                             'see shards.py (requires --output, excludes --since)')
+    parser.add_argument('--metrics-json', default=None,
+                        help='periodically write a JSON snapshot of crawl metrics here')
+    parser.add_argument('--metrics-prom', default=None,
+                        help='periodically write crawl metrics here in the Prometheus '
+                             'text format')
+    parser.add_argument('--metrics-interval', type=float,
+                        default=DEFAULT_REPORT_INTERVAL_SECONDS,
+                        help='seconds between metrics writes (default %(default)s)')
+    args = parser.parse_args()
+
+    if args.shard is not None and args.output is None:
+        parser.error('--shard requires --output')
+
+    # The route pages --since skips are not recorded as finished, so
+    # shards.py would report them missing
+    if args.shard is not None and args.since is not None:
+        parser.error('--shard and --since are exclusive')
+
+    if args.database is not None and args.output is not None:
+        parser.error('--database and --output are exclusive')
+
+    if args.offline and args.cache_dir is None:
+        parser.error('--offline requires --cache-dir')
+
+    pool_size = (args.pool_size
+                 if args.pool_size is not None
+                 else max(args.concurrency, fetcher.DEFAULT_POOL_SIZE))
+    fetcher.configure_session(pool_size=pool_size, retries=args.retries)
+
+    if not args.no_scheduler:
+        scheduler = fetcher.make_scheduler(
+            api_max_rate=args.api_rate, html_max_rate=args.html_rate,
+            api_max_concurrency=max(args.concurrency, 1),
+            html_max_concurrency=max(args.concurrency, 1))
+        fetcher.configure_scheduler(scheduler)
+        REGISTRY.add_gauge_collector(lambda: {
+            'mp_scheduler_rate': {name: limits['rate']
+                                  for name, limits in scheduler.snapshot().items()},
+            'mp_scheduler_concurrency': {name: limits['concurrency']
+                                         for name, limits in scheduler.snapshot().items()},
+        })
+
+    reporter = None
+    if args.metrics_json is not None or args.metrics_prom is not None:
+        reporter = MetricsReporter(args.metrics_json, args.metrics_prom,
+                                   args.metrics_interval)
+        reporter.start()
+
+    if args.cache_dir is not None:
+        fetcher.configure_cache(http_cache.ResponseCache(
+            args.cache_dir, args.cache_size * 1024 ** 2, args.offline))
+
+    crawl_started = datetime.now(timezone.utc)
+    since, state_path, previous_route_areas = (read_since(args.since)
+                                               if args.since is not None
+                                               else (None, None, RouteAreaIndex()))
+    scope = CrawlScope(since, args.shard)
+
+    output = open_output(parser, args)
+    output.checkpoint.route_areas.merge(previous_route_areas)
+    failed_runs_before = fetcher.failed_runs()
+    try:
+        if args.use_async:
+            asyncio.run(scrape_async(args.concurrency, output, scope))
+        else:
+            scrape(output, scope, args.prefetch)
+    finally:
+        output.close()
+        if reporter is not None:
+            reporter.stop()
 
-            print(json.dumps(asdict(area)))
-            area_count += 1
+    if args.shard is not None:
+        checkpoint = output.checkpoint
+        write_manifest(args.output + MANIFEST_SUFFIX, args.shard,
+                       scope.selected_area_pages, checkpoint.area_pages,
+                       checkpoint.route_pages, scope.route_page_end,
+                       scope.listed_route_ids | checkpoint.route_ids,
+                       checkpoint.route_areas)
 
-    routes_accumulator = Acc(lambda i: fetcher.fetch_routes(i))
-    for i, route in enumerate(routes_accumulator.generator()):
-        if i % 100 == 0:
-            print(f'routes[{i}]', file=sys.stderr)
+    if state_path is not None:
+        # What a failed fetch missed is only refetched once it changes again,
+        # so a crawl with failures must not become the next --since
+        failed_runs = fetcher.failed_runs() - failed_runs_before
+        if failed_runs > 0:
+            sys.exit('%d fetches failed, not updating %s' % (failed_runs, state_path))
 
-        handle_route(route)
+        write_state(state_path, crawl_started, output.checkpoint.route_areas)
 
 
 if __name__ == '__main__':
-    scrape()
+    main()
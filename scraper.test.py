@@ -0,0 +1,208 @@
+import asyncio
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stderr
+from datetime import datetime, timezone
+from unittest import mock
+
+import fetcher
+from area_index import RouteAreaIndex
+from checkpoint import Checkpoint
+from model import Area, Route, RouteRating
+from scraper import (CrawlOutput, HostLimiter, main, ordered_gather, read_since, scrape,
+                     scrape_async, write_state)
+
+SITEMAP = '''<sitemapindex>
+<sitemap><loc>https://www.mountainproject.com/sitemap-areas-0.xml</loc></sitemap>
+<sitemap><loc>https://www.mountainproject.com/sitemap-areas-1.xml</loc></sitemap>
+</sitemapindex>'''
+
+
+def jitter():
+    # Lets later requests finish before earlier ones
+    time.sleep(random.random() * 0.005)
+
+
+def fake_fetcher():
+    '''
+    Patch the fetcher functions a crawl calls with a small fake site: two area
+    pages of two areas, and two route pages of three routes with one rating
+    each.
+    '''
+
+    def fetch_area_entries(area_page):
+        jitter()
+        return [fetcher.SitemapEntry('area-%s-%d' % (area_page, i), None) for i in range(2)]
+
+    def fetch_area_with_routes(url):
+        jitter()
+        area_id = 100 + int(url[-1]) + 10 * int(url.split('-')[1])
+        return Area(area_id, url, 0.0, 0.0, [area_id, 0]), ['%d' % (area_id * 10)]
+
+    def fetch_route_entries(i):
+        jitter()
+        return [(Route('%d' % (1000 + i * 10 + j), 'Route', 0), None)
+                for j in range(3)] if i < 2 else []
+
+    def fetch_ratings(i, route_id):
+        jitter()
+        return [RouteRating(route_id, 7, ['5.10a'])] if i == 0 else []
+
+    def nothing(i, route_id):
+        return []
+
+    return mock.patch.multiple(fetcher, get_sitemap=lambda: SITEMAP,
+                               fetch_area_entries=fetch_area_entries,
+                               fetch_area_with_routes=fetch_area_with_routes,
+                               fetch_route_entries=fetch_route_entries,
+                               fetch_ratings=fetch_ratings, fetch_ticks=nothing,
+                               fetch_reviews=nothing)
+
+
+class AsyncCrawlTest(unittest.TestCase):
+    def test_host_limiter_bounds_concurrency(self):
+        lock = threading.Lock()
+        running = [0]
+        most = [0]
+
+        def request(i):
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return i
+
+        async def crawl():
+            limiter = HostLimiter(3)
+            return await asyncio.gather(*(limiter.run(request, i) for i in range(12)))
+
+        self.assertListEqual(list(range(12)), asyncio.run(crawl()))
+        self.assertEqual(3, most[0])
+
+    def test_ordered_gather_keeps_order_within_window(self):
+        started = []
+
+        async def work(i):
+            started.append(i)
+            # Later coroutines finish first
+            await asyncio.sleep(0.001 * (10 - i))
+            return i
+
+        async def coroutines():
+            for i in range(10):
+                yield work(i)
+
+        async def gather():
+            results = []
+            async for result in ordered_gather(coroutines(), 3):
+                # Never more than the window scheduled ahead of the result
+                self.assertLessEqual(len(started), result + 3)
+                results.append(result)
+            return results
+
+        self.assertListEqual(list(range(10)), asyncio.run(gather()))
+
+    def test_async_output_matches_sequential(self):
+        with fake_fetcher(), redirect_stderr(io.StringIO()):
+            sequential = CrawlOutput(io.BytesIO(), Checkpoint())
+            scrape(sequential)
+            concurrent = CrawlOutput(io.BytesIO(), Checkpoint())
+            asyncio.run(scrape_async(4, concurrent))
+
+        self.assertEqual(sequential.file.getvalue(), concurrent.file.getvalue())
+        # 4 areas, then 6 routes with a rating each
+        self.assertEqual(16, len(concurrent.file.getvalue().splitlines()))
+        self.assertSetEqual({0, 1}, concurrent.checkpoint.route_pages)
+
+
+class StateFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'state.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_timestamp(self):
+        since, state_path, route_areas = read_since('2024-03-01T00:00:00+02:00')
+        self.assertEqual(datetime(2024, 2, 29, 22, tzinfo=timezone.utc), since)
+        self.assertIsNone(state_path)
+        self.assertEqual(0, len(route_areas))
+
+    def test_missing_state_file_crawls_everything(self):
+        with redirect_stderr(io.StringIO()):
+            since, state_path, route_areas = read_since(self.path)
+        self.assertIsNone(since)
+        self.assertEqual(self.path, state_path)
+        self.assertEqual(0, len(route_areas))
+
+    def test_round_trip(self):
+        started = datetime(2024, 3, 1, 12, 30, tzinfo=timezone.utc)
+        route_areas = RouteAreaIndex()
+        route_areas.add_route_areas({'10': (2, 5), '11': (1, 6)})
+        write_state(self.path, started, route_areas)
+
+        self.assertListEqual(['state.json'], os.listdir(self.directory.name))
+        since, state_path, read_areas = read_since(self.path)
+        self.assertEqual(started, since)
+        self.assertEqual(self.path, state_path)
+        self.assertEqual(5, read_areas.area_id('10'))
+        self.assertEqual(6, read_areas.area_id('11'))
+
+    def test_state_without_route_areas(self):
+        with open(self.path, 'w') as file:
+            json.dump({'crawlStarted': '2024-03-01T12:30:00+00:00'}, file)
+
+        since, _, route_areas = read_since(self.path)
+        self.assertEqual(datetime(2024, 3, 1, 12, 30, tzinfo=timezone.utc), since)
+        self.assertEqual(0, len(route_areas))
+
+    def crawl(self, *arguments):
+        argv = ['scraper.py', '--no-scheduler', '--since', self.path, *arguments]
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with mock.patch('sys.argv', argv), mock.patch('sys.stdout', stdout), \
+                redirect_stderr(io.StringIO()):
+            main()
+
+    def test_crawl_updates_the_state_file(self):
+        with fake_fetcher():
+            self.crawl()
+
+        with open(self.path) as file:
+            self.assertIn('crawlStarted', json.load(file))
+
+    def test_failed_fetch_keeps_the_state_file(self):
+        started = datetime(2024, 3, 1, 12, 30, tzinfo=timezone.utc)
+        write_state(self.path, started, RouteAreaIndex())
+
+        def fetch_route_entries(i):
+            raise ConnectionError('Page %d failed' % i)
+
+        for arguments in ((), ('--async',)):
+            with fake_fetcher(), mock.patch.object(fetcher, 'fetch_route_entries',
+                                                   fetch_route_entries):
+                with self.assertRaises(SystemExit) as raised:
+                    self.crawl(*arguments)
+
+            self.assertEqual('1 fetches failed, not updating %s' % self.path,
+                             raised.exception.code)
+            self.assertEqual(started, read_since(self.path)[0])
+
+    def test_unexpected_state_file(self):
+        with open(self.path, 'w') as file:
+            json.dump({'started': 'yesterday'}, file)
+
+        with self.assertRaises(ValueError):
+            read_since(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
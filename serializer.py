@@ -1,13 +1,46 @@
 '''
 Converts model classes to and from json strings.
+
+from_jsonl() decodes one line at a time through a structural match, which is
+easy to read and extend. from_jsonl_fast() produces the same entities several
+times faster for large dumps, see decode_batch(), and python3 bench_serializer.py
+compares the two. from_jsonl_parallel() spreads the fast path over all cores
+for a regular file, reading it in newline-aligned chunks. from_jsonl_batches()
+and the batched parallel path collect ticks and reviews into model.TickBatch
+and model.ReviewBatch, for consumers like populator.py that take them in bulk.
+from_jsonl_file() picks the path for a file, reading bz2, gzip and xz files
+directly, see compression.py.
+
+Usage, printing the areas in a crawl:
+python3 serializer.py < data.jsonl
+python3 serializer.py data.jsonl[.bz2] [--jobs N]
 '''
 
+import argparse
+import dataclasses
+import itertools
 import json
+import os
 import sys
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from datetime import datetime
-from typing import Any, Callable, Generator, Optional, TextIO, Union
+from operator import attrgetter
+from typing import (Any, BinaryIO, Callable, Deque, Dict, Generator, List, Optional,
+                    TextIO, Tuple, Union)
+
+from compression import compression_of, open_input
+from model import Area, ReviewBatch, Route, RouteRating, RouteReview, RouteTick, TickBatch
+
+try:
+    import orjson
+    _fast_loads = orjson.loads
+except ImportError:
+    _fast_loads = json.loads
 
-from model import Area, Route, RouteRating, RouteReview, RouteTick
+DEFAULT_BATCH_SIZE = 10_000
+DATE_CACHE_SIZE = 100_000
+DEFAULT_CHUNK_BYTES = 16 * 1024 * 1024
 
 
 class SafeCaster:
@@ -41,11 +74,21 @@ def from_json_string(json_string: str) -> (
     except:
         return None
 
+    return from_json_object(obj)
+
+
+def from_json_object(obj: Any) -> (
+  Optional[Union[Area, Route, RouteRating, RouteReview, RouteTick]]):
     result = None
     caster = SafeCaster()
     match obj:
-        case {"routeId": str(route_id), "routeName": route_name}:
+        case {"routeId": str(route_id),
+              "routeName": route_name,
+              "areaId": int(area_id)}:
             # route case
+            result = Route(caster.safe_cast(int, route_id), route_name, area_id)
+        case {"routeId": str(route_id), "routeName": route_name}:
+            # route case, from scrapes that predate areaId
             result = Route(caster.safe_cast(int, route_id), route_name, 0)
         case {"routeId": str(route_id),
               "userId": int(user_id),
@@ -60,8 +103,9 @@ def from_json_string(json_string: str) -> (
             # tick case
             result = RouteTick(caster.safe_cast(int, route_id),
                              user_id, text,
-                             caster.safe_cast(datetime.fromisoformat,
-                                              datestring))
+                             caster.safe_cast(datetime.fromisoformat, datestring)
+                             if datestring is not None
+                             else None)
         case {"route_id": str(route_id),
               "user_id": int(user_id),
               "score": int(score)}:
@@ -92,7 +136,350 @@ def from_jsonl(file: TextIO) -> Generator[
             yield object
 
 
+def _decode_route(obj, dates):
+    area_id = obj.get('areaId', 0)
+    if type(obj['routeId']) is not str or not isinstance(area_id, int):
+        return None
+
+    return Route(int(obj['routeId']), obj['routeName'], area_id)
+
+
+def _decode_rating(obj, dates):
+    user_id = obj['userId']
+    ratings = obj['ratings']
+    if (type(obj['routeId']) is not str or not isinstance(user_id, int)
+            or type(ratings) is not list):
+        return None
+
+    return RouteRating(int(obj['routeId']), user_id, ratings)
+
+
+def _decode_tick(obj, dates: Dict[str, datetime]):
+    user_id = obj['userId']
+    text = obj['text']
+    datestring = obj['date']
+    if (type(obj['routeId']) is not str or not isinstance(user_id, int)
+            or type(text) is not str
+            or (datestring is not None and type(datestring) is not str)):
+        return None
+
+    # Ticks share few distinct dates, so reuse the parsed (immutable) datetime
+    date = dates.get(datestring)
+    if date is None and datestring is not None:
+        date = datetime.fromisoformat(datestring)
+        if len(dates) < DATE_CACHE_SIZE:
+            dates[datestring] = date
+
+    return RouteTick(int(obj['routeId']), user_id, text, date)
+
+
+def _decode_review(obj, dates):
+    user_id = obj['user_id']
+    score = obj['score']
+    if (type(obj['route_id']) is not str or not isinstance(user_id, int)
+            or not isinstance(score, int)):
+        return None
+
+    return RouteReview(int(obj['route_id']), user_id, score)
+
+
+def _decode_area(obj, dates):
+    area_id = obj['area_id']
+    area_name = obj['area_name']
+    latitude = obj['latitude']
+    longitude = obj['longitude']
+    chain = obj['area_chain']
+    if (not isinstance(area_id, int) or type(area_name) is not str
+            or type(latitude) is not float or type(longitude) is not float
+            or type(chain) is not list):
+        return None
+
+    return Area(area_id, area_name, latitude, longitude, [int(x) for x in chain])
+
+
+# Decoders for the exact key sets scraper.py writes. Each returns None when a
+# value does not have the expected type, leaving the object to
+# from_json_object(). dates caches parsed tick dates across a batch.
+_DECODERS_BY_KEYS = {
+    frozenset(('routeId', 'routeName', 'areaId')): _decode_route,
+    frozenset(('routeId', 'routeName')): _decode_route,
+    frozenset(('routeId', 'userId', 'ratings')): _decode_rating,
+    frozenset(('routeId', 'userId', 'text', 'date')): _decode_tick,
+    frozenset(('route_id', 'user_id', 'score')): _decode_review,
+    frozenset(('area_id', 'area_name', 'latitude', 'longitude', 'area_chain')): _decode_area,
+}
+
+
+def decode_batch(lines: List[Union[str, bytes]],
+                 dates: Optional[Dict[str, datetime]] = None,
+                 ticks: Optional[TickBatch] = None,
+                 reviews: Optional[ReviewBatch] = None) -> List[
+  Union[Area, Route, RouteRating, RouteReview, RouteTick]]:
+    '''
+    Decode a batch of jsonl lines, dropping the ones from_json_string() would
+    return None for. The result is the same as from_json_string() on each
+    line, including what is logged for unexpected objects and failed casts,
+    but the common shapes skip the structural match and the SafeCaster.
+
+    If ticks or reviews are given, ticks or reviews are appended to them
+    instead of the result.
+    '''
+
+    if dates is None:
+        dates = {}
+
+    loads = _fast_loads
+    decoders = _DECODERS_BY_KEYS
+    result = []
+    append = result.append
+
+    for line in lines:
+        try:
+            obj = loads(line)
+        except Exception:
+            continue
+
+        entity = None
+        decoder = decoders.get(frozenset(obj)) if type(obj) is dict else None
+        if decoder is not None:
+            try:
+                entity = decoder(obj, dates)
+            except ValueError:
+                entity = None
+
+        if entity is None:
+            # Unusual shape or value, take the slow path for its error
+            # accounting
+            entity = from_json_object(obj)
+
+        if entity is None:
+            continue
+
+        if ticks is not None and type(entity) is RouteTick:
+            ticks.append_tick(entity)
+        elif reviews is not None and type(entity) is RouteReview:
+            try:
+                reviews.append_review(entity)
+            except OverflowError:
+                append(entity)
+        else:
+            append(entity)
+
+    return result
+
+
+def from_jsonl_batches(file: Union[TextIO, BinaryIO],
+                       batch_size: int = DEFAULT_BATCH_SIZE) -> Generator[
+  Union[Area, Route, RouteRating, RouteReview, RouteTick, TickBatch, ReviewBatch],
+  None, None]:
+    '''
+    Like from_jsonl_fast(), but the ticks and reviews of every batch_size lines
+    come as one TickBatch and one ReviewBatch, after that batch's other
+    entities. Only the order between entity types differs.
+    '''
+
+    dates = {}
+    while True:
+        lines = list(itertools.islice(file, batch_size))
+        if not lines:
+            return
+
+        ticks = TickBatch()
+        reviews = ReviewBatch()
+        yield from decode_batch(lines, dates, ticks, reviews)
+        yield from _nonempty(ticks, reviews)
+
+
+def _nonempty(*batches: Union[TickBatch, ReviewBatch]) -> List[Union[TickBatch, ReviewBatch]]:
+    return [batch for batch in batches if len(batch) > 0]
+
+
+def from_jsonl_fast(file: Union[TextIO, BinaryIO], batch_size: int = DEFAULT_BATCH_SIZE
+                    ) -> Generator[Union[Area, Route, RouteRating, RouteReview, RouteTick],
+                                   None, None]:
+    '''
+    Same entities as from_jsonl(), decoded in batches with decode_batch().
+    Accepts text or binary files; binary files skip a decode step, and use
+    orjson when it is installed.
+    '''
+
+    dates = {}
+    while True:
+        lines = list(itertools.islice(file, batch_size))
+        if not lines:
+            return
+
+        yield from decode_batch(lines, dates)
+
+
+def chunk_ranges(path: str, chunk_size: int = DEFAULT_CHUNK_BYTES) -> List[Tuple[int, int]]:
+    '''
+    Split the file at path into [start, end) byte ranges of about chunk_size
+    bytes, each starting at the beginning of a line and ending after a
+    newline (or at the end of the file). Only reads one line per range.
+    '''
+
+    size = os.path.getsize(path)
+    starts = [0]
+    with open(path, 'rb') as file:
+        for offset in range(chunk_size, size, chunk_size):
+            if offset <= starts[-1]:
+                # The previous range ran past this offset in a long line
+                continue
+
+            # Move to the start of the first line at or after offset
+            file.seek(offset - 1)
+            file.readline()
+            if file.tell() < size:
+                starts.append(file.tell())
+
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def decode_chunk(path: str, start: int, end: int,
+                 ticks: Optional[TickBatch] = None,
+                 reviews: Optional[ReviewBatch] = None) -> List[
+  Union[Area, Route, RouteRating, RouteReview, RouteTick]]:
+    with open(path, 'rb') as file:
+        file.seek(start)
+        return decode_batch(file.read(end - start).splitlines(),
+                            ticks=ticks, reviews=reviews)
+
+
+# Sending model objects between processes as they are costs more to unpickle
+# than to decode the json in the first place, so chunks travel as one kind
+# byte per entity plus a column of field values per type
+_PACKED_TYPES = (Route, RouteRating, RouteTick, RouteReview, Area)
+_PACKED_KINDS = {entity_type: kind for kind, entity_type in enumerate(_PACKED_TYPES)}
+_FIELD_GETTERS = tuple(attrgetter(*(field.name for field in dataclasses.fields(entity_type)))
+                       for entity_type in _PACKED_TYPES)
+
+PackedEntities = Tuple[bytes, List[List[Tuple]]]
+
+
+def _pack(entities: List[Union[Area, Route, RouteRating, RouteReview, RouteTick]]
+          ) -> PackedEntities:
+    kinds = bytearray()
+    rows = [[] for _ in _PACKED_TYPES]
+    for entity in entities:
+        kind = _PACKED_KINDS[type(entity)]
+        kinds.append(kind)
+        rows[kind].append(_FIELD_GETTERS[kind](entity))
+
+    return bytes(kinds), [list(zip(*type_rows)) for type_rows in rows]
+
+
+def _unpack(packed: PackedEntities) -> List[
+  Union[Area, Route, RouteRating, RouteReview, RouteTick]]:
+    kinds, columns = packed
+    # A type missing from the chunk has no columns, and its kind never occurs
+    next_entities = [map(entity_type, *type_columns).__next__ if type_columns else None
+                     for entity_type, type_columns in zip(_PACKED_TYPES, columns)]
+    return [next_entities[kind]() for kind in kinds]
+
+
+def _decode_packed_chunk(path: str, start: int, end: int, batched: bool) -> Tuple[
+  PackedEntities, List[Union[TickBatch, ReviewBatch]]]:
+    if not batched:
+        return _pack(decode_chunk(path, start, end)), []
+
+    # Batches pickle as a few arrays, much cheaper still than packed entities
+    ticks = TickBatch()
+    reviews = ReviewBatch()
+    entities = decode_chunk(path, start, end, ticks, reviews)
+    return _pack(entities), _nonempty(ticks, reviews)
+
+
+def _unpack_chunk(packed_chunk: Tuple[PackedEntities, List[Union[TickBatch, ReviewBatch]]]
+                  ) -> List[Union[Area, Route, RouteRating, RouteReview, RouteTick,
+                                  TickBatch, ReviewBatch]]:
+    packed, batches = packed_chunk
+    return _unpack(packed) + batches
+
+
+def from_jsonl_chunks(path: str, jobs: Optional[int] = None,
+                      chunk_size: int = DEFAULT_CHUNK_BYTES, batched: bool = False
+                      ) -> Generator[List[Union[Area, Route, RouteRating, RouteReview,
+                                                RouteTick, TickBatch, ReviewBatch]],
+                                     None, None]:
+    '''
+    Decode the jsonl file at path in jobs processes (all cores by default),
+    yielding the entities of each chunk_ranges() range as a list, in file
+    order. At most two chunks per process are decoded ahead of the consumer,
+    so memory stays bounded however large the file is. If batched, each
+    chunk's ticks and reviews come last as a TickBatch and a ReviewBatch, as
+    in from_jsonl_batches().
+    '''
+
+    jobs = jobs or os.cpu_count() or 1
+    ranges = iter(chunk_ranges(path, chunk_size))
+    pending: Deque[Future] = deque()
+    with ProcessPoolExecutor(jobs) as executor:
+        try:
+            while True:
+                while len(pending) < 2 * jobs:
+                    chunk = next(ranges, None)
+                    if chunk is None:
+                        break
+
+                    pending.append(executor.submit(_decode_packed_chunk, path, *chunk,
+                                                   batched))
+
+                if not pending:
+                    return
+
+                yield _unpack_chunk(pending.popleft().result())
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def from_jsonl_parallel(path: str, jobs: Optional[int] = None,
+                        chunk_size: int = DEFAULT_CHUNK_BYTES, batched: bool = False
+                        ) -> Generator[Union[Area, Route, RouteRating, RouteReview, RouteTick,
+                                             TickBatch, ReviewBatch], None, None]:
+    '''
+    Same entities, in the same order, as from_jsonl() on the file at path
+    (or as from_jsonl_batches() if batched), decoded across processes with
+    from_jsonl_chunks().
+    '''
+
+    for chunk in from_jsonl_chunks(path, jobs, chunk_size, batched):
+        yield from chunk
+
+
+def from_jsonl_file(path: str, jobs: Optional[int] = 1, batched: bool = False
+                    ) -> Generator[Union[Area, Route, RouteRating, RouteReview, RouteTick,
+                                         TickBatch, ReviewBatch], None, None]:
+    '''
+    Same entities as from_jsonl_fast() on the file at path (or as
+    from_jsonl_batches() if batched). A compressed file is decompressed on
+    jobs threads and decoded in this process, see compression.open_input().
+    Otherwise jobs other than 1 decode the file with from_jsonl_parallel().
+    None means all cores.
+    '''
+
+    if compression_of(path) is None and jobs != 1:
+        yield from from_jsonl_parallel(path, jobs, batched=batched)
+        return
+
+    with open_input(path, jobs) as file:
+        yield from (from_jsonl_batches(file) if batched else from_jsonl_fast(file))
+
+
 if __name__ == '__main__':
-    for object in from_jsonl(sys.stdin):
+    parser = argparse.ArgumentParser(description='Print the areas in a scraper.py jsonl output.')
+    parser.add_argument('path', nargs='?',
+                        help='Read this file instead of stdin, decoding it on all cores, '
+                             'or decompressing it on all cores if it is compressed')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Processes decoding the file, or threads decompressing it, '
+                             'defaults to the number of cores')
+    args = parser.parse_args()
+
+    entities = (from_jsonl_file(args.path, args.jobs)
+                if args.path is not None
+                else from_jsonl(sys.stdin))
+    for object in entities:
         if isinstance(object, Area):
             print(object)
@@ -0,0 +1,123 @@
+import io
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+
+from model import ReviewBatch, RouteReview, RouteTick, TickBatch
+from serializer import (chunk_ranges, decode_batch, from_json_string, from_jsonl,
+                        from_jsonl_batches, from_jsonl_fast, from_jsonl_parallel)
+
+
+def expand_batches(entities):
+    for entity in entities:
+        if isinstance(entity, (TickBatch, ReviewBatch)):
+            yield from entity
+        else:
+            yield entity
+
+
+LINES = [
+    '{"area_id": 1, "area_name": "A", "latitude": 40.5, "longitude": -105.25, '
+    '"area_chain": [1, 0]}',
+    '{"routeId": "10", "routeName": "R", "areaId": 1}',
+    '{"routeId": "11", "routeName": "Old"}',
+    '{"routeId": "12", "routeName": "Null area", "areaId": null}',
+    '{"routeId": "10", "userId": 7, "ratings": ["5.10a", "PG13"]}',
+    '{"routeId": "10", "userId": 7, "text": "Sent", "date": "2020-05-01T00:00:00"}',
+    '{"routeId": "10", "userId": 8, "text": "", "date": "2020-05-01T00:00:00"}',
+    '{"routeId": "10", "userId": 9, "text": "Undated", "date": null}',
+    '{"route_id": "10", "user_id": 7, "score": 4}',
+    # The ones below are rejected, or only match through the slow path
+    '{"routeId": "10", "userId": 7, "text": "Bad date", "date": "yesterday"}',
+    '{"routeId": "x", "userId": 7, "ratings": []}',
+    '{"area_id": 2, "area_name": "Int coords", "latitude": 40, "longitude": -105, '
+    '"area_chain": [2, 0]}',
+    '{"routeId": "13", "routeName": "Extra key", "areaId": 1, "grade": "5.9"}',
+    '{"unexpected": true}',
+    '[1, 2]',
+    'not json',
+    '',
+]
+
+
+class DecodeBatchTest(unittest.TestCase):
+    def test_same_entities_as_from_json_string(self):
+        with redirect_stderr(io.StringIO()):
+            expected = [entity
+                        for entity in map(from_json_string, LINES)
+                        if entity is not None]
+            self.assertListEqual(expected, decode_batch(LINES))
+
+    def test_same_errors_logged(self):
+        expected_log = io.StringIO()
+        with redirect_stderr(expected_log):
+            list(from_jsonl(io.StringIO('\n'.join(LINES))))
+
+        log = io.StringIO()
+        with redirect_stderr(log):
+            list(from_jsonl_fast(io.BytesIO('\n'.join(LINES).encode())))
+
+        self.assertEqual(expected_log.getvalue(), log.getvalue())
+
+    def test_batches_preserve_order(self):
+        text = '\n'.join(LINES[:9] * 10)
+        with redirect_stderr(io.StringIO()):
+            self.assertListEqual(list(from_jsonl(io.StringIO(text))),
+                                 list(from_jsonl_fast(io.StringIO(text), batch_size=3)))
+
+    def test_batches_hold_ticks_and_reviews(self):
+        text = '\n'.join(LINES[:9] * 10)
+        with redirect_stderr(io.StringIO()):
+            expected = list(from_jsonl(io.StringIO(text)))
+            entities = list(from_jsonl_batches(io.BytesIO(text.encode()), batch_size=16))
+
+        self.assertFalse(any(isinstance(entity, (RouteTick, RouteReview))
+                             for entity in entities))
+        key = lambda entity: (type(entity).__name__, repr(entity))
+        self.assertListEqual(sorted(expected, key=key),
+                             sorted(expand_batches(entities), key=key))
+
+        ticks = next(entity for entity in entities if isinstance(entity, TickBatch))
+        self.assertEqual(2, len(ticks.dates))
+        self.assertIn((10, 7, 'Sent', '2020-05-01T00:00:00'), list(ticks.rows()))
+        self.assertIn((10, 9, 'Undated', None), list(ticks.rows()))
+
+
+class ParallelTest(unittest.TestCase):
+    def setUp(self):
+        file, self.path = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(file, 'w') as file:
+            file.write('\n'.join(LINES[:9] * 50) + '\n')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_chunk_ranges_cover_whole_lines(self):
+        with open(self.path, 'rb') as file:
+            data = file.read()
+
+        ranges = chunk_ranges(self.path, chunk_size=100)
+        self.assertEqual(0, ranges[0][0])
+        self.assertEqual(len(data), ranges[-1][1])
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(b'\n'[0], data[start - 1])
+
+    def test_same_entities_in_order(self):
+        with open(self.path) as file:
+            expected = list(from_jsonl(file))
+
+        self.assertListEqual(expected,
+                             list(from_jsonl_parallel(self.path, jobs=2, chunk_size=300)))
+
+    def test_batched(self):
+        with open(self.path, 'rb') as file:
+            expected = list(from_jsonl_batches(file, batch_size=10**6))
+
+        chunks = from_jsonl_parallel(self.path, jobs=2, chunk_size=10**6, batched=True)
+        self.assertListEqual(list(expand_batches(expected)), list(expand_batches(chunks)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+'''
+shards.py
+
+Splits a crawl across N workers and merges their output.
+
+`scraper.py --shard i/N --output shard-i.jsonl` crawls only the area sitemap
+pages and route sitemap pages whose number is i modulo N. When a shard
+finishes, it writes a manifest next to its output (shard-i.jsonl.manifest)
+recording the pages it was assigned and finished, the routes it was expected
+to emit, and the route to area index built from its area pages.
+
+Usage:
+python3 shards.py OUTPUT SHARD_OUTPUT...
+
+The merge checks that every shard of the same split is present and finished
+all of its pages, that no route id is missing, and that no route id appears
+twice. It then writes every area, followed by every route with its ratings,
+ticks and reviews, in shard order. A route emitted by more than one shard is
+kept once. Route areaIds are taken from the combined index wherever it has
+the route, since a route's deepest area page may have been crawled by another
+shard.
+
+Shard outputs and the merged output may be compressed, see compression.py.
+'''
+
+import json
+import sys
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+
+from area_index import RouteAreaIndex
+from compression import open_input, open_output
+
+MANIFEST_SUFFIX = '.manifest'
+
+
+@dataclass(frozen=True)
+class ShardSpec:
+    index: int
+    count: int
+
+    @staticmethod
+    def parse(text: str) -> 'ShardSpec':
+        '''
+        Parse "i/N", e.g. "0/4" for the first of four shards.
+        '''
+
+        index, count = map(int, text.split('/'))
+        if not 0 <= index < count:
+            raise ValueError('Shard index must be in [0, %d), got %d' % (count, index))
+
+        return ShardSpec(index, count)
+
+    def owns(self, page) -> bool:
+        return int(page) % self.count == self.index
+
+    def __str__(self):
+        return '%d/%d' % (self.index, self.count)
+
+
+def write_manifest(path: str, shard: ShardSpec, assigned_area_pages: List[str],
+                   finished_area_pages: Set[str], finished_route_pages: Set[int],
+                   route_page_end: Optional[int], expected_route_ids: Set[str],
+                   route_areas: RouteAreaIndex):
+    with open(path, 'w') as file:
+        json.dump({
+            'shard': [shard.index, shard.count],
+            'assignedAreaPages': sorted(assigned_area_pages, key=int),
+            'finishedAreaPages': sorted(finished_area_pages, key=int),
+            'finishedRoutePages': sorted(finished_route_pages),
+            'routePageEnd': route_page_end,
+            'expectedRouteIds': sorted(expected_route_ids, key=int),
+            'routeAreas': route_areas.to_json(),
+        }, file)
+
+
+def read_manifests(shard_paths: List[str]) -> Tuple[List[dict], List[str]]:
+    '''
+    Return the manifests of the shard outputs that have one, and a
+    description of every one that is missing or unreadable.
+    '''
+
+    manifests = []
+    problems = []
+    for path in shard_paths:
+        try:
+            with open(path + MANIFEST_SUFFIX) as file:
+                manifests.append(json.load(file))
+        except FileNotFoundError:
+            problems.append('%s has no manifest, the shard did not finish' % path)
+        except ValueError as e:
+            problems.append('Could not read the manifest of %s: %s' % (path, e))
+
+    return manifests, problems
+
+
+def verify_pages(manifests: List[dict]) -> List[str]:
+    '''
+    Return a description of every problem with the shards' page coverage.
+    '''
+
+    problems = []
+    counts = {manifest['shard'][1] for manifest in manifests}
+    if len(counts) != 1:
+        return ['Shards come from different splits: %s' % sorted(counts)]
+
+    count = counts.pop()
+    indices = sorted(manifest['shard'][0] for manifest in manifests)
+    if indices != list(range(count)):
+        problems.append('Expected shards 0..%d, got %s' % (count - 1, indices))
+
+    finished_route_pages = set()
+    route_page_ends = []
+    for manifest in manifests:
+        shard = ShardSpec(*manifest['shard'])
+        unfinished = (set(manifest['assignedAreaPages'])
+                      - set(manifest['finishedAreaPages']))
+        if unfinished:
+            problems.append('Shard %s did not finish area pages %s'
+                            % (shard, sorted(unfinished, key=int)))
+
+        if manifest['routePageEnd'] is None:
+            problems.append('Shard %s did not reach the last route page' % shard)
+        else:
+            route_page_ends.append(manifest['routePageEnd'])
+
+        finished_route_pages.update(manifest['finishedRoutePages'])
+
+    # Every shard stops at its first empty page. Only an empty page past every
+    # finished one is an end of the route sitemap pages; a shard that found an
+    # earlier page empty stopped early, and all of its later pages are missing.
+    if route_page_ends:
+        last_finished = max(finished_route_pages, default=-1)
+        ends = {end for end in route_page_ends if end > last_finished}
+        missing = set(range(max(route_page_ends))) - finished_route_pages - ends
+        if missing:
+            problems.append('Route pages %s were not finished' % sorted(missing))
+
+    return problems
+
+
+def is_route_line(line: bytes) -> bool:
+    # Cheap test before parsing, route lines are the only ones with a name
+    return line.startswith(b'{"routeId"') and b'"routeName"' in line
+
+
+def merge(output: BinaryIO, shard_paths: List[str]) -> List[str]:
+    '''
+    Merge shard outputs into output, see the module docstring. Return a
+    description of every coverage problem found.
+    '''
+
+    manifests, problems = read_manifests(shard_paths)
+    if manifests:
+        problems.extend(verify_pages(manifests))
+
+    route_areas = RouteAreaIndex()
+    expected_route_ids = set()
+    for manifest in manifests:
+        route_areas.merge(RouteAreaIndex.from_json(manifest['routeAreas']))
+        expected_route_ids.update(manifest['expectedRouteIds'])
+
+    # Areas first, then routes, so the merged file reads like a single crawl
+    for path in shard_paths:
+        with open_input(path) as file:
+            for line in file:
+                if line.startswith(b'{"area_id"'):
+                    output.write(line)
+
+    seen_route_ids = set()
+    duplicate_route_ids = set()
+    for path in shard_paths:
+        with open_input(path) as file:
+            skipping = True
+            for line in file:
+                if line.startswith(b'{"area_id"'):
+                    continue
+
+                if is_route_line(line):
+                    route = json.loads(line)
+                    route_id = route['routeId']
+                    skipping = route_id in seen_route_ids
+                    if skipping:
+                        duplicate_route_ids.add(route_id)
+                        continue
+
+                    seen_route_ids.add(route_id)
+                    area_id = route_areas.area_id(route_id)
+                    if area_id != 0 and area_id != route.get('areaId'):
+                        route['areaId'] = area_id
+                        line = json.dumps(route).encode() + b'\n'
+
+                if not skipping:
+                    output.write(line)
+
+    if duplicate_route_ids:
+        problems.append('%d routes were emitted by more than one shard, kept the first: %s'
+                        % (len(duplicate_route_ids), sorted(duplicate_route_ids, key=int)[:10]))
+
+    missing_route_ids = expected_route_ids - seen_route_ids
+    if missing_route_ids:
+        problems.append('%d routes are missing: %s'
+                        % (len(missing_route_ids), sorted(missing_route_ids, key=int)[:10]))
+
+    return problems
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(f'Usage: {sys.argv[0]} output shard_output...', file=sys.stderr)
+        exit(1)
+
+    with open_output(sys.argv[1]) as output:
+        problems = merge(output, sys.argv[2:])
+
+    for problem in problems:
+        print('ERROR: ' + problem, file=sys.stderr)
+
+    exit(1 if problems else 0)
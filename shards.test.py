@@ -0,0 +1,119 @@
+import io
+import os
+import tempfile
+import unittest
+
+from area_index import RouteAreaIndex
+from shards import ShardSpec, merge, verify_pages, write_manifest
+
+
+def manifest(index: int, count: int, route_page_end, finished_route_pages,
+             assigned_area_pages=(), finished_area_pages=()) -> dict:
+    return {
+        'shard': [index, count],
+        'assignedAreaPages': list(assigned_area_pages),
+        'finishedAreaPages': list(finished_area_pages),
+        'finishedRoutePages': list(finished_route_pages),
+        'routePageEnd': route_page_end,
+        'expectedRouteIds': [],
+        'routeAreas': {},
+    }
+
+
+class VerifyPagesTest(unittest.TestCase):
+    def test_complete(self):
+        # Pages 0-3 have routes, so shard 0 stops at page 4 and shard 1 at 5
+        self.assertListEqual([], verify_pages([manifest(0, 2, 4, [0, 2]),
+                                               manifest(1, 2, 5, [1, 3])]))
+
+    def test_gap(self):
+        self.assertListEqual(['Route pages [2] were not finished'],
+                             verify_pages([manifest(0, 2, 4, [0]),
+                                           manifest(1, 2, 5, [1, 3])]))
+
+    def test_shard_that_ended_early(self):
+        # Shard 0 found page 2 empty, but shard 1 finished page 3 after it
+        self.assertListEqual(['Route pages [2, 4] were not finished'],
+                             verify_pages([manifest(0, 2, 2, [0]),
+                                           manifest(1, 2, 5, [1, 3])]))
+
+    def test_unfinished_shards(self):
+        self.assertListEqual([
+            'Expected shards 0..2, got [0, 1]',
+            "Shard 0/3 did not finish area pages ['3']",
+            'Shard 1/3 did not reach the last route page',
+            # The missing shard 2
+            'Route pages [2] were not finished',
+        ], verify_pages([manifest(0, 3, 3, [0], ['0', '3'], ['0']),
+                         manifest(1, 3, None, [1])]))
+
+    def test_different_splits(self):
+        self.assertListEqual(['Shards come from different splits: [2, 3]'],
+                             verify_pages([manifest(0, 2, 2, [0, 1]),
+                                           manifest(1, 3, 2, [0, 1])]))
+
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_shard(self, index: int, lines, route_areas, expected_route_ids):
+        path = os.path.join(self.directory.name, 'shard-%d.jsonl' % index)
+        with open(path, 'w') as file:
+            file.writelines(line + '\n' for line in lines)
+
+        index_ = RouteAreaIndex()
+        index_.add_route_areas(route_areas)
+        write_manifest(path + '.manifest', ShardSpec(index, 2), [str(index)], {str(index)},
+                       {index}, index + 2, expected_route_ids, index_)
+        return path
+
+    def test_merge(self):
+        paths = [
+            self.write_shard(0, [
+                '{"area_id": 1, "area_name": "Crag", "latitude": 0.0, "longitude": 0.0, '
+                '"area_chain": [1, 0]}',
+                '{"routeId": "10", "routeName": "A", "areaId": 1}',
+                '{"routeId": "10", "userId": 7, "ratings": ["5.9"]}',
+                '{"routeId": "11", "routeName": "B", "areaId": 0}',
+            ], {'10': (2, 1), '11': (2, 1)}, {'10', '11'}),
+            self.write_shard(1, [
+                '{"area_id": 2, "area_name": "Wall", "latitude": 0.0, "longitude": 0.0, '
+                '"area_chain": [2, 1, 0]}',
+                '{"routeId": "11", "routeName": "B", "areaId": 0}',
+                '{"routeId": "11", "userId": 8, "ratings": ["5.8"]}',
+            ], {'10': (3, 2)}, {'10', '12'}),
+        ]
+
+        output = io.BytesIO()
+        problems = merge(output, paths)
+        self.assertListEqual([
+            "1 routes were emitted by more than one shard, kept the first: ['11']",
+            "1 routes are missing: ['12']",
+        ], problems)
+        self.assertListEqual([
+            b'{"area_id": 1, "area_name": "Crag", "latitude": 0.0, "longitude": 0.0, '
+            b'"area_chain": [1, 0]}',
+            b'{"area_id": 2, "area_name": "Wall", "latitude": 0.0, "longitude": 0.0, '
+            b'"area_chain": [2, 1, 0]}',
+            # The deeper area found by shard 1 replaces the one shard 0 wrote
+            b'{"routeId": "10", "routeName": "A", "areaId": 2}',
+            b'{"routeId": "10", "userId": 7, "ratings": ["5.9"]}',
+            b'{"routeId": "11", "routeName": "B", "areaId": 1}',
+        ], output.getvalue().splitlines())
+
+    def test_missing_manifest(self):
+        paths = [self.write_shard(0, [], {}, set()), self.write_shard(1, [], {}, set())]
+        os.remove(paths[1] + '.manifest')
+
+        self.assertListEqual(['%s has no manifest, the shard did not finish' % paths[1],
+                              'Expected shards 0..1, got [0]',
+                              'Route pages [1] were not finished'],
+                             merge(io.BytesIO(), paths))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,321 @@
+'''
+snapshot.py
+
+Exports the tables populator.py fills to a columnar snapshot that analyses
+and recommenders open with mmap, instead of re-reading SQLite row by row
+through pandas on every call.
+
+A snapshot is a directory with one subdirectory per table and one .npy file
+per column. Integer and real columns are stored as int64 and float64 arrays,
+with NULL as NULL_INTEGER and NaN. Text columns are dictionary-encoded: an
+int32 array of codes (-1 for NULL) plus the distinct strings, as utf-8 bytes
+back to back in <column>.strings with their offsets in <column>.offsets.npy.
+
+snapshot.json, written last, records the state of the database file the
+snapshot was taken from: the file change counter from its header (which
+SQLite increments on every committed write in rollback journal mode), its
+size and modification time, and those of its -wal file. A snapshot whose
+record does not match the database any more is stale.
+
+Usage:
+python3 snapshot.py DATABASE [DIRECTORY] [--force]
+
+DIRECTORY defaults to DATABASE.snapshot, which is where open_snapshot()
+looks by default. A new snapshot is exported next to DIRECTORY and then takes
+its place, so readers never see a partial one. An existing DIRECTORY that is
+not a snapshot is only replaced with --force.
+'''
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+SNAPSHOT_SUFFIX = '.snapshot'
+METADATA_FILE_NAME = 'snapshot.json'
+NULL_INTEGER = np.iinfo(np.int64).min
+# Rows read from SQLite at a time while exporting
+EXPORT_CHUNK_ROWS = 100_000
+
+# Column kinds: integer, real or text
+SNAPSHOT_TABLES: Dict[str, Tuple[Tuple[str, str], ...]] = {
+    'areas': (('id', 'integer'), ('name', 'text'), ('latitude', 'real'),
+              ('longitude', 'real'), ('parent_id', 'integer')),
+    'routes': (('id', 'integer'), ('name', 'text'), ('area_id', 'integer')),
+    'ratings': (('route_id', 'integer'), ('user_id', 'integer'), ('rating', 'text')),
+    'ticks': (('route_id', 'integer'), ('user_id', 'integer'), ('text', 'text'),
+              ('date', 'text')),
+    'reviews': (('route_id', 'integer'), ('user_id', 'integer'), ('score', 'integer')),
+}
+
+
+def default_directory(db_path: str) -> str:
+    return db_path + SNAPSHOT_SUFFIX
+
+
+def _file_stamp(path: str) -> Optional[List[int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def database_stamp(db_path: str) -> dict:
+    '''
+    What a snapshot records about the database it was taken from, see the
+    module docstring.
+    '''
+
+    with open(db_path, 'rb') as file:
+        header = file.read(100)
+
+    return {
+        'changeCounter': int.from_bytes(header[24:28], 'big') if len(header) == 100 else 0,
+        'file': _file_stamp(db_path),
+        'wal': _file_stamp(db_path + '-wal'),
+    }
+
+
+@contextmanager
+def replacing_directory(directory: str) -> Iterator[str]:
+    '''
+    Yield a new directory next to directory to build its replacement in.
+    Once the block finishes it takes directory's place, which until then is
+    left as it was; if the block fails, it is removed instead.
+    '''
+
+    building = '%s.%d.tmp' % (os.path.normpath(directory), os.getpid())
+    if os.path.exists(building):
+        shutil.rmtree(building)
+    os.makedirs(building)
+    try:
+        yield building
+    except BaseException:
+        shutil.rmtree(building, ignore_errors=True)
+        raise
+
+    # A directory can only be renamed over an empty one, so the old one is
+    # moved aside first. Readers that mapped its files keep them.
+    previous = building + '.old'
+    if os.path.exists(directory):
+        os.replace(directory, previous)
+    os.replace(building, directory)
+    if os.path.exists(previous):
+        shutil.rmtree(previous)
+
+
+class StringColumn:
+    '''
+    A dictionary-encoded text column: codes[i] indexes the ith row's string,
+    or is -1 for NULL.
+    '''
+
+    codes: np.ndarray
+
+    def __init__(self, codes: np.ndarray, offsets: np.ndarray, strings: Union[np.ndarray, bytes]):
+        self.codes = codes
+        self._offsets = offsets
+        self._strings = strings
+        self._dictionary: Optional[List[str]] = None
+
+    def string(self, code: int) -> Optional[str]:
+        if code < 0:
+            return None
+
+        return bytes(self._strings[self._offsets[code]:self._offsets[code + 1]]).decode()
+
+    def dictionary(self) -> List[str]:
+        '''
+        Every distinct string, decoded once and cached.
+        '''
+
+        if self._dictionary is None:
+            self._dictionary = [self.string(code) for code in range(len(self._offsets) - 1)]
+
+        return self._dictionary
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, i: int) -> Optional[str]:
+        return self.string(int(self.codes[i]))
+
+
+Column = Union[np.ndarray, StringColumn]
+
+
+class Snapshot:
+    '''
+    An exported snapshot. Columns are memory-mapped read-only when first
+    used, so opening a snapshot reads nothing but its metadata.
+    '''
+
+    directory: str
+    metadata: dict
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, METADATA_FILE_NAME)) as file:
+            self.metadata = json.load(file)
+
+        self._tables: Dict[str, Dict[str, Column]] = {}
+
+    def is_fresh(self, db_path: str) -> bool:
+        return self.metadata['stamp'] == database_stamp(db_path)
+
+    def _load_column(self, table: str, column: str, kind: str) -> Column:
+        base = os.path.join(self.directory, table, column)
+        if kind != 'text':
+            return np.load(base + '.npy', mmap_mode='r')
+
+        codes = np.load(base + '.npy', mmap_mode='r')
+        offsets = np.load(base + '.offsets.npy', mmap_mode='r')
+        strings = (np.memmap(base + '.strings', dtype=np.uint8, mode='r')
+                   if os.path.getsize(base + '.strings') > 0
+                   else b'')
+        return StringColumn(codes, offsets, strings)
+
+    def table(self, name: str) -> Dict[str, Column]:
+        if name not in self._tables:
+            columns = self.metadata['tables'][name]['columns']
+            self._tables[name] = {column: self._load_column(name, column, kind)
+                                  for column, kind in columns.items()}
+
+        return self._tables[name]
+
+    def rows(self, name: str) -> int:
+        return self.metadata['tables'][name]['rows']
+
+
+def _export_table(cursor: sqlite3.Cursor, table: str, columns: Tuple[Tuple[str, str], ...],
+                  directory: str) -> int:
+    os.makedirs(directory)
+    rows = cursor.execute('SELECT count(*) FROM %s' % table).fetchone()[0]
+
+    arrays = []
+    dictionaries = []
+    for column, kind in columns:
+        dtype = {'integer': np.int64, 'real': np.float64, 'text': np.int32}[kind]
+        arrays.append(np.lib.format.open_memmap(os.path.join(directory, column + '.npy'),
+                                                mode='w+', dtype=dtype, shape=(rows,)))
+        dictionaries.append({} if kind == 'text' else None)
+
+    cursor.execute('SELECT %s FROM %s' % (', '.join('`%s`' % column for column, _ in columns),
+                                          table))
+    start = 0
+    # The count and the rows come from the same read transaction
+    while chunk := cursor.fetchmany(EXPORT_CHUNK_ROWS):
+        end = start + len(chunk)
+        for array, dictionary, (_, kind), values in zip(arrays, dictionaries, columns,
+                                                        zip(*chunk)):
+            if kind == 'integer':
+                array[start:end] = [NULL_INTEGER if value is None else value
+                                    for value in values]
+            elif kind == 'real':
+                array[start:end] = [np.nan if value is None else value for value in values]
+            else:
+                array[start:end] = [-1 if value is None
+                                    else dictionary.setdefault(value, len(dictionary))
+                                    for value in values]
+        start = end
+
+    for array, dictionary, (column, _) in zip(arrays, dictionaries, columns):
+        array.flush()
+        if dictionary is None:
+            continue
+
+        encoded = [string.encode() for string in dictionary]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        np.save(os.path.join(directory, column + '.offsets.npy'), offsets)
+        with open(os.path.join(directory, column + '.strings'), 'wb') as file:
+            file.write(b''.join(encoded))
+
+    return rows
+
+
+def export_snapshot(db_path: str, directory: Optional[str] = None,
+                    force: bool = False) -> Snapshot:
+    '''
+    Export every table of SNAPSHOT_TABLES in the database to a new directory
+    that then replaces directory, and return the new snapshot. A failed
+    export leaves the previous snapshot as it was. An existing directory that
+    is not a snapshot raises FileExistsError, unless force is set.
+    '''
+
+    directory = directory or default_directory(db_path)
+    if (not force and os.path.exists(directory)
+            and not os.path.exists(os.path.join(directory, METADATA_FILE_NAME))):
+        raise FileExistsError('%s exists and is not a snapshot' % directory)
+
+    with replacing_directory(directory) as building:
+        # Stamp before reading, so that a write committed while exporting
+        # makes the snapshot stale rather than silently missing from it
+        stamp = database_stamp(db_path)
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, isolation_level=None)
+        tables = {}
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN')
+            for table, columns in SNAPSHOT_TABLES.items():
+                rows = _export_table(cursor, table, columns, os.path.join(building, table))
+                tables[table] = {'rows': rows, 'columns': dict(columns)}
+                print('Exported %d rows of %s' % (rows, table), file=sys.stderr)
+            cursor.execute('COMMIT')
+        finally:
+            conn.close()
+
+        with open(os.path.join(building, METADATA_FILE_NAME), 'w') as file:
+            json.dump({'database': os.path.abspath(db_path), 'stamp': stamp, 'tables': tables},
+                      file, indent=2)
+
+    return Snapshot(directory)
+
+
+def open_snapshot(db_path: str, directory: Optional[str] = None,
+                  export: bool = False) -> Optional[Snapshot]:
+    '''
+    Open the snapshot of the database in directory if it is fresh. Otherwise
+    export a new one if export is set, or return None.
+    '''
+
+    directory = directory or default_directory(db_path)
+    if os.path.exists(os.path.join(directory, METADATA_FILE_NAME)):
+        snapshot = Snapshot(directory)
+        if snapshot.is_fresh(db_path):
+            return snapshot
+
+    return export_snapshot(db_path, directory) if export else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database')
+    parser.add_argument('directory', nargs='?', default=None)
+    parser.add_argument('--force', action='store_true',
+                        help='Export even if the snapshot is fresh, replacing '
+                             'DIRECTORY even if it is not a snapshot')
+    args = parser.parse_args()
+
+    try:
+        if args.force:
+            export_snapshot(args.database, args.directory, force=True)
+        elif open_snapshot(args.database, args.directory) is not None:
+            print('Snapshot is fresh', file=sys.stderr)
+        else:
+            export_snapshot(args.database, args.directory)
+    except FileExistsError as e:
+        parser.error('%s, pass --force to replace it' % e)
+
+
+if __name__ == '__main__':
+    main()
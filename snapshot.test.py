@@ -0,0 +1,91 @@
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+
+import numpy as np
+
+from schema import TABLES
+from snapshot import NULL_INTEGER, Snapshot, default_directory, export_snapshot, open_snapshot
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, 'test.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(TABLES)
+        conn.executemany('INSERT INTO routes VALUES (?, ?, ?)',
+                         [(10, 'Föhn', 1), (11, 'Other', None), (12, 'Föhn', 2)])
+        conn.executemany('INSERT INTO reviews VALUES (?, ?, ?)',
+                         [(10, 7, 4), (11, 7, 0), (10, 8, 3)])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def export(self):
+        with redirect_stderr(io.StringIO()):
+            return export_snapshot(self.db_path)
+
+    def test_columns(self):
+        self.export()
+        snapshot = open_snapshot(self.db_path)
+
+        reviews = snapshot.table('reviews')
+        self.assertIsInstance(reviews['score'], np.memmap)
+        self.assertListEqual([4, 0, 3], reviews['score'].tolist())
+        self.assertListEqual([7, 7, 8], reviews['user_id'].tolist())
+
+        routes = snapshot.table('routes')
+        self.assertListEqual([1, NULL_INTEGER, 2], routes['area_id'].tolist())
+        self.assertListEqual(['Föhn', 'Other'], routes['name'].dictionary())
+        self.assertListEqual([0, 1, 0], routes['name'].codes.tolist())
+        self.assertEqual('Other', routes['name'][1])
+        self.assertEqual(0, snapshot.rows('areas'))
+
+    def test_stale_after_write(self):
+        self.export()
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('DELETE FROM reviews WHERE user_id = 8')
+        conn.commit()
+        conn.close()
+
+        self.assertIsNone(open_snapshot(self.db_path))
+        with redirect_stderr(io.StringIO()):
+            snapshot = open_snapshot(self.db_path, export=True)
+        self.assertEqual(2, snapshot.rows('reviews'))
+
+    def test_failed_export_keeps_the_snapshot(self):
+        self.export()
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('DROP TABLE areas')
+        conn.commit()
+        conn.close()
+
+        with self.assertRaises(sqlite3.OperationalError):
+            self.export()
+        self.assertEqual(3, Snapshot(default_directory(self.db_path)).rows('reviews'))
+        self.assertListEqual(['test.db', 'test.db.snapshot'],
+                             sorted(os.listdir(self.directory.name)))
+
+    def test_refuses_to_replace_other_directories(self):
+        other = os.path.join(self.directory.name, 'other')
+        os.makedirs(other)
+        with open(os.path.join(other, 'keep'), 'w'):
+            pass
+
+        with self.assertRaises(FileExistsError):
+            export_snapshot(self.db_path, other)
+        self.assertListEqual(['keep'], os.listdir(other))
+
+        with redirect_stderr(io.StringIO()):
+            export_snapshot(self.db_path, other, force=True)
+        self.assertNotIn('keep', os.listdir(other))
+
+
+if __name__ == '__main__':
+    unittest.main()